@@ -24,6 +24,7 @@
 #define LATCHING_RELAYS     "LR"
 #define NON_LATCHING_RELAYS "NLR"
 #define THERMISTOR_TEMP     "TEMP"
+#define BINARY_FRAMES       "BIN"
 #define START_MARKER        '{'
 #define END_MARKER          '}'
 
@@ -37,6 +38,14 @@
 
 #define MY_DEVICE_ID              1
 
+// binary frame: magic(2) id(1) type(1) seq(2) pixels(128) NLR(1) LR(1) CRC(2)
+// multi-byte fields are little-endian, the CRC-16/CCITT (poly 0x1021,
+// init 0xFFFF) covers the bytes from id to LR
+#define BINARY_MAGIC_0            0xAA
+#define BINARY_MAGIC_1            0x55
+#define BINARY_FRAME_SIZE         138
+#define BINARY_PIXELS_OFFSET      6
+
 volatile boolean endMarkerFound = false;
 volatile boolean startMarkerFound = false;
 
@@ -57,6 +66,10 @@ OWGridEye owGridEye(selector);
 volatile boolean sendGEData;
 volatile SerialData dataBuf;
 volatile boolean ge_connected;
+volatile boolean binary_frames = false;
+volatile uint8_t nlr_status = 0;
+volatile uint8_t lr_status = 0;
+uint16_t frame_sequence = 0;
 
 void setup_MAXREFDES130(void){
   rly_drvr.begin(D_MOSI, D_SCLK, RLY_DRVR_CS);
@@ -138,27 +151,61 @@ ISR(TIMER1_COMPA_vect)
   sendGEData = true;
 }
 
+uint16_t crc16_ccitt(const uint8_t *data, uint16_t length) {
+  uint16_t crc = 0xFFFF;
+  while (length--) {
+    crc ^= (uint16_t)(*data++) << 8;
+    for (uint8_t i = 0; i < 8; i++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void sendBinaryFrame(int16_t *pixels) {
+  uint8_t frame[BINARY_FRAME_SIZE];
+  frame[0] = BINARY_MAGIC_0;
+  frame[1] = BINARY_MAGIC_1;
+  frame[2] = MY_DEVICE_ID;
+  frame[3] = DEVICE_TYPE_MRD130_MRD131;
+  frame[4] = frame_sequence & 0xFF;
+  frame[5] = frame_sequence >> 8;
+  // the AVR is little-endian, as the frame format
+  memcpy(&frame[BINARY_PIXELS_OFFSET], pixels, 128);
+  frame[BINARY_FRAME_SIZE - 4] = nlr_status;
+  frame[BINARY_FRAME_SIZE - 3] = lr_status;
+  uint16_t crc = crc16_ccitt(&frame[2], BINARY_FRAME_SIZE - 4);
+  frame[BINARY_FRAME_SIZE - 2] = crc & 0xFF;
+  frame[BINARY_FRAME_SIZE - 1] = crc >> 8;
+  Serial.write(frame, BINARY_FRAME_SIZE);
+}
+
 void loop() {
   if (sendGEData) {
-    StaticJsonBuffer<SEND_BUF_MAXSIZE> jsonBuffer;
-    JsonObject& root = jsonBuffer.createObject();
-
-    root[DEVICE_ID] = MY_DEVICE_ID;
-    root[DEVICE_TYPE] = DEVICE_TYPE_MRD130_MRD131;
-
-    JsonArray& data = root.createNestedArray(GRIDEYE);
-     
-    if (ge_connected) {
-        int16_t recvBuff[64];
-        int sec_buf[64];
-        if(owGridEye.gridEyeGetFrameTemperature(recvBuff) == OWGridEye::Success){ 
+    int16_t recvBuff[64];
+    boolean frameRead = ge_connected &&
+                        (owGridEye.gridEyeGetFrameTemperature(recvBuff) == OWGridEye::Success);
+    frame_sequence++;
+    if (binary_frames && frameRead) {
+      sendBinaryFrame(recvBuff);
+    } else {
+      StaticJsonBuffer<SEND_BUF_MAXSIZE> jsonBuffer;
+      JsonObject& root = jsonBuffer.createObject();
+
+      root[DEVICE_ID] = MY_DEVICE_ID;
+      root[DEVICE_TYPE] = DEVICE_TYPE_MRD130_MRD131;
+
+      JsonArray& data = root.createNestedArray(GRIDEYE);
+
+      if (frameRead) {
+          int sec_buf[64];
           memcpy(sec_buf,recvBuff,128);
-          data.copyFrom(sec_buf);   
-        }
+          data.copyFrom(sec_buf);
+      }
+      root.printTo(Serial);
+      delay(1);
+      Serial.println();
     }
-    root.printTo(Serial);
-    delay(1);
-    Serial.println();
     cli();
     sendGEData = false;
     sei();
@@ -170,6 +217,7 @@ void parseData() {
   JsonObject& data = jsonBuffer.parse((char *)&dataBuf.inputBuffer);
   if (data.containsKey(NON_LATCHING_RELAYS)) {
     uint8_t non_latching_relays_status = (uint8_t) data[NON_LATCHING_RELAYS];
+    nlr_status = non_latching_relays_status;
     if(non_latching_relays_status==255){
       rly_drvr.set_all_relays(RLY_DRVR_SET);
     } else if(non_latching_relays_status==0){
@@ -186,11 +234,15 @@ void parseData() {
   }
   if (data.containsKey(LATCHING_RELAYS)) {
     uint8_t latching_relays_status = (uint8_t)data[LATCHING_RELAYS];
+    lr_status = latching_relays_status;
     for(uint8_t i=0;i<3;i++){
       uint8_t bit_value=(latching_relays_status>>i)&1;
       pixi.gpio_write(static_cast<MAX11300::MAX11300_Ports>(i + 9), bit_value);
     }  
   }
+  if (data.containsKey(BINARY_FRAMES)) {
+    binary_frames = (data[BINARY_FRAMES] != 0);
+  }
   if (data.containsKey(GRIDEYE)) {
     if(data[GRIDEYE]==0){
       ge_connected=false;
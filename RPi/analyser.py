@@ -1,10 +1,11 @@
 __author__ = 'fabio'
 import ConfigParser
-from copy import deepcopy
 import numpy as np
 from scipy.interpolate import griddata
 from scipy.signal import medfilt
+from scipy.ndimage import label
 import math
+from collections import OrderedDict
 
 PROCESSOR_SECTION="Processor"
 DETECTION_MODE_OPT="detection_mode"
@@ -25,15 +26,36 @@ detection_mode_dict = {DETECTION_MODE_ASBOLUTE:MODE_ABSOLUTE,
 ABSOLUTE_THRESHOLD_OPT="absolute_threshold"
 DIFFERENTIAL_THRESHOLD_OPT="differential_threshold"
 WINDOW_SIZE_OPT="window_size"
+SIGMA_THRESHOLD_OPT="sigma_threshold"
+TRACK_DISTANCE_OPT="track_distance"
 
 DEFAULT_WINDOW_SIZE = 10
 DEFAULT_ABSOLUTE_THRESHOLD=24
 DEFAULT_DIFFERENTIAL_THRESHOLD=2
+DEFAULT_SIGMA_THRESHOLD=0  # standard deviations of a background pixel, 0 to only use threshold_diff
+# floor of the background standard deviation, so that a pixel that has
+# been steady so far does not flag every small change
+MIN_BACKGROUND_STD=0.1
+# max distance (pixels) between the centroids of an object in two
+# consecutive frames, for the tracker to take it as the same object
+DEFAULT_TRACK_DISTANCE=2.0
 
 SKIP_TEMPERATURE=-999
+SKIP_RAW_TEMPERATURE=-32768  # SKIP_TEMPERATURE of the fixed point frames (scale > 1)
+
+# max number of interpolation operators kept by Upsampler.get (the processor
+# image and the resolutions of the web streams, see streams.py)
+UPSAMPLER_CACHE_SIZE = 4
+
+# type of the Frame pixel values
+FRAME_DTYPE = np.float32
+
+# 8-connectivity structuring element used to label the detected blobs
+CONNECTIVITY_8 = np.ones((3, 3), dtype=int)
 
 OBJECT_IN = 0
 OBJECT_OUT = 1
+OBJECT_MOVE = 2  # a tracked object is still detected, in its new position
 
 class Point(object):
     def __init__(self,x,y, value=None):
@@ -53,41 +75,164 @@ class Point(object):
     def __repr__(self):
         return "(%r,%r):%r" % (self.x,self.y,self.value)
 
+class Upsampler(object):
+    '''
+    Interpolation operator resizing a (srcX,srcY) image to (dstX,dstY).
+    griddata interpolation is linear in the data values, so the
+    interpolation weights are computed once (interpolating the unit
+    basis images) and each frame only costs a matrix-vector product.
+    Instances are cached by (source shape, target shape, method):
+    use Upsampler.get() rather than the constructor. The weights are
+    dense (dstX*dstY by srcX*srcY), so only the UPSAMPLER_CACHE_SIZE
+    most recently used operators are kept.
+    '''
+    _cache = OrderedDict()
+
+    def __init__(self, srcShape, dstShape, method='cubic'):
+        srcX, srcY = srcShape
+        dstX, dstY = dstShape
+        self.srcShape = (srcX, srcY)
+        self.dstShape = (dstX, dstY)
+        self.method = method
+        pts = np.array([[i, j] for i in np.linspace(0, 1, srcX) for j in np.linspace(0, 1, srcY)])
+        grid_x, grid_y = np.mgrid[0:1:dstX * 1j, 0:1:dstY * 1j]
+        basis = np.eye(srcX * srcY)
+        self.weights = np.reshape(griddata(pts, basis, (grid_x, grid_y), method=method),
+                                  (dstX * dstY, srcX * srcY))
+
+    @classmethod
+    def get(cls, srcShape, dstShape, method='cubic'):
+        key = (tuple(srcShape), tuple(dstShape), method)
+        upsampler = cls._cache.pop(key, None)
+        if upsampler is None:
+            upsampler = cls(srcShape, dstShape, method)
+            while len(cls._cache) >= UPSAMPLER_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        # (re)inserted as the most recently used
+        cls._cache[key] = upsampler
+        return upsampler
+
+    def apply(self, data):
+        '''
+        :param data: srcX*srcY 1-D array of values (or a (srcX,srcY) 2-D array)
+        :return: dstX*dstY 1-D array of the interpolated values
+        '''
+        return self.weights.dot(np.ravel(data))
+
+class BackgroundModel(object):
+    '''
+    Per-pixel running mean and variance of the background temperatures,
+    updated in place. Each pixel is the exact mean (Welford) of its first
+    window_size samples, then an exponential moving average with weight
+    1/window_size. The pixels covered by objects are left out of the
+    updates, so the background keeps following the slow changes of the
+    scene while the detection runs.
+    '''
+    __slots__ = ('window_size', 'alpha', 'min_std', 'frames', 'samples', 'mean', 'var')
+
+    def __init__(self, shape, window_size=DEFAULT_WINDOW_SIZE, dtype=FRAME_DTYPE, min_std=MIN_BACKGROUND_STD):
+        '''
+        :param dtype: type of the mean and variance, in the units of the frames
+        :param min_std: floor of the standard deviation, in the units of the frames
+        '''
+        self.window_size = window_size
+        self.min_std = min_std
+        self.alpha = 1.0 / window_size
+        self.frames = 0  # frames seen since the last reset
+        self.samples = np.zeros(shape, dtype=np.int64)  # samples per pixel, up to window_size
+        self.mean = np.zeros(shape, dtype=dtype)
+        self.var = np.zeros(shape, dtype=dtype)
+
+    def reset(self):
+        '''
+        Learn the background again: the next samples replace the current
+        values, which are still used until then.
+        '''
+        self.frames = 0
+        self.samples[...] = 0
+
+    def isReady(self):
+        return self.frames >= self.window_size
+
+    def update(self, values, mask=None):
+        '''
+        Add a frame to the model.
+        :param values: 2-D array of the frame temperatures
+        :param mask: boolean 2-D array, True for the background pixels to
+                     update (None for all)
+        '''
+        self.frames += 1
+        if mask is None:
+            np.add(self.samples, 1, out=self.samples, where=self.samples < self.window_size)
+            weight = np.maximum(1.0 / self.samples, self.alpha)
+        else:
+            np.add(self.samples, 1, out=self.samples, where=mask & (self.samples < self.window_size))
+            weight = np.where(mask, 1.0 / np.maximum(self.samples, 1), 0)
+            np.maximum(weight, self.alpha * mask, out=weight)
+        delta = values - self.mean
+        self.mean += weight * delta
+        # var(n) = (1 - w) * (var(n-1) + w * delta^2): the population variance
+        # for w = 1/n (Welford), the exponential moving variance for w = alpha
+        self.var += weight * delta * delta
+        self.var *= 1 - weight
+
+    def std(self):
+        return np.maximum(np.sqrt(self.var), self.min_std)
+
+
 class Frame(object):
-    def __init__(self,sizeX,sizeY,data=None):
+    '''
+    Image frame, backed by a single contiguous (sizeX,sizeY) array.
+    Flips return views on the same buffer, the in-place operators
+    work on the buffer directly, and conversion to a Python list only
+    happens when the frame is serialised (toList).
+    '''
+    __slots__ = ('sizeX', 'sizeY', 'size', 'imgMatrix')
+
+    def __init__(self,sizeX,sizeY,data=None,dtype=FRAME_DTYPE):
         '''
         Frame object constructor.
         :param sizeX: number of rows of the Frame image matrix
         :param sizeY: number of columns of the Frame image matrix
         :param data: can be either sizeX*sizeY 1-D array of values, or
                         a (sizeX,sizeY) 2-D array
+        :param dtype: type of the pixel values (default float32)
         '''
         self.sizeX = sizeX
         self.sizeY = sizeY
         self.size = sizeX * sizeY
-        if data==None:
-            data=[0] * sizeX * sizeY
-        self.shape = np.shape(data)
-        if len(self.shape) == 1:
+        if data is None:
+            self.imgMatrix = np.zeros((sizeX, sizeY), dtype=dtype)
+            return
+        data = np.array(data, dtype=dtype)
+        if data.ndim == 1:
             if sizeX * sizeY != len(data):
                 raise ValueError("Data points and (X,Y) size for the image do not match!")
             # 1-D array
-            self.rawData = deepcopy(data)
-            self.imgMatrix = np.reshape(self.rawData, (sizeX, sizeY))
-        elif self.shape == (sizeX, sizeY):
-            # 2-D array of the right size
             self.imgMatrix = np.reshape(data, (sizeX, sizeY))
-            self.rawData = self.imgMatrix.flatten().tolist()
+        elif data.shape == (sizeX, sizeY):
+            # 2-D array of the right size
+            self.imgMatrix = data
         else:
             # anything else is bad!
             raise ValueError("rawData array dimension does not match (X,Y) size!")
 
+    @property
+    def rawData(self):
+        '''
+        1-D view of the image (a copy if the image is a flipped view)
+        '''
+        return self.imgMatrix.ravel()
+
+    @property
+    def shape(self):
+        return self.imgMatrix.shape
+
     def setValue(self, x, y, value):
-        self.rawData[x*self.sizeY+y]=value
-        self.imgMatrix[x][y]=value
+        self.imgMatrix[x, y]=value
 
     def getValue(self, x, y):
-        return self.imgMatrix[x][y]
+        return self.imgMatrix[x, y]
 
     def getSize(self):
         return self.size
@@ -95,21 +240,43 @@ class Frame(object):
     def getShape(self):
         return self.shape
 
+    def toList(self):
+        '''
+        :return: the frame values as a flat Python list (for serialisation)
+        '''
+        return self.imgMatrix.ravel().tolist()
+
     def average(self, otherFrame):
-        self.imgMatrix = np.reshape((self.imgMatrix + otherFrame.imgMatrix) / 2,(self.sizeX,self.sizeY))
-        self.rawData = self.imgMatrix.flatten().tolist()
+        self.imgMatrix += otherFrame.imgMatrix
+        self.imgMatrix *= 0.5
 
     def __add__(a, b):
-        return Frame(a.sizeX,a.sizeY,np.array(a.rawData) + np.array(b.rawData))
+        return Frame(a.sizeX,a.sizeY,a.imgMatrix + b.imgMatrix,a.imgMatrix.dtype)
 
     def __sub__(a, b):
-        return Frame(a.sizeX,a.sizeY,np.array(a.rawData) - np.array(b.rawData))
+        return Frame(a.sizeX,a.sizeY,a.imgMatrix - b.imgMatrix,a.imgMatrix.dtype)
 
     def __mul__(a, b):
-        return Frame(a.sizeX,a.sizeY,np.array(a.rawData) * np.array(b.rawData))
+        return Frame(a.sizeX,a.sizeY,a.imgMatrix * b.imgMatrix,a.imgMatrix.dtype)
 
     def __div__(a, b):
-        return Frame(a.sizeX,a.sizeY,np.array(a.rawData) / np.array(b.rawData))
+        return Frame(a.sizeX,a.sizeY,a.imgMatrix / b.imgMatrix,a.imgMatrix.dtype)
+
+    def __iadd__(self, other):
+        self.imgMatrix += other.imgMatrix
+        return self
+
+    def __isub__(self, other):
+        self.imgMatrix -= other.imgMatrix
+        return self
+
+    def __imul__(self, other):
+        self.imgMatrix *= other.imgMatrix
+        return self
+
+    def __idiv__(self, other):
+        self.imgMatrix /= other.imgMatrix
+        return self
 
     def correlation(a,b):
         '''
@@ -119,7 +286,7 @@ class Frame(object):
         :param b: b Frame
         :return: the correlation value between a and b
         '''
-        return np.corrcoef(np.array((a.rawData,b.rawData)))[0, 1]
+        return np.corrcoef(a.rawData, b.rawData)[0, 1]
 
     def binary(self,detected_objects):
         '''
@@ -128,10 +295,9 @@ class Frame(object):
         :return: a Frame istance, with all background pixels = 0
                  and the objects pixels = 1
         '''
-        binaryFrame = Frame(self.sizeX,self.sizeY,[0]*self.sizeX*self.sizeY)
+        binaryFrame = Frame(self.sizeX,self.sizeY)
         for detectedObj in detected_objects:
-            for point in detectedObj.getPoints():
-                binaryFrame.setValue(point.x, point.y,1)
+            binaryFrame.imgMatrix[detectedObj.xs, detectedObj.ys] = 1
         return binaryFrame
 
     def stdDev(self):
@@ -139,78 +305,152 @@ class Frame(object):
         Calculate Standard Deviation of the frame temperature
         :return: the standard deviation
         '''
-        return np.std(self.rawData)
+        return float(np.std(self.imgMatrix))
 
-    def expand(self, sizeX, sizeY):
-        pts = np.array([[i, j] for i in np.linspace(0, 1, self.sizeX) for j in np.linspace(0, 1, self.sizeY)])
-        grid_x, grid_y = np.mgrid[0:1:sizeX * 1j, 0:1:sizeY * 1j]
-        self.rawData = np.reshape(griddata(pts, self.rawData, (grid_x, grid_y), method='cubic'), sizeX * sizeY)
+    def expand(self, sizeX, sizeY, method='cubic'):
+        upsampler = Upsampler.get((self.sizeX, self.sizeY), (sizeX, sizeY), method)
+        self.imgMatrix = np.reshape(upsampler.apply(self.imgMatrix).astype(self.imgMatrix.dtype), (sizeX, sizeY))
         self.sizeX = sizeX
         self.sizeY = sizeY
-        self.imgMatrix = np.reshape(self.rawData, (sizeX, sizeY))
+        self.size = sizeX * sizeY
 
     def flipH(self):
-        self.imgMatrix = np.fliplr(self.imgMatrix)
-        self.rawData = self.imgMatrix.flatten().tolist()
+        self.imgMatrix = self.imgMatrix[:, ::-1]
 
     def flipV(self):
-        self.imgMatrix = np.flipud(self.imgMatrix)
-        self.rawData = self.imgMatrix.flatten().tolist()
+        self.imgMatrix = self.imgMatrix[::-1, :]
 
     def max(self):
-        return max(self.rawData)
+        return float(self.imgMatrix.max())
 
     def min(self):
-        return min(self.rawData)
+        return float(self.imgMatrix.min())
 
     def mean(self):
-        return np.mean(self.rawData)
+        return float(np.mean(self.imgMatrix))
 
     def median(self):
-        return np.median(self.rawData)
+        return float(np.median(self.imgMatrix))
 
     def clone(self):
-        return Frame(self.sizeX,self.sizeY,self.rawData)
+        return Frame(self.sizeX,self.sizeY,self.imgMatrix,self.imgMatrix.dtype)
 
     def filterNoise(self):
-        self.imgMatrix = medfilt(self.imgMatrix, 5)
-        self.rawData = self.imgMatrix.flatten().tolist()
+        self.imgMatrix = medfilt(self.imgMatrix, 5).astype(self.imgMatrix.dtype)
 
     def __repr__(self):
         return str(self.imgMatrix)
 
 class DetectedObject(object):
-    def __init__(self,label=None,points=[]):
+    '''
+    Blob of pixels detected in a frame, stored as arrays of coordinates
+    and temperatures. The geometry (bounding box, centroid, area, mean and
+    max temperature) and the bitmask are computed on first use and cached
+    until the pixels change.
+    '''
+    __slots__ = ('label', 'xs', 'ys', 'temperatures', 'shape', 'geometry', 'bitmask')
+
+    def __init__(self,label=None,points=None,xs=None,ys=None,temperatures=None,shape=None):
         '''
         Initialise the object
         :param label: the name of the detected object
-        :param points: dictionary of points making up the
-                       detected object. Each point is
-                       a dictionary {(x,y) :temperature}
+        :param points: list of Point instances making up the detected
+                       object, if not given as arrays
+        :param xs: array of the rows of the object pixels
+        :param ys: array of the columns of the object pixels
+        :param temperatures: array of the temperatures of the object pixels
+        :param shape: (rows, columns) of the frame, for the bitmask (default:
+                      the smallest grid holding the object)
         '''
         self.label=label
-        self.points=points
+        if points is not None:
+            xs = [point.x for point in points]
+            ys = [point.y for point in points]
+            temperatures = [np.nan if point.value is None else point.value for point in points]
+        self.xs = np.asarray(xs if xs is not None else [], dtype=np.intp)
+        self.ys = np.asarray(ys if ys is not None else [], dtype=np.intp)
+        if temperatures is None:
+            temperatures = np.full(len(self.xs), np.nan)
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.shape = shape
+        self.geometry = None
+        self.bitmask = None
 
     def getLabel(self):
         return self.label
 
     def getSize(self):
-        pass
+        '''
+        :return: the number of pixels of the object
+        '''
+        return len(self.xs)
 
     def getPoints(self):
-        return self.points
+        return [Point(x, y, t) for x, y, t in zip(self.xs.tolist(), self.ys.tolist(), self.temperatures.tolist())]
 
     def setLabel(self,label):
         self.label=label
 
     def addPoint(self,point):
-        self.points= self.points + [point]
+        self.setPixels(np.append(self.xs, point.x), np.append(self.ys, point.y),
+                       np.append(self.temperatures, np.nan if point.value is None else point.value))
 
     def removePoint(self,point):
-        pass
+        keep = (self.xs != point.x) | (self.ys != point.y)
+        self.setPixels(self.xs[keep], self.ys[keep], self.temperatures[keep])
+
+    def setPixels(self, xs, ys, temperatures):
+        self.xs = np.asarray(xs, dtype=np.intp)
+        self.ys = np.asarray(ys, dtype=np.intp)
+        self.temperatures = np.asarray(temperatures, dtype=float)
+        self.geometry = None
+        self.bitmask = None
+
+    def getGeometry(self):
+        '''
+        :return: (bounding box (min row, min column, max row, max column),
+                 centroid (row, column), area, mean temperature, max temperature)
+        '''
+        if self.geometry is None:
+            if len(self.xs) == 0:
+                self.geometry = (None, None, 0, None, None)
+            else:
+                self.geometry = ((int(self.xs.min()), int(self.ys.min()), int(self.xs.max()), int(self.ys.max())),
+                                 (float(self.xs.mean()), float(self.ys.mean())),
+                                 len(self.xs),
+                                 float(self.temperatures.mean()),
+                                 float(self.temperatures.max()))
+        return self.geometry
+
+    def getBoundingBox(self):
+        return self.getGeometry()[0]
+
+    def getCentroid(self):
+        return self.getGeometry()[1]
+
+    def getArea(self):
+        return self.getGeometry()[2]
 
     def getAvgTemperature(self):
-        pass
+        return self.getGeometry()[3]
+
+    def getMaxTemperature(self):
+        return self.getGeometry()[4]
+
+    def getBitmask(self):
+        '''
+        :return: the object pixels as an integer, with bit x*columns+y set
+                 for the pixel (x,y) of the frame
+        '''
+        if self.bitmask is None:
+            columns = self.shape[1] if self.shape is not None else \
+                (int(self.ys.max()) + 1 if len(self.ys) else 1)
+            bits = np.unique(self.xs * columns + self.ys)
+            if len(bits) and bits[-1] < 64:
+                self.bitmask = int(np.bitwise_or.reduce(np.left_shift(np.uint64(1), bits.astype(np.uint64))))
+            else:
+                self.bitmask = sum(1 << bit for bit in bits.tolist())
+        return self.bitmask
 
     def distance(self,otherObject):
         '''
@@ -221,26 +461,118 @@ class DetectedObject(object):
         distance from
         :return:
         '''
-        distance=999
-        for pointA in self.getPoints():
-            for pointB in otherObject.getPoints():
-                currDistance = pointA - pointB
-                if currDistance < distance:
-                    distance = currDistance
-        return distance
-
-    def __eq__(self,other):
-        if self.__hash__() == other.__hash__():
-            return True
-        else:
-            return True if self.distance(other) <= 1.0 else False
-
-    def __hash__(self):
-        h=hash(frozenset(self.points))
-        return h
+        if len(self.xs) == 0 or len(otherObject.xs) == 0:
+            return 999
+        dx = self.xs[:, np.newaxis] - otherObject.xs[np.newaxis, :]
+        dy = self.ys[:, np.newaxis] - otherObject.ys[np.newaxis, :]
+        return math.sqrt((dx * dx + dy * dy).min())
 
     def __repr__(self):
-        return "%r,%r" % (self.label, self.points)
+        return "%r,%r" % (self.label, self.getPoints())
+
+class ObjectTracker(object):
+    '''
+    Follows the detected objects from frame to frame, giving each one a
+    persistent label. A blob of the new frame continues the track it
+    overlaps the most, then the unmatched blobs continue the nearest
+    unmatched track, as long as their centroids are within max_distance
+    pixels. The cost grows with the number of pixels and blobs, not
+    with the product of blobs and tracks.
+    '''
+
+    def __init__(self, max_distance=DEFAULT_TRACK_DISTANCE):
+        self.max_distance = max_distance
+        self.tracks = {}        # track id -> (DetectedObject, centroid)
+        self.trackImage = None  # track id of each pixel in the last frame (0: none)
+        self.nextId = 1
+
+    def update(self, objects, labels):
+        '''
+        Match the objects of a new frame with the tracks, and label them
+        with their track id.
+        :param objects: the DetectedObject instances of the frame
+        :param labels: 2-D array of the frame pixels label: k+1 for the pixels of
+                       objects[k], 0 for the background
+        :return: (new objects, [(previous object, object)] of the tracked ones,
+                 objects that disappeared)
+        '''
+        count = len(objects)
+        flatLabels = labels.ravel()
+        sizes = np.bincount(flatLabels, minlength=count + 1)[1:]
+        xs, ys = np.indices(labels.shape)
+        centroids = np.zeros((count, 2))
+        if count:
+            centroids[:, 0] = np.bincount(flatLabels, xs.ravel(), count + 1)[1:] / sizes
+            centroids[:, 1] = np.bincount(flatLabels, ys.ravel(), count + 1)[1:] / sizes
+        matches = {}  # object index -> track id
+        if self.tracks and count:
+            # overlapping (track, object) pairs, the largest overlaps first
+            if self.trackImage is not None and self.trackImage.shape == labels.shape:
+                overlap = (labels > 0) & (self.trackImage > 0)
+                pairs = self.trackImage[overlap].astype(np.int64) * (count + 1) + labels[overlap]
+                pairs, overlaps = np.unique(pairs, return_counts=True)
+                matched = set()
+                for pair in pairs[np.argsort(-overlaps, kind='mergesort')]:
+                    trackId, objIdx = divmod(int(pair), count + 1)
+                    objIdx -= 1
+                    if trackId in matched or objIdx in matches or trackId not in self.tracks:
+                        continue
+                    matches[objIdx] = trackId
+                    matched.add(trackId)
+            self.matchByDistance(centroids, matches)
+        entered = []
+        moved = []
+        tracks = {}
+        lut = np.zeros(count + 1, dtype=np.int64)
+        for objIdx, obj in enumerate(objects):
+            trackId = matches.get(objIdx)
+            if trackId is None:
+                trackId = self.nextId
+                self.nextId += 1
+                entered.append(obj)
+            else:
+                moved.append((self.tracks[trackId][0], obj))
+            obj.setLabel(str(trackId))
+            tracks[trackId] = (obj, centroids[objIdx])
+            lut[objIdx + 1] = trackId
+        left = [obj for trackId, (obj, centroid) in self.tracks.iteritems() if trackId not in tracks]
+        self.tracks = tracks
+        self.trackImage = lut[labels]
+        return entered, moved, left
+
+    def matchByDistance(self, centroids, matches):
+        '''
+        Match the objects left to the nearest track left, within max_distance:
+        the tracks are bucketed in cells of max_distance pixels, so that each
+        object is only compared with the tracks of the 9 cells around it.
+        '''
+        matched = set(matches.itervalues())
+        cellSize = max(self.max_distance, 1e-6)
+        cells = {}
+        for trackId, (obj, centroid) in self.tracks.iteritems():
+            if trackId not in matched:
+                cell = (int(centroid[0] // cellSize), int(centroid[1] // cellSize))
+                cells.setdefault(cell, []).append(trackId)
+        if not cells:
+            return
+        for objIdx, centroid in enumerate(centroids):
+            if objIdx in matches:
+                continue
+            cellX, cellY = int(centroid[0] // cellSize), int(centroid[1] // cellSize)
+            best = None
+            bestDistance = self.max_distance ** 2
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for trackId in cells.get((cellX + dx, cellY + dy), ()):
+                        if trackId in matched:
+                            continue
+                        trackCentroid = self.tracks[trackId][1]
+                        distance = (trackCentroid[0] - centroid[0]) ** 2 + (trackCentroid[1] - centroid[1]) ** 2
+                        if distance <= bestDistance:
+                            best, bestDistance = trackId, distance
+            if best is not None:
+                matches[objIdx] = best
+                matched.add(best)
 
 class ImageProcessor(object):
     S_PROCESS_BACKGROUND = 1  # need to acquire frames to set background
@@ -250,7 +582,7 @@ class ImageProcessor(object):
                  threshold_abs=DEFAULT_ABSOLUTE_THRESHOLD,
                  threshold_diff=DEFAULT_DIFFERENTIAL_THRESHOLD,
                  window_size = DEFAULT_WINDOW_SIZE,
-                 debug_queue=None):
+                 debug_queue=None, config=None, threshold_sigma=DEFAULT_SIGMA_THRESHOLD, scale=1):
         '''
 
         :param detection_mode: detection mode. Available modes are
@@ -269,27 +601,37 @@ class ImageProcessor(object):
         :param threshold_abs: value for the absolute temperature (default 25C)
         :param threshold_diff:value for the differential temperature (default 2C)
         :param window_size:number of frame processed to set the background image
+        :param config: ConfigParser instance, read instead of config_file
+        :param threshold_sigma: if not 0, the differential detection also needs a
+                                pixel to be this many standard deviations above
+                                its background mean (noisy pixels need more)
+        :param scale: frame units per C: 1 for frames in C, 256 for the int16
+                      frames in the sensor fixed point format. The thresholds
+                      are given in C, and scaled once here
         '''
         self.debug_queue = debug_queue
         self.threshold_diff = threshold_diff
         self.threshold_abs = threshold_abs
+        self.threshold_sigma = threshold_sigma
         self.detection_mode=detection_mode
-        self.background=None
+        self.background=None  # Frame of the background mean (backgroundModel.mean)
+        self.backgroundModel=None
+        self.foreground=None  # boolean 2-D array of the pixels of the detected objects
         self.current_frame=None
-        self.detectedObjects={}
-        self.detectionCallbacks={OBJECT_IN:[],OBJECT_OUT:[]}
-        # self.detectionCallbacks[OBJECT_IN] = []
-        # self.detectionCallbacks[OBJECT_OUT] = []
-        self.trackingCallbacks={}
+        self.detectedObjects=[]
+        self.detectionCallbacks={OBJECT_IN:[],OBJECT_OUT:[],OBJECT_MOVE:[]}
+        self.trackingCallbacks={}  # object label (None for all) -> callbacks
+        self.tracker = ObjectTracker()
+        self.labels = None  # label of each pixel of the current frame (see detectObjects)
         self.current_frame=None
-        self.bkgIdx = 0
         self.window_size = window_size
         self.status = ImageProcessor.S_PROCESS_BACKGROUND
-        if config_file:
-            #override defaults with configuration based settings
+        if config is None and config_file:
             config = ConfigParser.ConfigParser()
             config.optionxform = str
             config.read(config_file)
+        if config is not None:
+            #override defaults with configuration based settings
             if config.has_option(PROCESSOR_SECTION,DETECTION_MODE_OPT):
                 self.detection_mode=detection_mode_dict[config.get(PROCESSOR_SECTION,DETECTION_MODE_OPT)]
             if config.has_option(PROCESSOR_SECTION,ABSOLUTE_THRESHOLD_OPT):
@@ -298,6 +640,15 @@ class ImageProcessor(object):
                 self.threshold_diff=config.getint(PROCESSOR_SECTION, DIFFERENTIAL_THRESHOLD_OPT)
             if config.has_option(PROCESSOR_SECTION,WINDOW_SIZE_OPT):
                 self.window_size=config.getint(PROCESSOR_SECTION, WINDOW_SIZE_OPT)
+            if config.has_option(PROCESSOR_SECTION,SIGMA_THRESHOLD_OPT):
+                self.threshold_sigma=config.getfloat(PROCESSOR_SECTION, SIGMA_THRESHOLD_OPT)
+            if config.has_option(PROCESSOR_SECTION,TRACK_DISTANCE_OPT):
+                self.tracker.max_distance=config.getfloat(PROCESSOR_SECTION, TRACK_DISTANCE_OPT)
+        # from now on the temperatures are in the units of the frames
+        self.scale = scale
+        self.threshold_abs = self.threshold_abs * scale
+        self.threshold_diff = self.threshold_diff * scale
+        self.skip_temperature = SKIP_TEMPERATURE if scale == 1 else SKIP_RAW_TEMPERATURE
 
     def getDetectedObjects(self):
         return self.detectedObjects
@@ -312,11 +663,13 @@ class ImageProcessor(object):
         The callback will receive the following arguments:
         detection_callback(detected_object,event,frame)
             detected_object: a DetectedObject instance
-            event: either OBJECT_IN (new detection) or OBJECT_OUT (object disappeared)
+            event: OBJECT_IN (new detection), OBJECT_MOVE (object still detected,
+                   called on every frame) or OBJECT_OUT (object disappeared)
             frame: a Frame instance of the frame where object has been detected
         :param callback: function called in event of movement detected
         :param event: detection event as follow
                       OBJECT_IN = new object detected
+                      OBJECT_MOVE = previously detected object still detected
                       OBJECT_OUT= previously detected object now undetected
         :return:
         '''
@@ -331,16 +684,30 @@ class ImageProcessor(object):
         detected.
         The callback will receive the following arguments:
         tracking_callback(object_label,old_position_points,new_position_points)
+        The labels are persistent (see ObjectTracker): the callbacks of an
+        object are dropped when it disappears.
 
-        :param objectLabel: label of the object to be tracked
+        :param objectLabel: label of the object to be tracked (None for all the objects)
         :param callback: function called in event of movement detected
         :return:
         '''
-        pass
+        self.trackingCallbacks.setdefault(objectLabel, []).append(callback)
+
+    def notifyTracking(self, previous, current):
+        label = current.getLabel()
+        callbacks = self.trackingCallbacks.get(label, []) + self.trackingCallbacks.get(None, [])
+        if not callbacks or previous.getBitmask() == current.getBitmask():
+            return
+        for cb in callbacks:
+            cb(label, previous.getPoints(), current.getPoints())
 
     def updateBackground(self):
-        self.bkgIdx = 0
-        self.status=ImageProcessor.S_PROCESS_BACKGROUND
+        '''
+        Learn the background again. Once it has been set, the detection
+        keeps running on the current one while the new one is learnt.
+        '''
+        if self.backgroundModel is not None:
+            self.backgroundModel.reset()
 
     def processFrame(self,frame):
         '''
@@ -348,53 +715,64 @@ class ImageProcessor(object):
         :param frame: frame to process
         :return: status of the processing
         '''
+        if self.backgroundModel is None or self.backgroundModel.mean.shape != frame.shape:
+            self.backgroundModel = BackgroundModel(frame.shape, self.window_size,
+                                                   min_std=MIN_BACKGROUND_STD * self.scale)
+            self.background = Frame(frame.sizeX, frame.sizeY)
+            self.background.imgMatrix = self.backgroundModel.mean
+            self.status = ImageProcessor.S_PROCESS_BACKGROUND
         if self.status == ImageProcessor.S_PROCESS_BACKGROUND:
-            # process background:
-            # The background thermal image will be calculated as
-            # the moving average of 'self.windowSize' number of
-            # consecutive frames. As the background image is supposed
-            # to be sort of 'steady-state', each frame should show strong
-            # correlation with the previously acquired sample.
-            # If change is detected, start the processing of the background
-            # again.
-            if self.bkgIdx == 0:
-                self.background = frame.clone()
-            elif self.bkgIdx < self.window_size -1 :
-                corr_coeff = Frame.correlation(self.background, frame)
-                if abs(corr_coeff) >= 0.5:  # moderate to strong correlation
-                    self.background.average(frame)
-                else:
-                    self.background = frame.clone()
-                    self.bkgIdx = 0
-            else:
+            # process background: the first 'self.window_size' frames
+            # set the background mean and variance of each pixel
+            self.backgroundModel.update(frame.imgMatrix, frame.imgMatrix != self.skip_temperature)
+            if self.backgroundModel.isReady():
                 self.status = ImageProcessor.S_PROCESS_IMAGE
-            self.bkgIdx = self.bkgIdx + 1
         elif self.status == ImageProcessor.S_PROCESS_IMAGE:
-            currentDetectedObjs = deepcopy(self.detectedObjects)
             self.current_frame = frame.clone()
             self.detectedObjects = self.detectObjects()
-            detectedObjs = deepcopy(self.detectedObjects)
-            # compare the list of detected objects with
-            # the one already detected and notify callbacks
-            differentObjs = list(set(detectedObjs) ^ set(currentDetectedObjs))
-            detectedObjs = list(set(detectedObjs) & set(differentObjs))
-            currentDetectedObjs = list(set(currentDetectedObjs) & set(differentObjs))
-            for newDetObj in detectedObjs:
+            # match the objects with the ones of the previous
+            # frame (persistent labels) and notify callbacks
+            entered, moved, left = self.tracker.update(self.detectedObjects, self.labels)
+            for newDetObj in entered:
                 for cb in self.detectionCallbacks[OBJECT_IN]:
                     cb(newDetObj, OBJECT_IN, frame)
-            for currDetObj in currentDetectedObjs:
+            for prevDetObj, detObj in moved:
+                for cb in self.detectionCallbacks[OBJECT_MOVE]:
+                    cb(detObj, OBJECT_MOVE, frame)
+                self.notifyTracking(prevDetObj, detObj)
+            for currDetObj in left:
                 for cb in self.detectionCallbacks[OBJECT_OUT]:
                     cb(currDetObj, OBJECT_OUT, frame)
+                self.trackingCallbacks.pop(currDetObj.getLabel(), None)
+            # follow the changes of the background, outside the objects
+            # (or everywhere while it is learnt again, see updateBackground)
+            background = frame.imgMatrix != self.skip_temperature
+            if self.backgroundModel.isReady():
+                background &= ~self.foreground
+            self.backgroundModel.update(frame.imgMatrix, background)
         return self.status
 
+    def differentialThreshold(self):
+        '''
+        :return: the min temperature difference with the background for a
+                 positive detection, per pixel (2-D array) if threshold_sigma
+                 is set, else threshold_diff
+        '''
+        if self.threshold_sigma and self.backgroundModel is not None:
+            return np.maximum(self.threshold_diff, self.threshold_sigma * self.backgroundModel.std())
+        return self.threshold_diff
+
     def isThresholdPassed(self,x,y,frame=None):
         passed = False
         currentFrame = frame if frame != None else self.current_frame
         temperature = currentFrame.getValue(x,y)
-        if temperature != SKIP_TEMPERATURE:
+        if temperature != self.skip_temperature:
             passedAbs = temperature>=self.threshold_abs
             if self.background != None:
-                passedDiff = (temperature - self.background.getValue(x, y)) >= self.threshold_diff
+                threshold = self.differentialThreshold()
+                if not np.isscalar(threshold):
+                    threshold = threshold[x, y]
+                passedDiff = (temperature - self.background.getValue(x, y)) >= threshold
             else:
                 passedDiff = False
             if self.detection_mode == MODE_ABSOLUTE:
@@ -407,41 +785,62 @@ class ImageProcessor(object):
                 passed = passedAbs or passedDiff
         return passed
 
-    def detectObjects(self):
-        objects=[]
-        objIdx=1
-        workFrame = self.current_frame.clone()
-        for x in range(0,workFrame.sizeX):
-            for y in range(0,workFrame.sizeY):
-                if self.isThresholdPassed(x,y):
-                    points = self.extractPoints(x,y,workFrame)
-                    detectedObj = DetectedObject(str(objIdx),points)
-                    objects = objects + [detectedObj]
-                    objIdx = objIdx + 1
-        return objects
-
-    def extractPoints(self,x,y,frame):
+    def thresholdMask(self,frame=None):
         '''
-        Extract all the points that belong to the same object with temperature >= threshold
-        (points belong to the same object if they are neighbors of the (x,y) point)
-
-        :param x: x coord. center of the neighbors matrix to check
-        :param y: y coord. center of the neighbors matrix to check
-        :param frame: the image to scan
-        :return: points dictionary (ex: {(x1,y1):temp1,(x2,y2):temp2})
+        Vectorised version of isThresholdPassed, evaluated on all
+        the pixels of the frame in one pass.
+        :param frame: the frame to test (default: the current frame)
+        :return: boolean 2-D array, True where the detection threshold is passed
         '''
-        points=[Point(x, y, frame.getValue(x, y))]
-        xmin = x-1 if x>0 else 0
-        xmax = x+1 if x<frame.sizeX-1 else frame.sizeX-1
-        ymin = y-1 if y>0 else 0
-        ymax = y+1 if y<frame.sizeY-1 else frame.sizeY-1
-        frame.imgMatrix[x][y] = SKIP_TEMPERATURE #self.background.imgMatrix[x][y]
-        for xi in range(xmin,xmax+1):
-            for yi in range(ymin,ymax+1):
-                if self.isThresholdPassed(xi,yi,frame) and (xi,yi) != (x,y):
-                    points= points + self.extractPoints(xi, yi, frame)
-        return points
+        currentFrame = frame if frame != None else self.current_frame
+        temperature = currentFrame.imgMatrix
+        valid = temperature != self.skip_temperature
+        passedAbs = temperature >= self.threshold_abs
+        if self.background != None:
+            passedDiff = (temperature - self.background.imgMatrix) >= self.differentialThreshold()
+        else:
+            passedDiff = np.zeros(temperature.shape, dtype=bool)
+        if self.detection_mode == MODE_ABSOLUTE:
+            passed = passedAbs
+        elif self.detection_mode == MODE_DIFFERENTIAL:
+            passed = passedDiff
+        elif self.detection_mode == MODE_BOTH:
+            passed = passedAbs & passedDiff
+        else: #default MODE_ANY
+            passed = passedAbs | passedDiff
+        return passed & valid
 
+    def detectObjects(self):
+        '''
+        Detect the objects in the current frame: the pixels passing the
+        detection threshold are grouped in 8-connected blobs, each blob
+        being a DetectedObject. Objects are labelled in raster order.
+        :return: list of DetectedObject instances
+        '''
+        objects=[]
+        self.foreground = self.thresholdMask()
+        labels, count = label(self.foreground, structure=CONNECTIVITY_8)
+        self.labels = labels
+        if count == 0:
+            return objects
+        imgMatrix = self.current_frame.imgMatrix
+        # sort the labelled pixels by label, keeping the raster order
+        # within each blob, then split them in one group per object
+        flatLabels = labels.ravel()
+        idx = np.flatnonzero(flatLabels)
+        idx = idx[np.argsort(flatLabels[idx], kind='mergesort')]
+        xs, ys = np.unravel_index(idx, labels.shape)
+        values = imgMatrix[xs, ys]
+        if self.scale != 1:
+            # the objects temperatures are in C
+            values = values / float(self.scale)
+        bounds = np.cumsum(np.bincount(flatLabels[idx])[1:])[:-1]
+        for objIdx, (oxs, oys, ovalues) in enumerate(zip(np.split(xs, bounds),
+                                                         np.split(ys, bounds),
+                                                         np.split(values, bounds))):
+            objects.append(DetectedObject(str(objIdx + 1), xs=oxs, ys=oys, temperatures=ovalues,
+                                          shape=labels.shape))
+        return objects
 
 if __name__ == '__main__':
     # data=[1,2,3,4]
@@ -489,11 +888,14 @@ if __name__ == '__main__':
     def callback_f(detected,event,frame):
         if event == OBJECT_IN:
             print "detected object! (%s)" % detected
+        elif event == OBJECT_MOVE:
+            print "moved object! (%s)" % detected
         else:
             print "deleted object! (%s)" % detected
 
     monitor.addDetectionCallback(callback_f, OBJECT_IN)
     monitor.addDetectionCallback(callback_f, OBJECT_OUT)
+    monitor.addDetectionCallback(callback_f, OBJECT_MOVE)
 
     for currFrame in frame:
         monitor.processFrame(currFrame)
@@ -0,0 +1,238 @@
+__author__ = 'fabio'
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import timeit
+import numpy as np
+import scipy
+from scipy.interpolate import griddata
+from analyser import Frame, Upsampler, ImageProcessor, MODE_DIFFERENTIAL, OBJECT_IN, OBJECT_OUT
+from simulator import SyntheticScene
+from device import TEMPERATURE_SCALE
+
+REPEAT = 5
+NUMBER = 20
+
+# sensor grid sizes (rows, columns) and thermal image size of the suite
+GRIDS = ((8, 8), (16, 16), (32, 24), (64, 64))
+IMAGE_SIZE = (64, 64)
+WINDOW_SIZE = 10
+# a result slower than the baseline by more than this factor is a regression
+DEFAULT_REGRESSION_THRESHOLD = 1.25
+
+
+def griddata_expand(frame, sizeX, sizeY):
+    '''
+    The original Frame.expand: griddata rebuilds the points and
+    the Delaunay triangulation for every frame.
+    '''
+    pts = np.array([[i, j] for i in np.linspace(0, 1, frame.sizeX) for j in np.linspace(0, 1, frame.sizeY)])
+    grid_x, grid_y = np.mgrid[0:1:sizeX * 1j, 0:1:sizeY * 1j]
+    return np.reshape(griddata(pts, frame.rawData, (grid_x, grid_y), method='cubic'), sizeX * sizeY)
+
+
+def bench(stmt, number=NUMBER):
+    '''
+    :return: best time per call, in milliseconds
+    '''
+    return min(timeit.repeat(stmt, repeat=REPEAT, number=number)) / number * 1000
+
+
+def bench_expand(sizeX=8, sizeY=8, imageX=64, imageY=64):
+    data = np.random.uniform(18, 30, sizeX * sizeY).tolist()
+    frame = Frame(sizeX, sizeY, data)
+    setup = timeit.default_timer()
+    Upsampler.get((sizeX, sizeY), (imageX, imageY))
+    setup = (timeit.default_timer() - setup) * 1000
+    reference = griddata_expand(frame, imageX, imageY)
+    error = np.max(np.abs(Upsampler.get((sizeX, sizeY), (imageX, imageY)).apply(data) - reference))
+    old = bench(lambda: griddata_expand(frame, imageX, imageY))
+    new = bench(lambda: frame.clone().expand(imageX, imageY))
+    print "expand %dx%d -> %dx%d" % (sizeX, sizeY, imageX, imageY)
+    print "  griddata per frame:  %8.3f ms" % old
+    print "  upsampler per frame: %8.3f ms (one-off setup %.3f ms)" % (new, setup)
+    print "  speed-up:            %8.1fx" % (old / new)
+    print "  max abs difference:  %8.2e" % error
+
+
+def scene(sizeX, sizeY, blobs, count):
+    '''
+    :return: count frames (lists of temperatures) of a synthetic scene
+    '''
+    generator = SyntheticScene(blobs=blobs, seed=blobs, sizeX=sizeX, sizeY=sizeY)
+    if blobs > 1:
+        # spread the blobs on a lattice, so that they are detected as separate objects
+        columns = int(np.ceil(np.sqrt(blobs * float(sizeY) / sizeX)))
+        rows = int(np.ceil(blobs / float(columns)))
+        centers = [((row + 0.5) * sizeX / rows, (column + 0.5) * sizeY / columns)
+                   for row in range(rows) for column in range(columns)]
+        generator.positions = np.array(centers[:blobs])
+    return [generator.next().ravel().tolist() for i in range(count)]
+
+
+def manyBlobs(sizeX, sizeY):
+    return max(3, sizeX * sizeY // 64)
+
+
+def fixedPointFrame(sizeX, sizeY, data):
+    '''
+    :return: a Frame of the temperatures in the sensor fixed point format (int16)
+    '''
+    return Frame(sizeX, sizeY, np.rint(np.asarray(data) * TEMPERATURE_SCALE), np.int16)
+
+
+def detector(sizeX, sizeY, scale=1):
+    '''
+    :param scale: 1 for frames in C, TEMPERATURE_SCALE for fixed point frames
+    :return: an ImageProcessor with its background set (detection phase)
+    '''
+    imageProcessor = ImageProcessor(detection_mode=MODE_DIFFERENTIAL, window_size=WINDOW_SIZE, scale=scale)
+    background, = scene(sizeX, sizeY, 0, 1)
+    for i in range(WINDOW_SIZE + 1):
+        imageProcessor.processFrame(Frame(sizeX, sizeY, background) if scale == 1 else
+                                    fixedPointFrame(sizeX, sizeY, background))
+    assert imageProcessor.status == ImageProcessor.S_PROCESS_IMAGE
+    return imageProcessor
+
+
+def bench_grid(sizeX, sizeY, image=IMAGE_SIZE):
+    '''
+    Time the hot paths for one sensor grid size.
+    :return: dictionary of the timings (ms per call), by benchmark name
+    '''
+    results = {}
+    empty, = scene(sizeX, sizeY, 0, 1)
+    blobs = scene(sizeX, sizeY, manyBlobs(sizeX, sizeY), 2)
+    frame = Frame(sizeX, sizeY, empty)
+    other = Frame(sizeX, sizeY, blobs[0])
+
+    results['frame_construct'] = bench(lambda: Frame(sizeX, sizeY, empty))
+    results['flip'] = bench(lambda: (frame.flipH(), frame.flipV()))
+    setup = timeit.default_timer()
+    Upsampler.get((sizeX, sizeY), image)
+    results['expand_setup'] = (timeit.default_timer() - setup) * 1000
+    results['expand'] = bench(lambda: frame.clone().expand(image[0], image[1]))
+    expanded = frame.clone()
+    expanded.expand(image[0], image[1])
+    results['filter_noise'] = bench(lambda: expanded.clone().filterNoise())
+    results['correlation'] = bench(lambda: Frame.correlation(frame, other))
+
+    # background phase: averaging the frames of the window
+    imageProcessor = ImageProcessor(detection_mode=MODE_DIFFERENTIAL, window_size=sys.maxint)
+    imageProcessor.processFrame(frame.clone())
+    results['process_frame_background'] = bench(lambda: imageProcessor.processFrame(frame))
+
+    # detection phase, alternating two frames to fire the callbacks
+    imageProcessor = detector(sizeX, sizeY)
+    imageProcessor.addDetectionCallback(lambda obj, event, frm: None, OBJECT_IN)
+    imageProcessor.addDetectionCallback(lambda obj, event, frm: None, OBJECT_OUT)
+    frames = itertools.cycle([Frame(sizeX, sizeY, data) for data in blobs])
+    results['process_frame_detection'] = bench(lambda: imageProcessor.processFrame(next(frames)))
+    imageProcessor = detector(sizeX, sizeY, TEMPERATURE_SCALE)
+    imageProcessor.addDetectionCallback(lambda obj, event, frm: None, OBJECT_IN)
+    imageProcessor.addDetectionCallback(lambda obj, event, frm: None, OBJECT_OUT)
+    frames = itertools.cycle([fixedPointFrame(sizeX, sizeY, data) for data in blobs])
+    results['process_frame_detection_int16'] = bench(lambda: imageProcessor.processFrame(next(frames)))
+
+    imageProcessor = detector(sizeX, sizeY)
+    for name, count in (('0', 0), ('1', 1), ('many', manyBlobs(sizeX, sizeY))):
+        data, = scene(sizeX, sizeY, count, 1)
+        imageProcessor.current_frame = Frame(sizeX, sizeY, data)
+        results['detect_objects_%s' % name] = bench(imageProcessor.detectObjects)
+
+    results['processor_process'] = bench_processor(sizeX, sizeY, blobs, image)
+    return results
+
+
+def bench_processor(sizeX, sizeY, blobs, image=IMAGE_SIZE):
+    '''
+    :return: time (ms) of Processor.process, from the node message to
+             the message for the web server, with all the frame parts built
+    '''
+    import pipeline
+    import processor
+    from node import SOURCE_TAG, DEVICE
+    from device import GE
+    queues = [pipeline.StageQueue(name) for name in ('node_to_processor', 'processor_to_node', 'processor_to_web')]
+    proc = processor.Processor(queues[0], queues[1], queues[2], detection_mode=MODE_DIFFERENTIAL,
+                               frame_size_X=sizeX, frame_size_Y=sizeY,
+                               image_size_X=image[0], image_size_Y=image[1], window_size=WINDOW_SIZE)
+    background, = scene(sizeX, sizeY, 0, 1)
+    for i in range(WINDOW_SIZE + 1):
+        proc.process({SOURCE_TAG: DEVICE, GE: background})
+    messages = itertools.cycle([{SOURCE_TAG: DEVICE, GE: data} for data in blobs])
+    return bench(lambda: proc.process(next(messages)))
+
+
+def runSuite(grids=GRIDS, image=IMAGE_SIZE):
+    '''
+    :return: the suite results, with the environment they were measured in
+    '''
+    results = {}
+    for sizeX, sizeY in grids:
+        print >> sys.stderr, "benchmarking %dx%d..." % (sizeX, sizeY)
+        results['%dx%d' % (sizeX, sizeY)] = bench_grid(sizeX, sizeY, image)
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'image_size': '%dx%d' % image,
+            'repeat': REPEAT,
+            'number': NUMBER,
+            'unit': 'ms',
+            'results': results}
+
+
+def printResults(suite):
+    grids = sorted(suite['results'], key=lambda grid: [int(size) for size in grid.split('x')])
+    names = sorted(suite['results'][grids[0]])
+    print "%-30s" % "ms per call" + "".join("%12s" % grid for grid in grids)
+    for name in names:
+        print "%-30s" % name + "".join("%12.3f" % suite['results'][grid].get(name, float('nan')) for grid in grids)
+
+
+def compare(baseline, suite, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    '''
+    Print the results slower than the baseline by more than threshold.
+    :return: the list of the regressions, as (grid, name, baseline ms, ms)
+    '''
+    regressions = []
+    for grid, results in sorted(suite['results'].items()):
+        for name, value in sorted(results.items()):
+            base = baseline['results'].get(grid, {}).get(name)
+            if base and value > base * threshold:
+                regressions.append((grid, name, base, value))
+                print "REGRESSION %-8s %-26s %10.3f -> %10.3f ms (%.2fx)" % (grid, name, base, value, value / base)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the hot paths of the image processing.')
+    parser.add_argument('--grids', default=','.join('%dx%d' % grid for grid in GRIDS),
+                        help='comma separated sensor grid sizes (default: %(default)s)')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE, as JSON')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare with the results in BASELINE (JSON), exit with 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='slow-down factor reported as a regression (default: %(default)s)')
+    parser.add_argument('--griddata', action='store_true',
+                        help='only compare expand with the original griddata implementation')
+    args = parser.parse_args()
+    if args.griddata:
+        bench_expand()
+        sys.exit(0)
+    grids = [tuple(int(size) for size in grid.split('x')) for grid in args.grids.split(',')]
+    suite = runSuite(grids)
+    printResults(suite)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(suite, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            if compare(json.load(baselineFile), suite, args.threshold):
+                sys.exit(1)
@@ -0,0 +1,125 @@
+__author__ = 'fabio'
+import ConfigParser
+import fcntl
+import os
+import time
+
+# seconds without changes before the configuration is written
+DEFAULT_WRITE_DELAY = 5.0
+# max seconds a change can wait, while the changes keep coming
+MAX_WRITE_DELAY_FACTOR = 4
+TEMP_SUFFIX = '.tmp'
+LOCK_SUFFIX = '.lock'
+
+
+class ConfigStore(ConfigParser.ConfigParser):
+    '''
+    ConfigParser bound to its file, with write-behind persistence:
+    the changes are applied in memory at once, and written to the
+    file by flushIfDue once no other change came for write_delay
+    seconds (or at most MAX_WRITE_DELAY_FACTOR * write_delay after
+    the first unsaved change), or by flush (e.g. on shutdown).
+    The file is replaced atomically (temp file + rename), so a power
+    cut leaves either the old or the new configuration on disk.
+    When several processes share the file, each one only writes the
+    sections it owns, merged with the current content of the file.
+    '''
+
+    def __init__(self, config_file, write_delay=DEFAULT_WRITE_DELAY, sections=None):
+        '''
+        :param sections: names of the sections written by flush, the others
+                         are kept as they are in the file (None for all)
+        '''
+        ConfigParser.ConfigParser.__init__(self)
+        self.optionxform = str
+        self.config_file = config_file
+        self.write_delay = write_delay
+        self.sections_owned = sections
+        self.firstChange = None  # time of the first unsaved change
+        self.lastChange = None   # time of the last unsaved change
+
+    def set(self, section, option, value=None):
+        if self.has_option(section, option) and self.get(section, option, raw=True) == value:
+            return
+        ConfigParser.ConfigParser.set(self, section, option, value)
+        self.changed()
+
+    def add_section(self, section):
+        ConfigParser.ConfigParser.add_section(self, section)
+        self.changed()
+
+    def changed(self):
+        now = time.time()
+        if self.firstChange is None:
+            self.firstChange = now
+        self.lastChange = now
+
+    def isDirty(self):
+        return self.firstChange is not None
+
+    def flushIfDue(self, now=None):
+        '''
+        Write the configuration if there are unsaved changes old enough.
+        :return: True if the file has been written
+        '''
+        if not self.isDirty():
+            return False
+        now = time.time() if now is None else now
+        if now - self.lastChange < self.write_delay and \
+                now - self.firstChange < self.write_delay * MAX_WRITE_DELAY_FACTOR:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        '''
+        Write the configuration to its file, atomically.
+        '''
+        if self.sections_owned is None:
+            self.replace(self)
+        else:
+            # read, merge and replace the file while holding the lock,
+            # so that the changes of the other processes are not lost
+            with open(self.config_file + LOCK_SUFFIX, 'a') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                self.replace(self.merge())
+        self.firstChange = None
+        self.lastChange = None
+
+    def merge(self):
+        '''
+        :return: the content of the file, with the sections owned
+                 replaced by their current values
+        '''
+        merged = ConfigParser.RawConfigParser()
+        merged.optionxform = str
+        merged.read(self.config_file)
+        for section in self.sections_owned:
+            if not self.has_section(section):
+                continue
+            if merged.has_section(section):
+                # cleared in place, to keep the sections order in the file
+                for option in merged.options(section):
+                    merged.remove_option(section, option)
+            else:
+                merged.add_section(section)
+            for option, value in self.items(section, raw=True):
+                merged.set(section, option, value)
+        return merged
+
+    def replace(self, config):
+        '''
+        Replace the file with the content of config (a ConfigParser).
+        '''
+        tempFile = self.config_file + TEMP_SUFFIX
+        with open(tempFile, 'wb') as configfile:
+            config.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        os.rename(tempFile, self.config_file)
+        # make the rename itself durable
+        directory = os.open(os.path.dirname(os.path.abspath(self.config_file)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
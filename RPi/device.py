@@ -1,6 +1,13 @@
 __author__ = 'fabio'
 import ConfigParser
+import binascii
+import json
+import struct
+import numpy as np
 import serial
+from configstore import ConfigStore
+from serialwriter import SerialWriter, ALARM_COMMAND, COMMAND, STATE_COMMAND
+from sensors import DEFAULT_SENSOR, sectionName, sensorConfig
 import time
 import sys
 
@@ -14,9 +21,21 @@ GRID_SIZE_Y = 8
 PORT_TAG = 'port'
 SPEED_TAG = 'speed'
 RANGE_TAG = 'range'
+PROTOCOL_TAG = 'protocol'
+CONFIG_WRITE_DELAY_TAG = 'config_write_delay'
 PORT_DEFAULT = '/dev/ttyACM0'
+SIMULATOR_PORT = 'sim://'  # port setting selecting the simulated device (simulator.py)
 SPEED_DEFAULT = 115200
 RANGE_DEFAULT = '5m'
+PROTOCOL_JSON = 'json'
+PROTOCOL_BINARY = 'binary'
+PROTOCOL_DEFAULT = PROTOCOL_JSON
+PIXEL_FORMAT_TAG = 'pixel_format'
+PIXEL_FLOAT = 'float'  # frames in C, as floats
+PIXEL_INT16 = 'int16'  # frames kept in the sensor fixed point format (1/256 C)
+PIXEL_FORMAT_DEFAULT = PIXEL_FLOAT
+PIXEL_DTYPES = {PIXEL_FLOAT: np.float32, PIXEL_INT16: np.int16}
+TEMPERATURE_SCALE = 256  # sensor units per C
 
 ID_TAG = 'id'
 TYPE_TAG = 'type'
@@ -33,64 +52,116 @@ START_MARKER = '{'
 END_MARKER = '}'
 NON_LATCHING_RELAY = "NLR"
 LATCHING_RELAY = "LR"
+BINARY = "BIN"
+DEVICE_ID_TAG = "ID"
+DEVICE_TYPE_TAG = "TYPE"
+SEQUENCE_TAG = "SEQ"
+
+# Binary frame (all fields little-endian), sent by the firmware
+# once enabled with the {'BIN':1} command:
+#   magic (2 bytes) | device id (uint8) | device type (uint8) |
+#   sequence number (uint16) | 64 pixels (int16, 1/256 C) |
+#   NLR (uint8) | LR (uint8) | CRC-16/CCITT (uint16)
+# The CRC (poly 0x1021, init 0xFFFF) covers the id to LR bytes.
+BINARY_MAGIC = '\xaa\x55'
+BINARY_HEADER = struct.Struct('<BBH')
+BINARY_TRAILER = struct.Struct('<BBH')
+BINARY_PIXELS_OFFSET = len(BINARY_MAGIC) + BINARY_HEADER.size
+BINARY_FRAME_SIZE = BINARY_PIXELS_OFFSET + GRID_SIZE_X * GRID_SIZE_Y * 2 + BINARY_TRAILER.size
+
+# max length of an incomplete frame kept between two reads
+READ_BUFFER_MAXSIZE = 4096
+
+def getPixelFormat(config, section=DEVICE_SECTION):
+    '''
+    :param config: a ConfigParser instance
+    :param section: the device section
+    :return: the format of the frame pixels of the device, PIXEL_FLOAT or PIXEL_INT16
+    '''
+    if config.has_option(section, PIXEL_FORMAT_TAG):
+        return config.get(section, PIXEL_FORMAT_TAG)
+    return PIXEL_FORMAT_DEFAULT
 
-startFound = False
-endFound = False
-buffer = ''
 
 class Device(object):
-    def __init__(self,config_file=None, debug_queue=None):
+    def __init__(self,config_file=None, debug_queue=None, sensor=DEFAULT_SENSOR):
+        '''
+        :param sensor: the sensor id, naming the [Device:<sensor>] section of the
+                       device and the sections of its relays (see sensors.py)
+        '''
         self.debug_queue=debug_queue
-        self.config = ConfigParser.ConfigParser()
-        self.config.optionxform = str
         self.config_file = CONFIG_FILE_DEFAULT if config_file == None else config_file
+        self.sensor = sensor
+        self.device_section = sectionName(DEVICE_SECTION, sensor)
+        self.nlr_section = sectionName(NLR_SECTION, sensor)
+        self.lr_section = sectionName(LR_SECTION, sensor)
+        # relay and sensor changes are saved in background (see saveConfig),
+        # only in the sections of this device: the other devices save theirs
+        self.config = ConfigStore(self.config_file,
+                                  sections=(self.device_section, self.nlr_section, self.lr_section))
         self.config.read(self.config_file)
-        if not self.config.has_section(DEVICE_SECTION):
-            self.config.add_section(DEVICE_SECTION)
-            self.config.set(DEVICE_SECTION,ID_TAG,str(DEVICE_ID)) # set in the firmware code
-            self.config.set(DEVICE_SECTION,TYPE_TAG,str(DEVICE_TYPE))
-            self.config.set(DEVICE_SECTION,GE,STATUS_ON)
-            self.config.set(DEVICE_SECTION, RANGE_TAG, RANGE_DEFAULT)
-            self.config.set(DEVICE_SECTION, PORT_TAG, PORT_DEFAULT)
-            self.config.set(DEVICE_SECTION, SPEED_TAG, SPEED_DEFAULT)
-        if not self.config.has_section(NLR_SECTION):
-            self.config.add_section(NLR_SECTION)
+        if self.config.has_option(self.device_section, CONFIG_WRITE_DELAY_TAG):
+            self.config.write_delay = self.config.getfloat(self.device_section, CONFIG_WRITE_DELAY_TAG)
+        if not self.config.has_section(self.device_section):
+            self.config.add_section(self.device_section)
+            self.config.set(self.device_section,ID_TAG,str(DEVICE_ID)) # set in the firmware code
+            self.config.set(self.device_section,TYPE_TAG,str(DEVICE_TYPE))
+            self.config.set(self.device_section,GE,STATUS_ON)
+            self.config.set(self.device_section, RANGE_TAG, RANGE_DEFAULT)
+            self.config.set(self.device_section, PORT_TAG, PORT_DEFAULT)
+            self.config.set(self.device_section, SPEED_TAG, SPEED_DEFAULT)
+            self.config.set(self.device_section, PROTOCOL_TAG, PROTOCOL_DEFAULT)
+        if not self.config.has_section(self.nlr_section):
+            self.config.add_section(self.nlr_section)
         self.nlr=0
         for i in range(1, 9):
-            if not self.config.has_option(NLR_SECTION,RELAY + SEP_TAG + str(i)):
-                self.config.set(NLR_SECTION, RELAY + SEP_TAG +str(i), STATUS_OFF)
+            if not self.config.has_option(self.nlr_section,RELAY + SEP_TAG + str(i)):
+                self.config.set(self.nlr_section, RELAY + SEP_TAG +str(i), STATUS_OFF)
             else:
-                if self.config.get(NLR_SECTION, RELAY + SEP_TAG + str(i)) == STATUS_ON:
+                if self.config.get(self.nlr_section, RELAY + SEP_TAG + str(i)) == STATUS_ON:
                     self.nlr += pow(2,i-1)
-        if not self.config.has_section(LR_SECTION):
-            self.config.add_section(LR_SECTION)
+        if not self.config.has_section(self.lr_section):
+            self.config.add_section(self.lr_section)
         self.lr=0
         for i in range(1, 4):
-            if not self.config.has_option(LR_SECTION, RELAY + SEP_TAG + str(i)):
-                self.config.set(LR_SECTION, RELAY + SEP_TAG + str(i), STATUS_OFF)
+            if not self.config.has_option(self.lr_section, RELAY + SEP_TAG + str(i)):
+                self.config.set(self.lr_section, RELAY + SEP_TAG + str(i), STATUS_OFF)
             else:
-                if self.config.get(LR_SECTION, RELAY + SEP_TAG + str(i)) == STATUS_ON:
+                if self.config.get(self.lr_section, RELAY + SEP_TAG + str(i)) == STATUS_ON:
                     self.lr += pow(2, i-1)
-        with open(self.config_file, 'wb') as configfile:
-            self.config.write(configfile)
-        self.sp = serial.Serial(self.config.get(DEVICE_SECTION,PORT_TAG), self.config.get(DEVICE_SECTION,SPEED_TAG), timeout=1)
-        time.sleep(2)  # give time to the serial interface to settle
+        # write the defaults added above, if any
+        self.saveConfig(force=True)
+        self.readBuffer = ''  # incomplete frame left over by the last read
+        self.pixelFormat = getPixelFormat(self.config, self.device_section)
+        port = self.config.get(self.device_section,PORT_TAG)
+        if port.startswith(SIMULATOR_PORT):
+            # simulated device, see the [Simulator] section
+            import simulator
+            self.sp = simulator.createSimulator(sensorConfig(self.config, sensor), debug_queue)
+        else:
+            self.sp = serial.Serial(port, self.config.get(self.device_section,SPEED_TAG), timeout=1)
+            time.sleep(2)  # give time to the serial interface to settle
         self.sp.flushInput()
+        # the commands are written by this thread, once started (startWriter)
+        self.writer = SerialWriter(self.sp, self.encodeCommand, debug_queue=debug_queue)
         self.writeData()
+        # negotiate the frame format: a firmware without binary
+        # frames support ignores the command and keeps sending JSON
+        self.writeData({BINARY: 1 if self.getProtocol() == PROTOCOL_BINARY else 0})
 
     def getNonLatchingRelayStatus(self,relay):
         ''' returns 1 if set, 0 if reset'''
         status = 0
         #relay_str = str((relay-1)%8 if relay > 0 else 0)
-        if self.config.has_option(NLR_SECTION,RELAY+SEP_TAG+str(relay)):
-            status = 1 if self.config.get(NLR_SECTION,RELAY+SEP_TAG+str(relay))==STATUS_ON else 0
+        if self.config.has_option(self.nlr_section,RELAY+SEP_TAG+str(relay)):
+            status = 1 if self.config.get(self.nlr_section,RELAY+SEP_TAG+str(relay))==STATUS_ON else 0
         return status
 
     def getLatchingRelayStatus(self,relay):
         ''' returns 1 if set, 0 if reset'''
         status = 0
-        if self.config.has_option(LR_SECTION,RELAY+SEP_TAG+str(relay)):
-            status = 1 if self.config.get(LR_SECTION,RELAY+SEP_TAG+str(relay))==STATUS_ON else 0
+        if self.config.has_option(self.lr_section,RELAY+SEP_TAG+str(relay)):
+            status = 1 if self.config.get(self.lr_section,RELAY+SEP_TAG+str(relay))==STATUS_ON else 0
         return status
 
     def setNonLatchingRelayStatus(self,relay,value):
@@ -101,10 +172,7 @@ class Device(object):
             else:
                 self.nlr = self.nlr ^ pow(2, relay - 1)
                 status = STATUS_OFF
-            self.config.set(NLR_SECTION,RELAY+SEP_TAG+str(relay),status)
-
-            with open(self.config_file, 'wb') as configfile:
-                self.config.write(configfile)
+            self.config.set(self.nlr_section,RELAY+SEP_TAG+str(relay),status)
 
     def setLatchingRelayStatus(self,relay,value):
         if relay > 0 and relay < 4:
@@ -114,9 +182,7 @@ class Device(object):
             else:
                 self.lr = self.lr ^ pow(2, relay - 1)
                 status = STATUS_OFF
-            self.config.set(LR_SECTION,RELAY+SEP_TAG+str(relay),status)
-            with open(self.config_file, 'wb') as configfile:
-                self.config.write(configfile)
+            self.config.set(self.lr_section,RELAY+SEP_TAG+str(relay),status)
 
     def setNonLatchingRelays(self,status):
         '''
@@ -146,8 +212,8 @@ class Device(object):
 
     def getSensorStatus(self):
         status = 0
-        if self.config.has_option(DEVICE_SECTION,GE):
-            status = 1 if self.config.get(DEVICE_SECTION,GE) == STATUS_ON else 0
+        if self.config.has_option(self.device_section,GE):
+            status = 1 if self.config.get(self.device_section,GE) == STATUS_ON else 0
         return status
 
     def setSensorStatus(self,enabled):
@@ -155,9 +221,29 @@ class Device(object):
         :param enabled: 0 to disable, 1 to enable
         :return: None
         '''
-        self.config.set(DEVICE_SECTION,GE,STATUS_ON if enabled==1 else STATUS_OFF)
-        with open(self.config_file, 'wb') as configfile:
-            self.config.write(configfile)
+        self.config.set(self.device_section,GE,STATUS_ON if enabled==1 else STATUS_OFF)
+
+    def saveConfig(self, force=False):
+        '''
+        Write the pending configuration changes (relays and sensor
+        status) to the file, once they have settled.
+        :param force: True to write them now (e.g. on shutdown)
+        :return: None
+        '''
+        if force:
+            if self.config.isDirty():
+                self.config.flush()
+        else:
+            self.config.flushIfDue()
+
+    def getPixelFormat(self):
+        return self.pixelFormat
+
+    def getProtocol(self):
+        protocol = PROTOCOL_DEFAULT
+        if self.config.has_option(self.device_section,PROTOCOL_TAG):
+            protocol = self.config.get(self.device_section,PROTOCOL_TAG)
+        return protocol
 
     def getNonLatchingRelays(self):
         return self.nlr
@@ -171,59 +257,141 @@ class Device(object):
     def encode(self):
         return (u"{'NLR':%d,'LR':%d,'GE':%r}" % (self.nlr,self.lr,self.getSensorStatus())).encode()
 
-    def writeData(self,data=None):
-        if data == None:
-            dataStr = self.encode()
-        elif all(x in data for x in (NON_LATCHING_RELAY,LATCHING_RELAY)):
-            dataStr = (u"{'NLR':%d,'LR':%d}" % data[NON_LATCHING_RELAY],data[LATCHING_RELAY]).encode()
-        elif NON_LATCHING_RELAY in data:
-            dataStr = (u"{'NLR':%d}" % data[NON_LATCHING_RELAY]).encode()
-        elif LATCHING_RELAY in data:
-            dataStr = (u"{'LR':%d}" % data[LATCHING_RELAY]).encode()
-        else:
-            dataStr = self.encode()
+    def getState(self):
+        '''
+        :return: the relays and sensor state, as a command
+        '''
+        return {NON_LATCHING_RELAY: self.nlr, LATCHING_RELAY: self.lr, GE: self.getSensorStatus()}
+
+    def encodeCommand(self, data):
+        '''
+        :param data: command, with any of the NLR, LR, GE and BIN fields
+        :return: the command string for the firmware
+        '''
+        fields = []
+        for tag in (NON_LATCHING_RELAY, LATCHING_RELAY, GE, BINARY):
+            if tag in data:
+                fields.append(u"'%s':%d" % (tag, data[tag]))
+        return (u"{%s}" % u",".join(fields)).encode()
 
-        self.sp.write(dataStr)
-        time.sleep(0.1)
+    def startWriter(self):
+        '''
+        Start the thread writing the commands, in the process using the device.
+        '''
+        self.writer.start()
 
-        if self.debug_queue:
-            self.debug_queue.put("DEVICE: Sent to Serial Port: %s" % (self.encode()))
+    def writeData(self,data=None,alarm=False,since=None):
+        '''
+        Queue a command for the device, written by the writer thread.
+        :param data: the relays to set (NLR and/or LR) or the frame format (BIN).
+                     None to send the whole relays and sensor state: the
+                     state commands not written yet are replaced by the newest
+        :param alarm: True for the alarm commands, written before the others
+        :param since: time of the alarm detection (metrics.now()), if known
+        :return: None
+        '''
+        if alarm and data:
+            self.writer.send(data, ALARM_COMMAND, since)
+        elif data and any(tag in data for tag in (NON_LATCHING_RELAY, LATCHING_RELAY, BINARY)):
+            self.writer.send(data, COMMAND)
+        else:
+            self.writer.send(self.getState(), STATE_COMMAND)
 
     def convertToTemperature(self, width, height, dataIn):
-        dataOut = [None] * width * height
-        for idx1 in range(0, width * height):
-            dataOut[idx1] = float(dataIn[idx1]) / 256
-        return dataOut
-
-    def readData(self):
-        global endFound, startFound, buffer, write, writeFinal
+        '''
+        :param dataIn: the pixels, in sensor units (1/256 C)
+        :return: the pixels in C (list), or as an int16 array in sensor
+                 units with the PIXEL_INT16 format
+        '''
+        if self.pixelFormat == PIXEL_INT16:
+            return np.asarray(dataIn, dtype=np.int16)
+        return (np.asarray(dataIn, dtype=float) / TEMPERATURE_SCALE).tolist()
 
-        while self.sp.inWaiting() > 0 and not endFound:
-            ch = self.sp.read()
-            if (ch == START_MARKER):
-                startFound = True
+    def splitFrames(self):
+        '''
+        Extract all the complete frames from the read buffer, either
+        JSON ({...}) or binary (BINARY_MAGIC...) frames.
+        Anything preceding a frame start is discarded, while an
+        incomplete frame is kept in the buffer for the next read.
+        :return: list of the frames found (strings, markers included)
+        '''
+        frames = []
+        buffer = self.readBuffer
+        while True:
+            start = buffer.find(START_MARKER)
+            magic = buffer.find(BINARY_MAGIC)
+            if magic >= 0 and (start < 0 or magic < start):
+                if len(buffer) - magic < BINARY_FRAME_SIZE:
+                    buffer = buffer[magic:]
+                    break
+                frame = buffer[magic:magic + BINARY_FRAME_SIZE]
+                if self.checkBinaryFrame(frame):
+                    frames.append(frame)
+                    buffer = buffer[magic + BINARY_FRAME_SIZE:]
+                else:
+                    # false or corrupted start: resync on the next byte
+                    buffer = buffer[magic + 1:]
+                continue
+            if start < 0:
                 buffer = ''
+                break
+            end = buffer.find(END_MARKER, start)
+            if end < 0:
+                buffer = buffer[start:]
+                break
+            # a new start marker restarts the frame, as in the firmware
+            start = buffer.rfind(START_MARKER, start, end)
+            frames.append(buffer[start:end + 1])
+            buffer = buffer[end + 1:]
+        if len(buffer) > READ_BUFFER_MAXSIZE:
+            # no end of frame in sight: discard the input
+            buffer = ''
+        self.readBuffer = buffer
+        return frames
+
+    def checkBinaryFrame(self, frame):
+        (crc,) = struct.unpack_from('<H', frame, BINARY_FRAME_SIZE - 2)
+        return binascii.crc_hqx(frame[len(BINARY_MAGIC):-2], 0xFFFF) == crc
+
+    def decodeBinaryFrame(self, frame):
+        '''
+        :param frame: a binary frame, with a valid CRC
+        :return: the reading, with the same keys as the JSON frames
+        '''
+        (deviceId, deviceType, sequence) = BINARY_HEADER.unpack_from(frame, len(BINARY_MAGIC))
+        (nlr, lr, crc) = BINARY_TRAILER.unpack_from(frame, BINARY_FRAME_SIZE - BINARY_TRAILER.size)
+        pixels = np.frombuffer(frame, dtype='<i2', count=GRID_SIZE_X * GRID_SIZE_Y,
+                               offset=BINARY_PIXELS_OFFSET)
+        if self.pixelFormat == PIXEL_INT16:
+            pixels = pixels.astype(np.int16)
+        else:
+            pixels = (pixels / float(TEMPERATURE_SCALE)).tolist()
+        return {DEVICE_ID_TAG: deviceId, DEVICE_TYPE_TAG: deviceType, SEQUENCE_TAG: sequence,
+                GE: pixels, NON_LATCHING_RELAY: nlr, LATCHING_RELAY: lr}
 
-            if ((startFound) and (not endFound)):
-                buffer += ch
-
-            if (ch == END_MARKER):
-                if (startFound):
-                    endFound = True
-                    startFound = False
-                    try:
-                        import json
-                        reading = json.loads(buffer)
-                        if GE in reading:
-                            reading[GE] = self.convertToTemperature(GRID_SIZE_X,GRID_SIZE_Y,reading[GE])
-                        data = json.dumps(reading)
-                        return data
-                    except ValueError as e:
-                        print "Unexpected error:", sys.exc_info()[0]
-                        print e
-        if (endFound):
-            endFound = False
-        return None
+    def readData(self):
+        '''
+        Read all the data available on the serial port in one go,
+        and decode every complete frame received.
+        :return: list of the readings (dictionaries), possibly empty
+        '''
+        waiting = self.sp.inWaiting()
+        if waiting > 0:
+            self.readBuffer += self.sp.read(waiting)
+        readings = []
+        for frame in self.splitFrames():
+            if frame.startswith(BINARY_MAGIC):
+                readings.append(self.decodeBinaryFrame(frame))
+                continue
+            try:
+                reading = json.loads(frame)
+                if GE in reading:
+                    reading[GE] = self.convertToTemperature(GRID_SIZE_X,GRID_SIZE_Y,reading[GE])
+                readings.append(reading)
+            except ValueError as e:
+                print "Unexpected error:", sys.exc_info()[0]
+                print e
+        return readings
 
 if __name__ == '__main__':
     # import datetime
@@ -0,0 +1,63 @@
+__author__ = 'fabio'
+import multiprocessing
+import numpy as np
+
+RING_SLOT_TAG = "RING_SLOT"
+RING_SEQ_TAG = "RING_SEQ"
+
+DEFAULT_RING_SLOTS = 16
+
+SLOT_EMPTY = 0
+SLOT_WRITING = -1
+
+
+class FrameRing(object):
+    '''
+    Fixed-slot ring of frames in shared memory, written by the Node and
+    read by the Processor. Only the slot index and the frame sequence
+    number travel on the queue, the pixels are read in place.
+    The ring must be created before the processes are started, so that
+    they all inherit the same shared memory.
+    Each slot stores the sequence number of the frame it holds, and
+    SLOT_WRITING while it is being written: a reader checks it before
+    and after using the pixels, to detect a frame overwritten by the
+    writer in the meantime (the reader lagging more than 'slots' frames).
+    '''
+
+    def __init__(self, sizeX, sizeY, slots=DEFAULT_RING_SLOTS, dtype=np.float32):
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.slots = slots
+        self.dtype = np.dtype(dtype)
+        self.sequence = 0  # last sequence number written (writer side only)
+        frameBytes = sizeX * sizeY * self.dtype.itemsize
+        self.sharedPixels = multiprocessing.RawArray('c', slots * frameBytes)
+        self.sharedSequences = multiprocessing.RawArray('l', slots)
+        self.pixels = np.frombuffer(self.sharedPixels, dtype=self.dtype).reshape((slots, sizeX, sizeY))
+        self.sequences = np.ctypeslib.as_array(self.sharedSequences)
+
+    def write(self, data):
+        '''
+        Write a frame in the next slot of the ring.
+        :param data: sizeX*sizeY 1-D array of values, or a (sizeX,sizeY) 2-D array
+        :return: (slot, sequence) identifying the frame
+        '''
+        self.sequence += 1
+        slot = self.sequence % self.slots
+        self.sequences[slot] = SLOT_WRITING
+        self.pixels[slot] = np.reshape(data, (self.sizeX, self.sizeY))
+        self.sequences[slot] = self.sequence
+        return slot, self.sequence
+
+    def read(self, slot, sequence):
+        '''
+        :return: a (sizeX,sizeY) view on the frame pixels (not a copy),
+                 or None if the frame has already been overwritten.
+                 The view must be copied before checking isValid again.
+        '''
+        if not self.isValid(slot, sequence):
+            return None
+        return self.pixels[slot]
+
+    def isValid(self, slot, sequence):
+        return self.sequences[slot] == sequence
@@ -0,0 +1,216 @@
+__author__ = 'fabio'
+import bisect
+import ctypes
+import ctypes.util
+import multiprocessing
+
+# monotonic timestamps (s) carried by each frame, by stage: the time
+# spent in a stage is the time since the previous stage of the frame
+TIMESTAMPS_TAG = "TS"
+STAGE_READ = 'read'                    # serial data read by the node
+STAGE_DISPATCH = 'dispatch'            # frame decoded and queued by the node
+STAGE_DEQUEUE = 'dequeue'              # frame taken by the processor
+STAGE_PROCESS_FRAME = 'processFrame'   # background or detection phase
+STAGE_STATS = 'stats'                  # frame statistics and grids
+STAGE_EXPAND = 'expand'                # thermal image interpolation
+STAGE_FILTER_NOISE = 'filterNoise'     # thermal image noise filter
+STAGE_RECEIVE = 'receive'              # processed frame taken by the web server
+STAGE_SERIALIZATION = 'serialization'  # frame encoded for all the clients
+STAGE_SEND = 'send'                    # frame sent to a client
+STAGES = (STAGE_READ, STAGE_DISPATCH, STAGE_DEQUEUE, STAGE_PROCESS_FRAME, STAGE_STATS, STAGE_EXPAND,
+          STAGE_FILTER_NOISE, STAGE_RECEIVE, STAGE_SERIALIZATION, STAGE_SEND)
+STAGE_DETECT = 'detect'                # alarm raised by the processor
+
+# histogram buckets (upper bounds, in seconds)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+METRICS_PREFIX = 'grideye_'
+
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or ctypes.util.find_library('rt'), use_errno=True)
+_clock_gettime = _libc.clock_gettime
+_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+
+def monotonicNs():
+    '''
+    :return: the monotonic clock, in nanoseconds (not affected by the
+             system clock changes, e.g. NTP updates)
+    '''
+    ts = timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+    return ts.tv_sec * 1000000000 + ts.tv_nsec
+
+
+def now():
+    '''
+    :return: the monotonic clock (s), comparable between the processes
+    '''
+    return monotonicNs() / 1e9
+
+
+def stamp(message, stage):
+    '''
+    Add the current time of a stage to the timestamps of a message.
+    '''
+    message.setdefault(TIMESTAMPS_TAG, {})[stage] = now()
+
+
+class Histogram(object):
+    '''
+    Histogram of observed values, in shared memory so that it can be
+    updated by any process forked after its creation.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # count per bucket (the last one is +Inf), then sum and count
+        self.values = multiprocessing.Array('d', len(buckets) + 3)
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.values.get_lock():
+            self.values[bucket] += 1
+            self.values[-2] += value
+            self.values[-1] += 1
+
+    def snapshot(self):
+        '''
+        :return: (cumulative counts per bucket, +Inf included, sum, count)
+        '''
+        with self.values.get_lock():
+            values = self.values[:]
+        cumulative = []
+        total = 0
+        for count in values[:-2]:
+            total += count
+            cumulative.append(total)
+        return cumulative, values[-2], values[-1]
+
+
+class Counter(object):
+    '''
+    Counter in shared memory, formatted as a Prometheus counter.
+    '''
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = multiprocessing.Value('l', 0)
+
+    def increment(self, count=1):
+        with self.value.get_lock():
+            self.value.value += count
+
+    def format(self):
+        return ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name,
+                '%s %d' % (self.name, self.value.value)]
+
+
+class HistogramFamily(object):
+    '''
+    Histograms of one metric, by value of a label.
+    '''
+
+    def __init__(self, name, help, label, values=(), buckets=LATENCY_BUCKETS):
+        '''
+        :param values: label values whose histogram must be shared with the
+                       processes forked later (the others are created on use)
+        '''
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.histograms = dict((value, Histogram(buckets)) for value in values)
+
+    def observe(self, value, seconds):
+        if value not in self.histograms:
+            self.histograms[value] = Histogram(self.buckets)
+        self.histograms[value].observe(seconds)
+
+    def format(self):
+        '''
+        :return: the Prometheus text format lines of the histograms
+        '''
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        for value, histogram in sorted(self.histograms.items()):
+            cumulative, total, count = histogram.snapshot()
+            labels = '%s="%s"' % (self.label, value)
+            for bound, bucketCount in zip(self.buckets + ('+Inf',), cumulative):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, labels, bound, bucketCount))
+            lines.append('%s_sum{%s} %.9f' % (self.name, labels, total))
+            lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return lines
+
+
+STAGE_SECONDS = HistogramFamily(METRICS_PREFIX + 'stage_seconds',
+                                'Time spent by the frames in each stage of the pipeline', 'stage')
+FRAME_SECONDS = HistogramFamily(METRICS_PREFIX + 'frame_latency_seconds',
+                                'Time from the serial read of a frame to a stage', 'stage')
+# updated by the node process
+ALARM_SECONDS = HistogramFamily(METRICS_PREFIX + 'alarm_latency_seconds',
+                                'Time from an alarm detection to the relay command written', 'command',
+                                values=('alarm',))
+CLIENT_FRAMES_DROPPED = Counter(METRICS_PREFIX + 'client_frames_dropped_total',
+                                'Frames replaced by a newer one while waiting to be sent to a client')
+
+
+def observeFrame(timestamps):
+    '''
+    Add the stages of a frame to the histograms.
+    :param timestamps: the frame timestamps, by stage
+    '''
+    previous = None
+    last = None
+    for stage in STAGES:
+        if stage in timestamps:
+            if previous is not None:
+                STAGE_SECONDS.observe(stage, timestamps[stage] - previous)
+            previous = timestamps[stage]
+            last = stage
+    if STAGE_READ in timestamps and last != STAGE_READ:
+        FRAME_SECONDS.observe(last, previous - timestamps[STAGE_READ])
+
+
+def observeSend(timestamps):
+    '''
+    Add the sending of a frame to a client to the histograms.
+    :param timestamps: the frame timestamps, by stage (up to STAGE_SERIALIZATION)
+    '''
+    sent = now()
+    if STAGE_SERIALIZATION in timestamps:
+        STAGE_SECONDS.observe(STAGE_SEND, sent - timestamps[STAGE_SERIALIZATION])
+    if STAGE_READ in timestamps:
+        FRAME_SECONDS.observe(STAGE_SEND, sent - timestamps[STAGE_READ])
+
+
+def formatQueues(queues):
+    '''
+    :param queues: the pipeline.StageQueue instances
+    :return: the Prometheus text format lines of the queue counters
+    '''
+    lines = []
+    for metric, key, kind, help in (('queue_messages_total', 'sent', 'counter', 'Messages put in the queue'),
+                                    ('queue_dropped_total', 'dropped', 'counter', 'Frames dropped by the queue'),
+                                    ('queue_depth', 'queued', 'gauge', 'Messages waiting in the queue')):
+        lines.append('# HELP %s%s %s' % (METRICS_PREFIX, metric, help))
+        lines.append('# TYPE %s%s %s' % (METRICS_PREFIX, metric, kind))
+        for queue in queues:
+            lines.append('%s%s{queue="%s"} %d' % (METRICS_PREFIX, metric, queue.name, queue.getStats()[key]))
+    return lines
+
+
+def format(queues):
+    '''
+    :return: all the metrics, in the Prometheus text format
+    '''
+    lines = formatQueues(queues)
+    for metric in (CLIENT_FRAMES_DROPPED, STAGE_SECONDS, FRAME_SECONDS, ALARM_SECONDS):
+        lines.extend(metric.format())
+    return '\n'.join(lines) + '\n'
@@ -2,7 +2,15 @@ __author__ = 'fabio'
 import json
 import multiprocessing
 import datetime
+import select
+import signal
+import numpy as np
 from device import *
+from framering import RING_SLOT_TAG, RING_SEQ_TAG
+from recorder import wallNs
+from sensors import SENSOR_TAG, DEFAULT_SENSOR
+import metrics
+from metrics import monotonicNs
 
 TIMESTAMP_TAG="TIME" #mandatory
 SOURCE_TAG="SRC"
@@ -16,18 +24,65 @@ BACKGROUND="BACKGROUND"
 RESET="RESET"
 SET="SET"
 
+# max time (s) the node waits for input before polling again
+SELECT_TIMEOUT = 1.0
+
 class Node(multiprocessing.Process, Device):
     def __init__(self, web_to_node_queue, processor_to_node_queue, node_to_processor_queue,
-                 config_file, debug_queue=None):
+                 config_file, debug_queue=None, frame_ring=None, recorder_queue=None, sensor=DEFAULT_SENSOR):
+        '''
+        :param frame_ring: optional FrameRing shared with the Processor. If set, the
+                           sensor pixels are written in the ring and only the slot
+                           reference is sent on node_to_processor_queue
+        :param recorder_queue: optional queue of the Recorder, receiving a copy of the
+                               sensor frames with their time and relays status
+        :param sensor: the sensor id of the device, tagging the messages to the
+                       Processor (node_to_processor_queue may be shared by several nodes)
+        '''
         multiprocessing.Process.__init__(self)
-        Device.__init__(self,config_file, debug_queue)
+        Device.__init__(self,config_file, debug_queue, sensor)
         self.web_to_node_queue = web_to_node_queue
         self.processor_to_node_queue = processor_to_node_queue
         self.node_to_processor_queue = node_to_processor_queue
+        self.frame_ring = frame_ring
+        self.recorder_queue = recorder_queue
 
     def run(self):
-        #self.device = RoadTestDevice(self.configFile, self.debug_queue)
+        '''
+        Run the loop, saving the pending configuration changes on exit.
+        :return:
+        '''
+        readers = [self.sp, self.processor_to_node_queue._reader, self.web_to_node_queue._reader]
+        # terminate() sends SIGTERM: exit through the finally clause,
+        # so that the pending configuration changes are saved
+        signal.signal(signal.SIGTERM, self.onTerminate)
+        self.startWriter()
+        try:
+            self.loop(readers)
+        finally:
+            self.saveConfig(force=True)
+            # the consumers may be terminated already, with the pipes of
+            # their queues full: exit without flushing the messages left
+            for queue in (self.node_to_processor_queue, self.recorder_queue, self.debug_queue):
+                if queue is not None:
+                    queue.cancel_join_thread()
+
+    def onTerminate(self, signum, frame):
+        raise SystemExit(0)
+
+    def loop(self, readers):
+        '''
+        Block until the serial port or one of the input queues has
+        data to read, then dispatch it. The queues are waited on
+        through the file descriptor of their underlying pipe.
+        :param readers: the serial port and the input queues pipes
+        :return:
+        '''
         while True:
+            select.select(readers, [], [], SELECT_TIMEOUT)
+            readTime = metrics.now()
+            # write the relay and sensor settings, once they settled
+            self.saveConfig()
             # look for incoming processor request (alarm trigger)
             while not self.processor_to_node_queue.empty():
                 data = json.loads(self.processor_to_node_queue.get())
@@ -36,15 +91,17 @@ class Node(multiprocessing.Process, Device):
                     alarmData[NON_LATCHING_RELAY] = data[NON_LATCHING_RELAY]
                 if LATCHING_RELAY in data:
                     alarmData[LATCHING_RELAY] = data[LATCHING_RELAY]
-                # send it to the serial device
-                self.writeData(alarmData)
+                # send it to the serial device, before any other command
+                detectTime = data.get(metrics.TIMESTAMPS_TAG, {}).get(metrics.STAGE_DETECT)
+                self.writeData(alarmData, alarm=True, since=detectTime)
 
             # look for incoming tornado request
-            if not self.web_to_node_queue.empty():
+            while not self.web_to_node_queue.empty():
                 data = self.web_to_node_queue.get()
                 if self.debug_queue:
                     self.debug_queue.put(str("NODE: recv web msg - "+data))
                 data = json.loads(data)
+                data[SENSOR_TAG]=self.sensor
                 if SOURCE_TAG in data:
                     if data[SOURCE_TAG]==WEB and COMMAND_TAG in data:
                         if data[COMMAND_TAG]==UPDATE_UI:
@@ -72,21 +129,32 @@ class Node(multiprocessing.Process, Device):
                     del data[GE]
                 self.writeData()
 
-                if bool(data):
-                    # send data for processing (alarm mask)
+                if len(data) > 1:
+                    # send data for processing (alarm mask), if anything
+                    # is left besides the sensor id
                     data[SOURCE_TAG]=WEB
                     self.node_to_processor_queue.put(json.dumps(data))
 
             # look for incoming serial data
-            data = self.readData()
-            # send data to processor
-            if (data != None):
-                data = json.loads(data)
+            for data in self.readData():
+                # send data to processor
                 data[TIMESTAMP_TAG]=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 data[NON_LATCHING_RELAY]=self.getNonLatchingRelays()
                 data[LATCHING_RELAY]=self.getLatchingRelays()
                 data[SOURCE_TAG]=DEVICE
+                data[SENSOR_TAG]=self.sensor
+                if self.recorder_queue is not None and len(data.get(GE, [])) > 0:
+                    self.recorder_queue.put((monotonicNs(), wallNs(), data[NON_LATCHING_RELAY],
+                                             data[LATCHING_RELAY], data[GE]), droppable=True)
+                if self.frame_ring is not None and len(data.get(GE, [])) > 0:
+                    data[RING_SLOT_TAG], data[RING_SEQ_TAG] = self.frame_ring.write(data[GE])
+                    del data[GE]
+                elif isinstance(data.get(GE), np.ndarray):
+                    # fixed point pixels (PIXEL_INT16), sent as integers
+                    data[GE] = data[GE].tolist()
+                data[metrics.TIMESTAMPS_TAG] = {metrics.STAGE_READ: readTime}
+                metrics.stamp(data, metrics.STAGE_DISPATCH)
                 message = json.dumps(data)
-                self.node_to_processor_queue.put(message)
+                self.node_to_processor_queue.put(message, droppable=True, stream=self.sensor)
                 if self.debug_queue:
                     self.debug_queue.put("NODE: send msg to processor - %s" % message)
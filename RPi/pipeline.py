@@ -0,0 +1,231 @@
+__author__ = 'fabio'
+import multiprocessing
+import Queue
+
+PIPELINE_SECTION = 'Pipeline'
+MAXSIZE_OPT = '_maxsize'  # option name: <stage name>_maxsize
+POLICY_OPT = '_policy'    # option name: <stage name>_policy
+
+# drop policies for the droppable messages (sensor frames).
+# Control messages (alarm, relays, mask settings...) are never dropped.
+DROP_NONE = 'none'      # never drop anything, the queue is unbounded
+DROP_NEWEST = 'newest'  # drop the incoming frames while the queue is full
+                        # (maxsize frames of their stream already queued)
+DROP_OLDEST = 'oldest'  # the incoming frames supersede the older ones, beyond
+                        # maxsize frames of their stream, and the consumer only
+                        # keeps the newest of the frames queued when it drains
+                        # the queue (the newest of each stream, e.g. of each sensor)
+
+DEFAULT_MAXSIZE = 10
+DEFAULT_POLICY = DROP_OLDEST
+# DROP_OLDEST: max frames of a stream in the queue, the superseded ones
+# included (they are only removed by the consumer), in maxsize units.
+# The incoming frames are dropped beyond it, while the consumer stalls
+OLDEST_LIMIT_FACTOR = 2
+
+# indexes of the stage counters
+QUEUED = 0         # messages currently in the queue
+QUEUED_FRAMES = 1  # droppable messages currently in the queue
+DROPPED = 2        # droppable messages dropped so far
+SENT = 3           # messages put in the queue so far
+COUNTERS = 4
+
+
+class StageQueue(object):
+    '''
+    Queue between two stages of the pipeline, with a drop policy for the
+    droppable messages (sensor frames). With DROP_NEWEST at most maxsize
+    frames of each stream are queued. With DROP_OLDEST the frames of a
+    stream are numbered when put, and only its newest maxsize ones are
+    live: a multiprocessing.Queue cannot remove the older ones, they are
+    superseded and dropped when the consumer gets them.
+    It wraps a multiprocessing.Queue, whose pipe (_reader) can still be
+    waited on with select. The counters are shared between the processes.
+    The streams (e.g. the sensor ids) are known when the queue is created,
+    each one gets its own count of queued frames; the frames of any other
+    stream share a single count.
+    '''
+
+    def __init__(self, name, maxsize=DEFAULT_MAXSIZE, policy=DEFAULT_POLICY, streams=()):
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue = multiprocessing.Queue()
+        self._reader = self.queue._reader
+        self.counters = multiprocessing.Array('l', COUNTERS)
+        # index of the queued frames count of each stream, 0 for the others
+        self.streams = dict((stream, idx + 1) for idx, stream in enumerate(streams))
+        # guarded by the lock of the counters: the frames of each stream
+        # in the queue, and put so far (the number of the next one)
+        self.streamFrames = multiprocessing.Array('l', len(self.streams) + 1, lock=False)
+        self.streamGenerations = multiprocessing.Array('l', len(self.streams) + 1, lock=False)
+
+    def put(self, message, droppable=False, stream=None):
+        '''
+        :param message: the message
+        :param droppable: True if the message can be dropped (sensor frame)
+        :param stream: the stream of the frame (e.g. the sensor id), when
+                       the queue carries the frames of several streams
+        :return: True if the message has been queued, False if dropped
+                 (maxsize frames of the stream already queued with DROP_NEWEST,
+                 OLDEST_LIMIT_FACTOR times as many with DROP_OLDEST)
+        '''
+        droppable = droppable and self.policy != DROP_NONE
+        slot = self.streams.get(stream, 0)
+        generation = None
+        with self.counters.get_lock():
+            if droppable:
+                limit = self.maxsize if self.policy == DROP_NEWEST else self.maxsize * OLDEST_LIMIT_FACTOR
+                if self.streamFrames[slot] >= limit:
+                    self.counters[DROPPED] += 1
+                    return False
+                generation = self.streamGenerations[slot]
+                self.streamGenerations[slot] += 1
+                self.counters[QUEUED_FRAMES] += 1
+                self.streamFrames[slot] += 1
+            self.counters[QUEUED] += 1
+            self.counters[SENT] += 1
+        self.queue.put((droppable, stream, generation, message))
+        return True
+
+    def isSuperseded(self, stream, generation):
+        '''
+        :return: True if the frame is older than the newest maxsize frames
+                 of its stream (DROP_OLDEST policy). Call it holding the
+                 lock of the counters
+        '''
+        return self.policy == DROP_OLDEST and \
+            generation < self.streamGenerations[self.streams.get(stream, 0)] - self.maxsize
+
+    def empty(self):
+        return self.queue.empty()
+
+    def cancel_join_thread(self):
+        '''
+        Do not wait, when the producer process exits, for the queued
+        messages to be written to the pipe (see multiprocessing.Queue).
+        '''
+        self.queue.cancel_join_thread()
+
+    def get(self, block=True, timeout=None):
+        '''
+        Get the next message, skipping the superseded frames.
+        '''
+        while True:
+            droppable, stream, generation, message = self.queue.get(block, timeout)
+            with self.counters.get_lock():
+                superseded = droppable and self.isSuperseded(stream, generation)
+            self.dequeued(1, [stream] if droppable else [], 1 if superseded else 0)
+            if not superseded:
+                return message
+
+    def drain(self, block=True, timeout=None):
+        '''
+        Get all the messages available in the queue, waiting for the
+        first one if block is True.
+        With the DROP_OLDEST policy only the newest frame of each stream
+        is kept (unless superseded), the control messages are all returned.
+        :return: list of messages, in queue order (possibly empty)
+        '''
+        return [message for droppable, message in self.drainItems(block, timeout)]
+
+    def drainItems(self, block=True, timeout=None):
+        '''
+        As drain, but return (droppable, message) tuples
+        '''
+        items = []
+        try:
+            items.append(self.queue.get(block, timeout))
+            while True:
+                items.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        frames = [idx for idx, (droppable, stream, generation, message) in enumerate(items) if droppable]
+        frameStreams = [items[idx][1] for idx in frames]
+        count = len(items)
+        if self.policy == DROP_OLDEST and frames:
+            newest = {}
+            for idx in frames:
+                newest[items[idx][1]] = idx
+            stale = set(frames) - set(newest.itervalues())
+            with self.counters.get_lock():
+                stale.update(idx for idx in newest.itervalues() if self.isSuperseded(*items[idx][1:3]))
+            items = [item for idx, item in enumerate(items) if idx not in stale]
+        self.dequeued(count, frameStreams, count - len(items))
+        return [(droppable, message) for droppable, stream, generation, message in items]
+
+    def dequeued(self, count, frameStreams, dropped):
+        '''
+        :param count: number of messages taken from the queue
+        :param frameStreams: the stream of each frame among them
+        :param dropped: number of frames dropped among them
+        '''
+        with self.counters.get_lock():
+            self.counters[QUEUED] -= count
+            self.counters[QUEUED_FRAMES] -= len(frameStreams)
+            self.counters[DROPPED] += dropped
+            for stream in frameStreams:
+                self.streamFrames[self.streams.get(stream, 0)] -= 1
+
+    def getStats(self):
+        with self.counters.get_lock():
+            return {'queued': self.counters[QUEUED],
+                    'dropped': self.counters[DROPPED],
+                    'sent': self.counters[SENT]}
+
+
+def createStageQueue(config, name, policy=DEFAULT_POLICY, instance=None, streams=()):
+    '''
+    Create the queue of a stage, reading its settings from the
+    [Pipeline] section of the configuration (if any).
+    :param config: a ConfigParser instance
+    :param name: the stage name
+    :param policy: the default drop policy for the stage
+    :param instance: the queue name among the ones of the same stage (e.g. the
+                     sensor id), appended to the stage name in the statistics
+    :param streams: the streams of the frames, when the queue carries the
+                    frames of several sensors (see StageQueue)
+    :return: a StageQueue
+    '''
+    maxsize = DEFAULT_MAXSIZE
+    if config.has_option(PIPELINE_SECTION, name + MAXSIZE_OPT):
+        maxsize = config.getint(PIPELINE_SECTION, name + MAXSIZE_OPT)
+    if config.has_option(PIPELINE_SECTION, name + POLICY_OPT):
+        policy = config.get(PIPELINE_SECTION, name + POLICY_OPT)
+    if instance is not None:
+        name = '%s:%s' % (name, instance)
+    return StageQueue(name, maxsize, policy, streams)
+
+
+# indexes of the stream demand counters
+DEMAND_CLIENTS = 0  # connected web clients
+DEMAND_IMAGE = 1    # clients wanting the thermal image at the processor resolution
+DEMAND_BINARY = 2   # clients wanting the binary grid
+DEMAND_TEMP = 3     # clients wanting the temperature grid
+DEMAND_IMAGE_32 = 4  # clients wanting the thermal image at 32x32
+DEMAND_IMAGE_64 = 5  # clients wanting the thermal image at 64x64
+DEMANDS = 6
+# the thermal image resolutions the clients can subscribe to, besides
+# the processor and the raw ones, with their demand counter
+IMAGE_DEMANDS = {32: DEMAND_IMAGE_32, 64: DEMAND_IMAGE_64}
+
+
+class StreamDemand(object):
+    '''
+    Number of web clients consuming each part of the processed frames,
+    written by the web server and read by the processor, which can
+    skip the work nobody is waiting for.
+    '''
+
+    def __init__(self):
+        self.counters = multiprocessing.Array('l', DEMANDS)
+
+    def set(self, counters):
+        '''
+        :param counters: list of DEMANDS values, indexed by the DEMAND_* constants
+        '''
+        with self.counters.get_lock():
+            self.counters[:] = counters
+
+    def get(self, demand):
+        return self.counters[demand]
@@ -1,11 +1,18 @@
 __author__ = 'fabio'
-import ConfigParser
 import multiprocessing
 import json
 from node import SOURCE_TAG, WEB, DEVICE, ALARM, BACKGROUND, RESET, SET, UPDATE_UI, COMMAND_TAG
 from device import GRID_SIZE_X,GRID_SIZE_Y,GE,NON_LATCHING_RELAY,LATCHING_RELAY
+from device import PIXEL_DTYPES, PIXEL_INT16, PIXEL_FORMAT_DEFAULT, TEMPERATURE_SCALE, getPixelFormat
 import analyser
 from analyser import *
+from framering import RING_SLOT_TAG, RING_SEQ_TAG
+from pipeline import DEMAND_CLIENTS, DEMAND_IMAGE, DEMAND_BINARY, DEMAND_TEMP, IMAGE_DEMANDS
+import metrics
+from metrics import stamp
+from sensors import SENSOR_TAG, DEFAULT_SENSOR, readSensorConfig
+from zones import DEFAULT_ZONE, ZONE_TAG, readZones, zonesMessage
+import select
 
 IMAGE_SIZE_X = 64
 IMAGE_SIZE_Y = 64
@@ -17,10 +24,12 @@ GE_MDN = "GE_MDN"
 GE_STD = "GE_STD"
 GE_BINARY = "GE_BINARY"
 GE_TEMP = "GE_TEMP"
+GE_RAW = "GE_RAW"
+GE_SEQ = "GE_SEQ"
+GE_IMAGES = "GE_IMAGES"  # thermal images at the other resolutions asked by the clients, by size
 GE_CORR_COEFF = "GE_CORR_COEFF"
 X_TAG = "X"
 Y_TAG = "Y"
-CELL="CELL"
 MODE="MODE"
 
 DEFAULT_ALARM_TRIGGER_THRESHOLD=1
@@ -31,7 +40,6 @@ IMAGE_SIZE_X_OPT="image_grid_rows"
 IMAGE_SIZE_Y_OPT="image_grid_columns"
 ALARM_TRIGGER_THRESHOLD_OPT="alarm_trigger_threshold"
 ALARM_COMMAND_OPT="alarm_command"
-ALARM_MASK_OPT="alarm_mask"
 
 DEFAULT_ALARM_COMMAND='{"LR":7}'
 
@@ -45,7 +53,8 @@ class Processor(multiprocessing.Process,analyser.ImageProcessor):
                  image_size_X=IMAGE_SIZE_X, image_size_Y=IMAGE_SIZE_Y,
                  window_size=DEFAULT_WINDOW_SIZE,
                  alarm_trigger_threshold=DEFAULT_ALARM_TRIGGER_THRESHOLD,
-                 alarm_command=DEFAULT_ALARM_COMMAND):
+                 alarm_command=DEFAULT_ALARM_COMMAND,
+                 frame_ring=None, stream_demand=None, sensor=DEFAULT_SENSOR, render_pool=None):
         '''
 
         :param node_to_processor_queue:    input queue for data from the device (node)
@@ -65,17 +74,31 @@ class Processor(multiprocessing.Process,analyser.ImageProcessor):
         :param image_size_Y:               thermal image frame size Y axis (number of columns)
         :param window_size:                number of frames required to set background temperature
         :param alarm_trigger_threshold:    number of frames necessary for detecting the change
-                                           and trigger the event
+                                           and trigger the event (default of the alarm zones)
         :param alarm_command:              the JSON command to trigger the alarm on the device
+                                           (default of the alarm zones, see zones.py)
+        :param frame_ring:                 FrameRing shared with the node, holding the
+                                           pixels of the frames referenced by the messages
+        :param stream_demand:              StreamDemand set by the web server: the parts of the
+                                           processed frames nobody consumes are not computed
+        :param sensor:                     the sensor id: its [Processor:<sensor>] section overrides
+                                           the [Processor] settings, and it tags the messages to the web
+        :param render_pool:                RenderPool building the thermal images in the render
+                                           workers, and sending the processed frames in order
         '''
 
         multiprocessing.Process.__init__(self)
+        config = readSensorConfig(config_file, sensor) if config_file else None
+        # the frames of the device, either in C or in its fixed point format
+        self.pixel_format = getPixelFormat(config) if config is not None else PIXEL_FORMAT_DEFAULT
         analyser.ImageProcessor.__init__(self, config_file=config_file,
                                          detection_mode=detection_mode,
                                          threshold_abs=absolute_temperature_threshold,
                                          threshold_diff=differential_temperature_threshold,
                                          window_size=window_size,
-                                         debug_queue=debug_queue)
+                                         debug_queue=debug_queue, config=config,
+                                         scale=TEMPERATURE_SCALE if self.pixel_format == PIXEL_INT16 else 1)
+        self.sensor = sensor
         self.size_X=frame_size_X
         self.size_Y=frame_size_Y
         self.image_size_X=image_size_X
@@ -83,18 +106,16 @@ class Processor(multiprocessing.Process,analyser.ImageProcessor):
         self.node_to_processor_queue = node_to_processor_queue
         self.processor_to_node_queue = processor_to_node_queue
         self.processor_to_web_queue = processor_to_web_queue
-        self.alarm_mask = Frame(frame_size_X, frame_size_Y, [0] * frame_size_X * frame_size_Y)
         self.alarm_trigger_threshold = alarm_trigger_threshold
-        self.alarm_triggered = False
-        self.alarm_counter = 0
         self.alarm_command = alarm_command
-        if config_file:
-            config = ConfigParser.ConfigParser()
-            config.optionxform = str
-            config.read(config_file)
+        self.frame_ring = frame_ring
+        self.stream_demand = stream_demand
+        self.render_pool = render_pool
+        self.frame_sequence = 0
+        if config is not None:
             #override with configuration based settings
             if config.has_option(PROCESSOR_SECTION,GRID_SIZE_X_OPT):
-                self.size_X=config.get(PROCESSOR_SECTION,GRID_SIZE_X_OPT)
+                self.size_X=config.getint(PROCESSOR_SECTION,GRID_SIZE_X_OPT)
             if config.has_option(PROCESSOR_SECTION,GRID_SIZE_Y_OPT):
                 self.size_Y=config.getint(PROCESSOR_SECTION, GRID_SIZE_Y_OPT)
             if config.has_option(PROCESSOR_SECTION,IMAGE_SIZE_X_OPT):
@@ -105,77 +126,222 @@ class Processor(multiprocessing.Process,analyser.ImageProcessor):
                 self.alarm_trigger_threshold=config.getint(PROCESSOR_SECTION, ALARM_TRIGGER_THRESHOLD_OPT)
             if config.has_option(PROCESSOR_SECTION,ALARM_COMMAND_OPT):
                 self.alarm_command=config.get(PROCESSOR_SECTION, ALARM_COMMAND_OPT)
-            if config.has_option(PROCESSOR_SECTION,ALARM_MASK_OPT):
-                from ast import literal_eval
-                for x in config.get(PROCESSOR_SECTION, ALARM_MASK_OPT).split(" "):
-                    (x, y) = literal_eval(x)
-                    self.alarm_mask.setValue(x, y, 1)
+        # alarm zones, by name
+        self.zones = readZones(config, (self.size_X, self.size_Y), self.alarm_command,
+                               self.alarm_trigger_threshold)
+        # the zones with objects in the frame being processed
+        self.hit_zones = set()
 
     def updateUI(self):
         #update UI
-        for x in range (0, self.size_X):
-            for y in range (0, self.size_Y):
-                if self.alarm_mask.getValue(x,y)==1:
-                    maskMessage = {}
-                    maskMessage[X_TAG] = x + 1
-                    maskMessage[Y_TAG] = y + 1
-                    maskMessage[CELL] = SET
-                    self.processor_to_web_queue.put(json.dumps(maskMessage))
+        self.sendZones()
         message={}
         message[MODE]=self.detection_mode
-        self.processor_to_web_queue.put(message)
+        self.sendToWeb(message)
+
+    def sendZones(self):
+        '''
+        Send the masks and status of all the alarm zones, as one message.
+        '''
+        self.sendToWeb(zonesMessage(self.zones, (self.size_X, self.size_Y)))
+
+    def sendToWeb(self, message):
+        '''
+        Send a control message to the web server, tagged with the sensor id.
+        '''
+        message[SENSOR_TAG] = self.sensor
+        self.processor_to_web_queue.put(json.dumps(message))
+
+    def readFrame(self, message):
+        '''
+        :param message: message from the device (node)
+        :return: a Frame with the sensor temperatures carried by the message,
+                 either inline or in the frame ring, or None if there are none.
+                 With the PIXEL_INT16 format, the Frame is in sensor units
+        '''
+        dtype = PIXEL_DTYPES[self.pixel_format]
+        if RING_SLOT_TAG in message:
+            slot, sequence = message[RING_SLOT_TAG], message[RING_SEQ_TAG]
+            pixels = self.frame_ring.read(slot, sequence)
+            if pixels is None:
+                return None
+            frame = Frame(self.size_X, self.size_Y, pixels, dtype)
+            # the slot may have been overwritten while copying it
+            return frame if self.frame_ring.isValid(slot, sequence) else None
+        if GE in message and len(message[GE]) > 0:
+            return Frame(self.size_X,self.size_Y,message[GE],dtype)
+        return None
+
+    def isWanted(self, demand):
+        '''
+        :param demand: one of the DEMAND_* counters
+        :return: True if some web client consumes that part of the
+                 processed frames (always True without a StreamDemand)
+        '''
+        return self.stream_demand is None or self.stream_demand.get(demand) > 0
+
+    def getImageSizes(self):
+        '''
+        :return: the sizes (rows, columns) of the thermal images to build:
+                 the processor image size, and the other resolutions the
+                 web clients subscribed to (only asked through a StreamDemand)
+        '''
+        sizes = []
+        if self.isWanted(DEMAND_IMAGE):
+            sizes.append((self.image_size_X, self.image_size_Y))
+        if self.stream_demand is not None:
+            for resolution, demand in sorted(IMAGE_DEMANDS.iteritems()):
+                if self.isWanted(demand) and (resolution, resolution) not in sizes:
+                    sizes.append((resolution, resolution))
+        return sizes
 
     def process(self, message):
-        from copy import deepcopy
-        processedMessage = deepcopy(message)
-        if GE in processedMessage and len(processedMessage[GE]) > 0:
-            imgFrame = Frame(self.size_X,self.size_Y,processedMessage[GE])
+        '''
+        Process a message from the device.
+        The object detection always runs, the thermal image, the binary
+        and temperature grids are only built when some client wants them.
+        :return: the processed message for the web clients (see streams.py),
+                 or None if there are no clients.
+                 The frames it carries (GE, GE_RAW, GE_TEMP, GE_BINARY)
+                 are 2-D arrays, encoded by the web server
+        '''
+        processedMessage, imgFrame = self.analyse(message)
+        if imgFrame is not None:
+            self.render(processedMessage, imgFrame)
+        return processedMessage
+
+    def analyse(self, message):
+        '''
+        The sequential part of process: the detection, that depends on
+        the previous frames, the statistics and the grids.
+        :return: (processed message or None, Frame whose thermal image has to
+                 be rendered or None)
+        '''
+        processedMessage = dict(message)
+        stamp(processedMessage, metrics.STAGE_DEQUEUE)
+        imgFrame = self.readFrame(processedMessage)
+        # the sensor values are replaced by the processed frames
+        processedMessage.pop(GE, None)
+        if RING_SLOT_TAG in processedMessage:
+            del processedMessage[RING_SLOT_TAG]
+            del processedMessage[RING_SEQ_TAG]
+            if imgFrame is None and self.debug_queue:
+                self.debug_queue.put("PROCESSOR: frame %d overwritten in the ring" % message[RING_SEQ_TAG])
+        if imgFrame is not None:
             imgFrame.flipH()
             imgFrame.flipV()
             status = self.processFrame(imgFrame)
+            self.checkZones()
+            stamp(processedMessage, metrics.STAGE_PROCESS_FRAME)
+            self.frame_sequence += 1
+            if not self.isWanted(DEMAND_CLIENTS):
+                return None, None
+            if self.scale != 1:
+                # the web clients get the temperatures in C
+                imgFrame = Frame(self.size_X, self.size_Y, imgFrame.imgMatrix / float(self.scale))
+            processedMessage[GE_SEQ] = self.frame_sequence
+            processedMessage[GE_RAW] = imgFrame.imgMatrix
             if status == ImageProcessor.S_PROCESS_IMAGE:
-                processedMessage[GE_TEMP] = list(imgFrame.rawData)
-                processedMessage[GE_BINARY] = list(imgFrame.binary(self.getDetectedObjects()).rawData)
+                if self.isWanted(DEMAND_TEMP):
+                    processedMessage[GE_TEMP] = imgFrame.imgMatrix
+                if self.isWanted(DEMAND_BINARY):
+                    processedMessage[GE_BINARY] = imgFrame.binary(self.getDetectedObjects()).imgMatrix
             processedMessage[GE_MIN] = imgFrame.min()
             processedMessage[GE_MAX] = imgFrame.max()
             processedMessage[GE_AVG] = imgFrame.mean()
             processedMessage[GE_MDN] = imgFrame.median()
             processedMessage[GE_STD] = imgFrame.stdDev()
+            stamp(processedMessage, metrics.STAGE_STATS)
+            if self.getImageSizes():
+                return processedMessage, imgFrame
+        elif not self.isWanted(DEMAND_CLIENTS):
+            return None, None
+        return processedMessage, None
+
+    def render(self, processedMessage, imgFrame):
+        '''
+        The thermal images of a frame (the part of process that can run in parallel)
+        '''
+        imageSize = (self.image_size_X, self.image_size_Y)
+        sizes = self.getImageSizes()
+        # the other resolutions first: imgFrame is expanded in place
+        for sizeX, sizeY in sizes:
+            if (sizeX, sizeY) != imageSize:
+                resized = Frame(self.size_X, self.size_Y, imgFrame.imgMatrix)
+                resized.expand(sizeX, sizeY)
+                resized.filterNoise()
+                storeImages(processedMessage, [(sizeX, sizeY)], [resized.imgMatrix], imageSize)
+        if imageSize in sizes:
             imgFrame.expand(self.image_size_X,self.image_size_Y)
+            stamp(processedMessage, metrics.STAGE_EXPAND)
             imgFrame.filterNoise()
-            processedMessage[GE] = list(imgFrame.rawData)
-        return processedMessage
+            stamp(processedMessage, metrics.STAGE_FILTER_NOISE)
+            processedMessage[GE] = imgFrame.imgMatrix
+
+    def sendFrame(self, processedMessage, imgFrame=None):
+        '''
+        Send a processed frame to the web server, once its thermal images
+        are rendered: here, or by the render workers if there is a pool.
+        :param imgFrame: the Frame to render, None if there is no image to build
+        '''
+        if self.render_pool is None:
+            if imgFrame is not None:
+                self.render(processedMessage, imgFrame)
+            self.processor_to_web_queue.put(processedMessage, droppable=True, stream=self.sensor)
+            return
+        sizes = self.getImageSizes() if imgFrame is not None else []
+        if sizes:
+            self.render_pool.submit(processedMessage, self.sensor, imgFrame.imgMatrix,
+                                    sizes, (self.image_size_X, self.image_size_Y))
+        else:
+            self.render_pool.append(processedMessage, self.sensor)
 
     def detect_cb(self,detected_object,event,frame):
         '''
-        callback invoked upon detection.
+        callback invoked upon detection: records the alarm zones the object
+        is in (the object is tracked, so it is reported as OBJECT_IN on its
+        first frame and as OBJECT_MOVE on the next ones).
         :param detected_object:
         :param event:
         :param frame:
         :return:
         '''
-        if event==OBJECT_IN and not self.alarm_triggered:
-            alarm = False
-            for point in detected_object.getPoints():
-                if self.alarm_mask.getValue(point.x, point.y) != 0:
-                    if self.alarm_counter == self.alarm_trigger_threshold:
-                        alarm = True
-                        self.alarm_counter = 0
-                    else:
-                        self.alarm_counter += 1
-                    break
-            # update device if alarm has been triggered
-            if alarm:
+        if event not in (OBJECT_IN, OBJECT_MOVE):
+            return
+        for zone in self.zones.itervalues():
+            if not zone.triggered and zone.intersects(detected_object):
+                self.hit_zones.add(zone.name)
+
+    def checkZones(self):
+        '''
+        Count the frame for each alarm zone with objects in it (once,
+        whatever the number of objects), and raise the alarm of the
+        zones reaching their trigger threshold.
+        '''
+        for zone in self.zones.itervalues():
+            if zone.name in self.hit_zones and zone.hit():
                 # send only the relay setting to the device
+                alarmCommand = json.loads(zone.command)
+                stamp(alarmCommand, metrics.STAGE_DETECT)
+                self.processor_to_node_queue.put(json.dumps(alarmCommand))
                 alarmMessage = {}
-                #alarmMessage[LATCHING_RELAY] = 7
-                self.processor_to_node_queue.put(json.dumps(json.loads(self.alarm_command)))
-                #del alarmMessage[LATCHING_RELAY]
                 alarmMessage[ALARM] = SET
-                self.processor_to_web_queue.put(json.dumps(alarmMessage))
-                self.alarm_triggered = True
+                alarmMessage[ZONE_TAG] = zone.name
+                self.sendToWeb(alarmMessage)
                 if self.debug_queue:
                     self.debug_queue.put("PROCESSOR: send msg to node - %s" % alarmMessage)
+        self.hit_zones.clear()
+
+    def setup(self):
+        '''
+        Prepare the processing of the frames, in the process running it.
+        '''
+        self.addDetectionCallback(self.detect_cb,OBJECT_IN)
+        self.addDetectionCallback(self.detect_cb,OBJECT_MOVE)
+        # build the interpolation operator up front, so that
+        # the first frames do not pay for the triangulation
+        Upsampler.get((self.size_X, self.size_Y), (self.image_size_X, self.image_size_Y))
+        self.updateUI()
 
     def run(self):
         '''
@@ -184,51 +350,130 @@ class Processor(multiprocessing.Process,analyser.ImageProcessor):
         process and route them to their next destination.
         :return:
         '''
-        self.addDetectionCallback(self.detect_cb,OBJECT_IN)
-        self.updateUI()
-        while True:
-            while not self.node_to_processor_queue.empty():
-                # process data from the device
-                message = self.node_to_processor_queue.get()
+        self.setup()
+        serve(self.node_to_processor_queue, {self.sensor: self}, self.render_pool, self.debug_queue)
+
+    def handle(self, message):
+        '''
+        Process a message from the node and route the result
+        to its next destination.
+        :param message: the decoded message
+        '''
+        if message[SOURCE_TAG] == ALARM:
+            if message[ALARM] == RESET:
+                # reset the alarm status (of all the zones, or of
+                # the ZONE given) and broadcast the reset command
+                # to all the web clients, to update their UI control
+                alarmMessage = {}
+                alarmMessage[ALARM] = RESET
+                for zone in self.zones.itervalues():
+                    if message.get(ZONE_TAG, zone.name) == zone.name:
+                        zone.reset()
+                if ZONE_TAG in message:
+                    alarmMessage[ZONE_TAG] = message[ZONE_TAG]
+                self.sendToWeb(alarmMessage)
+        elif message[SOURCE_TAG] == BACKGROUND:
+            # upgrade the background image
+            self.updateBackground()
+        elif message[SOURCE_TAG] == DEVICE:
+            message, imgFrame = self.analyse(message)
+            # update UI
+            if message is not None:
+                self.sendFrame(message, imgFrame)
+        elif message[SOURCE_TAG] == WEB:
+            # process data coming from the web
+            if COMMAND_TAG in message:
+                if message[COMMAND_TAG] == UPDATE_UI:
+                    self.updateUI()
+            # (alarm mask settings: toggle a cell of a zone)
+            elif all(key in message for key in (X_TAG, Y_TAG)):
+                zone = self.zones.get(message.get(ZONE_TAG, DEFAULT_ZONE))
+                if zone is None:
+                    return
+                # X and Y count the rows and the columns of the grid from 1
+                x, y = message[X_TAG], message[Y_TAG]
+                rows, cols = zone.mask.shape
+                if not all(type(value) in (int, long) for value in (x, y)) or \
+                        not (1 <= x <= rows and 1 <= y <= cols):
+                    if self.debug_queue:
+                        self.debug_queue.put("PROCESSOR: invalid alarm zone cell %r, %r" % (x, y))
+                    return
+                zone.toggle(x - 1, y - 1)
+                self.sendZones()
                 if self.debug_queue:
-                    self.debug_queue.put("PROCESSOR: recv msg from node - %s" % message)
-                message = json.loads(message)
-                if message[SOURCE_TAG] == ALARM:
-                    if message[ALARM] == RESET:
-                        # reset the alarm status and
-                        # broadcast the reset command to all the
-                        # web clients, to update their UI control
-                        alarmMessage = {}
-                        alarmMessage[ALARM] = RESET
-                        self.alarm_triggered = False
-                        self.alarm_counter = 0
-                        self.processor_to_web_queue.put(json.dumps(alarmMessage))
-                elif message[SOURCE_TAG] == BACKGROUND:
-                    # upgrade the background image
-                    self.updateBackground()
-                elif message[SOURCE_TAG] == DEVICE:
-                    message = self.process(message)
-                    # update UI
-                    self.processor_to_web_queue.put(json.dumps(message))
-                    if self.debug_queue and False:
-                        self.debug_queue.put("PROCESSOR: send msg to web - %s" % message)
-                elif message[SOURCE_TAG] == WEB:
-                    # process data coming from the web
-                    if COMMAND_TAG in message:
-                        if message[COMMAND_TAG] == UPDATE_UI:
-                            self.updateUI()
-                    # (alarm mask settings)
-                    elif all(key in message for key in (X_TAG, Y_TAG)):
-                        maskMessage = {}
-                        maskMessage[X_TAG]=message[X_TAG]
-                        maskMessage[Y_TAG]=message[Y_TAG]
-                        if self.alarm_mask.getValue(message[X_TAG]-1,message[Y_TAG]-1) == 1:
-                            self.alarm_mask.setValue(message[X_TAG] - 1, message[Y_TAG] - 1,0)
-                            maskMessage[CELL]=RESET
-                        else:
-                            self.alarm_mask.setValue(message[X_TAG] - 1, message[Y_TAG] - 1,1)
-                            maskMessage[CELL]=SET
-                        self.processor_to_web_queue.put(json.dumps(maskMessage))
-                        if self.debug_queue:
-                            self.debug_queue.put("PROCESSOR: alarm grid %s" % self.alarm_mask)
+                    self.debug_queue.put("PROCESSOR: alarm zone %s\n%s" % (zone.name, zone.mask.astype(int)))
+
+
+def storeImages(processedMessage, sizes, images, imageSize):
+    '''
+    Add the thermal images of a frame to its processed message: the one
+    at the processor image size as GE, the others in GE_IMAGES by resolution.
+    :param sizes: the (rows, columns) of each image
+    :param imageSize: the processor image size
+    '''
+    for size, image in zip(sizes, images):
+        if size == imageSize:
+            processedMessage[GE] = image
+        else:
+            processedMessage.setdefault(GE_IMAGES, {})[size[0]] = image
+
+
+class ProcessorShard(multiprocessing.Process):
+    '''
+    Process running the Processors of a shard of the sensors: their
+    nodes share its input queue, and each message is handled by the
+    Processor of the sensor it is tagged with. The Processors are not
+    started themselves, their state lives in this process.
+    '''
+
+    def __init__(self, node_to_processor_queue, processors, render_pool=None, debug_queue=None):
+        '''
+        :param node_to_processor_queue: input queue for data from the nodes of the shard
+        :param processors:              the Processor of each sensor of the shard
+        :param render_pool:             the RenderPool shared by the Processors, if any
+        :param debug_queue:             output queue for debugging messages
+        '''
+        multiprocessing.Process.__init__(self)
+        self.node_to_processor_queue = node_to_processor_queue
+        self.processors = dict((proc.sensor, proc) for proc in processors)
+        self.render_pool = render_pool
+        self.debug_queue = debug_queue
+
+    def run(self):
+        for proc in self.processors.itervalues():
+            proc.setup()
+        serve(self.node_to_processor_queue, self.processors, self.render_pool, self.debug_queue)
+
 
+def serve(node_to_processor_queue, processors, render_pool=None, debug_queue=None):
+    '''
+    The loop of a processor process: wait for the messages from the
+    nodes and hand them to the Processor of their sensor. If the
+    processor fell behind, only the newest frame of each sensor is
+    processed (see StageQueue.drain). With a render pool, the rendered
+    images are collected as they come, and no new frame is taken while
+    the workers are busy with max_pending frames.
+    :param processors: the Processors, by sensor id
+    '''
+    readers = [node_to_processor_queue._reader]
+    if render_pool is not None:
+        readers.append(render_pool.rendered_queue._reader)
+    while True:
+        if render_pool is not None:
+            if render_pool.isFull():
+                render_pool.collect(block=True)
+                continue
+            select.select(readers, [], [])
+            render_pool.collect()
+            messages = node_to_processor_queue.drain(block=False)
+        else:
+            messages = node_to_processor_queue.drain()
+        for message in messages:
+            if debug_queue:
+                debug_queue.put("PROCESSOR: recv msg from node - %s" % message)
+            message = json.loads(message)
+            proc = processors.get(message.get(SENSOR_TAG, DEFAULT_SENSOR))
+            if proc is not None:
+                proc.handle(message)
+            elif debug_queue:
+                debug_queue.put("PROCESSOR: no processor for sensor %s" % message.get(SENSOR_TAG))
@@ -0,0 +1,268 @@
+__author__ = 'fabio'
+import glob
+import json
+import multiprocessing
+import os
+import signal
+import time
+import numpy as np
+from device import GRID_SIZE_X, GRID_SIZE_Y
+
+RECORDER_SECTION = 'Recorder'
+ENABLED_OPT = 'enabled'
+DIRECTORY_OPT = 'directory'
+PIXEL_FORMAT_OPT = 'pixel_format'
+SEGMENT_RECORDS_OPT = 'segment_records'
+INDEX_INTERVAL_OPT = 'index_interval'
+FLUSH_INTERVAL_OPT = 'flush_interval'
+
+PIXEL_INT16 = 'int16'      # 1/256 C, as sent by the sensor
+PIXEL_FLOAT32 = 'float32'  # C
+PIXEL_DTYPES = {PIXEL_INT16: '<i2', PIXEL_FLOAT32: '<f4'}
+INT16_SCALE = 256
+
+DEFAULT_DIRECTORY = './recordings'
+DEFAULT_PIXEL_FORMAT = PIXEL_INT16
+DEFAULT_SEGMENT_RECORDS = 36000  # one hour at 10 frames per second
+DEFAULT_INDEX_INTERVAL = 100     # records between two index entries
+DEFAULT_FLUSH_INTERVAL = 1.0     # s between two writes to the disk
+
+# Each segment of a recording is made of three files, sharing a name
+# (SEGMENT_PREFIX + start time + sequence number):
+#   .rec   the frames, fixed-size records (see recordDtype), to be read
+#          with np.memmap(path, dtype=recordDtype(...), mode='r')
+#   .idx   the time index: one INDEX_DTYPE entry every index_interval
+#          records, to find a time range by seek rather than by scan
+#   .json  the record layout (pixel format and grid size)
+SEGMENT_PREFIX = 'frames_'
+RECORDS_EXT = '.rec'
+INDEX_EXT = '.idx'
+META_EXT = '.json'
+INDEX_DTYPE = np.dtype([('time_ns', '<i8'), ('wall_ns', '<i8'), ('record', '<i8')])
+
+
+def wallNs():
+    return int(time.time() * 1000000000)
+
+
+def recordDtype(pixel_format=DEFAULT_PIXEL_FORMAT, sizeX=GRID_SIZE_X, sizeY=GRID_SIZE_Y):
+    '''
+    :return: the numpy dtype of the records of a segment
+    '''
+    return np.dtype([('time_ns', '<i8'),  # monotonic clock
+                     ('wall_ns', '<i8'),  # system clock, since the epoch
+                     ('nlr', 'u1'),       # non-latching relays status
+                     ('lr', 'u1'),        # latching relays status
+                     ('pixels', PIXEL_DTYPES[pixel_format], (sizeX, sizeY))])
+
+
+class Recorder(multiprocessing.Process):
+    '''
+    Process appending the raw sensor frames, sent by the node on
+    recorder_queue, to segmented files. The frames are buffered and
+    written every flush_interval seconds, so that the disk sees a few
+    large writes instead of one per frame.
+    '''
+
+    def __init__(self, recorder_queue, directory=DEFAULT_DIRECTORY, pixel_format=DEFAULT_PIXEL_FORMAT,
+                 segment_records=DEFAULT_SEGMENT_RECORDS, index_interval=DEFAULT_INDEX_INTERVAL,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, sizeX=GRID_SIZE_X, sizeY=GRID_SIZE_Y,
+                 debug_queue=None):
+        '''
+        :param recorder_queue:  input queue of the frames, as (monotonic ns, wall ns, nlr, lr, pixels),
+                                the pixels in C (floats) or in 1/256 C (integers)
+        :param directory:       directory of the segment files
+        :param pixel_format:    PIXEL_INT16 or PIXEL_FLOAT32
+        :param segment_records: number of records of a segment
+        :param index_interval:  number of records between two index entries
+        :param flush_interval:  time (s) between two writes to the disk
+        :param debug_queue:     output queue for debugging messages
+        '''
+        multiprocessing.Process.__init__(self)
+        self.recorder_queue = recorder_queue
+        self.directory = directory
+        self.pixel_format = pixel_format
+        self.segment_records = segment_records
+        self.index_interval = index_interval
+        self.flush_interval = flush_interval
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.debug_queue = debug_queue
+        self.dtype = recordDtype(pixel_format, sizeX, sizeY)
+        self.buffer = np.zeros(0, dtype=self.dtype)
+        self.buffered = 0
+        self.records = None  # files of the current segment
+        self.index = None
+        self.segmentLength = 0
+        self.segmentCount = 0
+
+    def openSegment(self, wall_ns):
+        self.closeSegment()
+        name = os.path.join(self.directory, '%s%s_%04d' % (
+            SEGMENT_PREFIX, time.strftime('%Y%m%d-%H%M%S', time.localtime(wall_ns / 1e9)), self.segmentCount))
+        self.segmentCount += 1
+        with open(name + META_EXT, 'w') as meta:
+            json.dump({'pixel_format': self.pixel_format, 'rows': self.sizeX, 'columns': self.sizeY,
+                       'int16_scale': INT16_SCALE, 'index_interval': self.index_interval}, meta)
+        self.records = open(name + RECORDS_EXT, 'ab')
+        self.index = open(name + INDEX_EXT, 'ab')
+        self.segmentLength = 0
+
+    def closeSegment(self):
+        if self.records is not None:
+            self.records.close()
+            self.index.close()
+            self.records = self.index = None
+
+    def append(self, frame):
+        '''
+        :param frame: (monotonic ns, wall ns, nlr, lr, pixels) tuple, the
+                      pixels in C (floats) or in 1/256 C (integers, recorded
+                      as they are in the int16 format)
+        '''
+        if self.buffered == len(self.buffer):
+            self.buffer = np.resize(self.buffer, max(64, 2 * len(self.buffer)))
+        idx = self.buffered
+        for field, value in zip(('time_ns', 'wall_ns', 'nlr', 'lr'), frame[:4]):
+            self.buffer[field][idx] = value
+        pixels = np.reshape(frame[4], (self.sizeX, self.sizeY))
+        if pixels.dtype.kind == 'f':
+            if self.pixel_format == PIXEL_INT16:
+                pixels = np.rint(pixels * INT16_SCALE)
+        elif self.pixel_format == PIXEL_FLOAT32:
+            pixels = pixels / float(INT16_SCALE)
+        self.buffer['pixels'][idx] = pixels
+        self.buffered += 1
+
+    def flush(self):
+        '''
+        Write the buffered records, starting new segments as needed,
+        and the index entries of the records written.
+        '''
+        start = 0
+        while start < self.buffered:
+            if self.records is None or self.segmentLength == self.segment_records:
+                self.openSegment(self.buffer[start]['wall_ns'])
+            count = min(self.buffered - start, self.segment_records - self.segmentLength)
+            chunk = self.buffer[start:start + count]
+            # index entries for the records whose number is a multiple of index_interval
+            first = -self.segmentLength % self.index_interval
+            indexed = np.arange(first, count, self.index_interval)
+            entries = np.zeros(len(indexed), dtype=INDEX_DTYPE)
+            entries['time_ns'] = chunk['time_ns'][indexed]
+            entries['wall_ns'] = chunk['wall_ns'][indexed]
+            entries['record'] = indexed + self.segmentLength
+            self.records.write(chunk.tostring())
+            self.index.write(entries.tostring())
+            self.records.flush()
+            self.index.flush()
+            self.segmentLength += count
+            start += count
+        self.buffered = 0
+
+    def run(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # terminate() sends SIGTERM: exit through the finally clause,
+        # so that the buffered frames are written
+        signal.signal(signal.SIGTERM, self.onTerminate)
+        try:
+            lastFlush = time.time()
+            while True:
+                timeout = max(0, lastFlush + self.flush_interval - time.time())
+                for frame in self.recorder_queue.drain(timeout=timeout):
+                    self.append(frame)
+                if time.time() - lastFlush >= self.flush_interval:
+                    if self.buffered and self.debug_queue:
+                        self.debug_queue.put("RECORDER: writing %d frames" % self.buffered)
+                    self.flush()
+                    lastFlush = time.time()
+        finally:
+            self.flush()
+            self.closeSegment()
+            # the web server may not read the debug messages any more
+            if self.debug_queue:
+                self.debug_queue.cancel_join_thread()
+
+    def onTerminate(self, signum, frame):
+        raise SystemExit(0)
+
+
+def createRecorder(config, recorder_queue, debug_queue=None, sensor=None):
+    '''
+    Create the recorder, reading its settings from the [Recorder]
+    section of the configuration.
+    :param config: a ConfigParser instance
+    :param sensor: the id of the recorded sensor, when there are several:
+                   its frames are recorded in a subdirectory of that name
+    :return: a Recorder, or None if the recording is not enabled
+    '''
+    if not config.has_option(RECORDER_SECTION, ENABLED_OPT) or \
+            not config.getboolean(RECORDER_SECTION, ENABLED_OPT):
+        return None
+    settings = {}
+    for option in (DIRECTORY_OPT, PIXEL_FORMAT_OPT):
+        if config.has_option(RECORDER_SECTION, option):
+            settings[option] = config.get(RECORDER_SECTION, option)
+    for option in (SEGMENT_RECORDS_OPT, INDEX_INTERVAL_OPT):
+        if config.has_option(RECORDER_SECTION, option):
+            settings[option] = config.getint(RECORDER_SECTION, option)
+    if config.has_option(RECORDER_SECTION, FLUSH_INTERVAL_OPT):
+        settings[FLUSH_INTERVAL_OPT] = config.getfloat(RECORDER_SECTION, FLUSH_INTERVAL_OPT)
+    if sensor is not None:
+        settings[DIRECTORY_OPT] = os.path.join(settings.get(DIRECTORY_OPT, DEFAULT_DIRECTORY), sensor)
+    return Recorder(recorder_queue, debug_queue=debug_queue, **settings)
+
+
+def readSegment(path):
+    '''
+    :param path: path of a segment, without extension
+    :return: (records, index), read-only np.memmap arrays
+    '''
+    with open(path + META_EXT) as meta:
+        layout = json.load(meta)
+    dtype = recordDtype(layout['pixel_format'], layout['rows'], layout['columns'])
+    records = np.memmap(path + RECORDS_EXT, dtype=dtype, mode='r') \
+        if os.path.getsize(path + RECORDS_EXT) else np.zeros(0, dtype=dtype)
+    index = np.fromfile(path + INDEX_EXT, dtype=INDEX_DTYPE)
+    return records, index
+
+
+def listSegments(directory=DEFAULT_DIRECTORY):
+    '''
+    :return: the paths of the segments (without extension), oldest first
+    '''
+    return sorted(path[:-len(RECORDS_EXT)]
+                  for path in glob.glob(os.path.join(directory, SEGMENT_PREFIX + '*' + RECORDS_EXT)))
+
+
+def findRecords(start_ns, end_ns, directory=DEFAULT_DIRECTORY):
+    '''
+    Find the frames recorded in a wall clock time range, only reading
+    the index and the records around the range boundaries (the system
+    clock is assumed not to step back while recording).
+    :param start_ns: start of the range (ns since the epoch, included)
+    :param end_ns: end of the range (ns since the epoch, excluded)
+    :return: list of the matching records (np.memmap slices), one per segment
+    '''
+    found = []
+    for path in listSegments(directory):
+        records, index = readSegment(path)
+        if len(records) == 0 or records[0]['wall_ns'] >= end_ns or records[-1]['wall_ns'] < start_ns:
+            continue
+        first = locate(records, index, start_ns)
+        last = locate(records, index, end_ns)
+        if last > first:
+            found.append(records[first:last])
+    return found
+
+
+def locate(records, index, wall_ns):
+    '''
+    :return: the number of the first record at or after wall_ns
+    '''
+    # the index narrows the search to index_interval records
+    entry = np.searchsorted(index['wall_ns'], wall_ns, side='left')
+    low = index['record'][entry - 1] if entry > 0 else 0
+    high = index['record'][entry] if entry < len(index) else len(records)
+    return low + np.searchsorted(records['wall_ns'][low:high], wall_ns, side='left')
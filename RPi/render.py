@@ -0,0 +1,156 @@
+__author__ = 'fabio'
+import multiprocessing
+from collections import deque
+import metrics
+import pipeline
+from analyser import Frame, PROCESSOR_SECTION
+from processor import storeImages
+
+RENDER_WORKERS_OPT = 'render_workers'  # [Processor] option
+DEFAULT_RENDER_WORKERS = 0  # render in the processor process
+# frames being rendered, per worker, before the processor waits for them
+MAX_PENDING_PER_WORKER = 2
+
+
+def renderImage(raw, sizeX, sizeY):
+    '''
+    Build the thermal image of a frame.
+    :param raw: 2-D array, the sensor temperatures
+    :param sizeX: thermal image rows
+    :param sizeY: thermal image columns
+    :return: (image, expand end time, filter end time), the image as a 2-D array
+    '''
+    frame = Frame(raw.shape[0], raw.shape[1], raw)
+    frame.expand(sizeX, sizeY)
+    expanded = metrics.now()
+    frame.filterNoise()
+    return frame.imgMatrix, expanded, metrics.now()
+
+
+def renderImages(raw, sizes):
+    '''
+    Build the thermal images of a frame, at several sizes.
+    :param raw: 2-D array, the sensor temperatures
+    :param sizes: list of (rows, columns) of the images
+    :return: (images, expand end time, filter end time), the times of the first image
+    '''
+    images = []
+    expanded = filtered = None
+    for sizeX, sizeY in sizes:
+        image, imageExpanded, imageFiltered = renderImage(raw, sizeX, sizeY)
+        if not images:
+            expanded, filtered = imageExpanded, imageFiltered
+        images.append(image)
+    return images, expanded, filtered
+
+
+class RenderWorker(multiprocessing.Process):
+    '''
+    Process building the thermal images of the frames queued by a
+    RenderPool (at all the sizes asked for the frame), one frame at a
+    time, so that the idle workers take the next ones.
+    '''
+
+    def __init__(self, render_queue, rendered_queue):
+        multiprocessing.Process.__init__(self)
+        self.render_queue = render_queue
+        self.rendered_queue = rendered_queue
+
+    def run(self):
+        while True:
+            job, raw, sizes = self.render_queue.get()
+            self.rendered_queue.put((job,) + renderImages(raw, sizes))
+
+
+class RenderPool(object):
+    '''
+    Front of the render workers, in the processor process: it queues
+    the frames to render, and puts all the processed frames, rendered
+    or not, on the output queue in the order they were processed.
+    '''
+
+    def __init__(self, render_queue, rendered_queue, output_queue, max_pending):
+        '''
+        :param render_queue:   queue of the frames to render, read by the workers
+        :param rendered_queue: queue of the rendered images, from the workers
+        :param output_queue:   queue of the processed frames (to the web server)
+        :param max_pending:    max number of frames being rendered
+        '''
+        self.render_queue = render_queue
+        self.rendered_queue = rendered_queue
+        self.output_queue = output_queue
+        self.max_pending = max_pending
+        self.frames = deque()  # [message, stream, done], in processing order
+        self.jobs = {}         # frames being rendered, by job number: (entry, sizes, image size)
+        self.nextJob = 0
+
+    def isFull(self):
+        return len(self.jobs) >= self.max_pending
+
+    def submit(self, message, stream, raw, sizes, imageSize):
+        '''
+        Queue a frame for rendering: its thermal images are added to the
+        message once built (see processor.storeImages).
+        :param message: the processed message
+        :param stream: the stream of the frame on the output queue
+        :param raw: 2-D array, the sensor temperatures
+        :param sizes: list of (rows, columns) of the images to build
+        :param imageSize: the processor image size, the one of GE
+        '''
+        entry = [message, stream, False]
+        self.frames.append(entry)
+        self.jobs[self.nextJob] = (entry, sizes, imageSize)
+        self.render_queue.put((self.nextJob, raw, sizes))
+        self.nextJob += 1
+
+    def append(self, message, stream):
+        '''
+        Output a processed message with nothing to render, after the ones
+        queued before it.
+        '''
+        self.frames.append([message, stream, True])
+        self.flush()
+
+    def collect(self, block=False, timeout=None):
+        '''
+        Add the rendered images to their messages, and output the messages
+        that are complete and no longer wait for older ones.
+        :param block: True to wait for an image
+        '''
+        for job, images, expanded, filtered in self.rendered_queue.drain(block, timeout):
+            entry, sizes, imageSize = self.jobs.pop(job)
+            message = entry[0]
+            storeImages(message, sizes, images, imageSize)
+            timestamps = message.get(metrics.TIMESTAMPS_TAG)
+            if timestamps is not None:
+                timestamps[metrics.STAGE_EXPAND] = expanded
+                timestamps[metrics.STAGE_FILTER_NOISE] = filtered
+            entry[2] = True
+        self.flush()
+
+    def flush(self):
+        while self.frames and self.frames[0][2]:
+            message, stream, done = self.frames.popleft()
+            self.output_queue.put(message, droppable=True, stream=stream)
+
+
+def createRenderPool(config, output_queue, instance=None):
+    '''
+    Create the render workers set in the [Processor] section of the
+    configuration, with the pool feeding them. The workers must be
+    started by the caller, as they cannot be children of the (daemon)
+    processor process.
+    :param config: a ConfigParser instance
+    :param output_queue: queue of the processed frames
+    :param instance: name of the processor process (see pipeline.createStageQueue)
+    :return: (RenderPool, list of RenderWorker), or (None, []) to render in the processor
+    '''
+    workers = DEFAULT_RENDER_WORKERS
+    if config.has_option(PROCESSOR_SECTION, RENDER_WORKERS_OPT):
+        workers = config.getint(PROCESSOR_SECTION, RENDER_WORKERS_OPT)
+    if workers <= 0:
+        return None, []
+    render_queue = pipeline.createStageQueue(config, 'processor_to_render', pipeline.DROP_NONE, instance)
+    rendered_queue = pipeline.createStageQueue(config, 'render_to_processor', pipeline.DROP_NONE, instance)
+    pool = RenderPool(render_queue, rendered_queue, output_queue, MAX_PENDING_PER_WORKER * workers)
+    return pool, [RenderWorker(render_queue, rendered_queue) for i in range(workers)]
@@ -0,0 +1,78 @@
+__author__ = 'fabio'
+import ConfigParser
+
+# Several devices are configured with one [Device:<name>] section each,
+# <name> being the sensor id. The per-sensor sections of the other
+# settings ([Processor:<name>], [Simulator:<name>], [Recorder:<name>])
+# override the options of the shared section for that sensor only, and
+# the relays of each device are saved in [Non_Latching_Relays:<name>]
+# and [Latching_Relays:<name>].
+# A configuration with a single [Device] section has one sensor,
+# DEFAULT_SENSOR, using the sections without suffix.
+SENSOR_TAG = "SENSOR"    # sensor id, in the messages of the pipeline and of the web clients
+SENSORS_TAG = "SENSORS"  # the sensor ids, sent to the web clients when they connect
+SECTION_SEP = ':'
+DEVICE_SECTION = 'Device'
+DEFAULT_SENSOR = 'default'
+
+PROCESSES_OPT = 'processes'  # [Processor] option: number of processor processes
+
+
+def getSensors(config):
+    '''
+    :param config: a ConfigParser instance
+    :return: the sensor ids, in the order of their sections
+    '''
+    prefix = DEVICE_SECTION + SECTION_SEP
+    sensors = [section[len(prefix):] for section in config.sections() if section.startswith(prefix)]
+    return sensors if sensors else [DEFAULT_SENSOR]
+
+
+def sectionName(section, sensor=DEFAULT_SENSOR):
+    '''
+    :return: the name of the section of a sensor
+    '''
+    return section if sensor == DEFAULT_SENSOR else section + SECTION_SEP + sensor
+
+
+def sensorConfig(config, sensor=DEFAULT_SENSOR):
+    '''
+    :param config: a ConfigParser instance
+    :return: a copy of the configuration, as seen by a sensor: the options
+             of its sections override the ones of the shared sections
+    '''
+    view = ConfigParser.ConfigParser()
+    view.optionxform = str
+    suffix = SECTION_SEP + sensor
+    for section in config.sections():
+        if not view.has_section(section):
+            view.add_section(section)
+        for option, value in config.items(section, raw=True):
+            view.set(section, option, value)
+    if sensor != DEFAULT_SENSOR:
+        for section in config.sections():
+            if section.endswith(suffix):
+                base = section[:-len(suffix)]
+                if not view.has_section(base):
+                    view.add_section(base)
+                for option, value in config.items(section, raw=True):
+                    view.set(base, option, value)
+    return view
+
+
+def readSensorConfig(config_file, sensor=DEFAULT_SENSOR):
+    '''
+    :return: the configuration in config_file, as seen by a sensor (see sensorConfig)
+    '''
+    config = ConfigParser.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    return sensorConfig(config, sensor)
+
+
+def assignShards(sensors, count):
+    '''
+    Split the sensors among count processes, in turn.
+    :return: list of count lists of sensor ids (the last ones may be empty)
+    '''
+    return [sensors[shard::count] for shard in range(count)]
@@ -0,0 +1,105 @@
+__author__ = 'fabio'
+import threading
+import time
+from collections import deque
+import metrics
+
+# min time (s) between two commands, needed by the firmware to parse them
+WRITE_INTERVAL = 0.1
+
+# command kinds, in order of priority
+ALARM_COMMAND = 0  # alarm relays, sent before anything else
+COMMAND = 1        # one-off commands (e.g. the frame format), sent in order
+STATE_COMMAND = 2  # full relays/sensor state: only the newest one is sent
+
+
+class SerialWriter(threading.Thread):
+    '''
+    Thread writing the commands to the device, so that the reads are
+    never blocked by a write or by the pause the firmware needs between
+    two commands.
+    The commands are dictionaries, turned into strings by encode when
+    they are written. The pending state commands are coalesced into the
+    newest one, and an alarm command is merged with the pending state
+    command (if any) so that the relays end up as if they had been
+    written in order.
+    '''
+
+    def __init__(self, port, encode, write_interval=WRITE_INTERVAL, debug_queue=None):
+        '''
+        :param port: the serial port
+        :param encode: function returning the string to write for a command
+        :param write_interval: min time (s) between two commands
+        :param debug_queue: output queue for debugging messages
+        '''
+        threading.Thread.__init__(self, name='SerialWriter')
+        self.daemon = True
+        self.port = port
+        self.encode = encode
+        self.write_interval = write_interval
+        self.debug_queue = debug_queue
+        self.condition = threading.Condition()
+        self.alarms = deque()    # (command, time queued)
+        self.commands = deque()  # (command, time queued)
+        self.state = None        # (command, time queued)
+        self.lastWrite = 0
+
+    def send(self, command, kind=STATE_COMMAND, since=None):
+        '''
+        Queue a command for the device, without waiting for it to be written.
+        :param command: dictionary of the command fields
+        :param kind: ALARM_COMMAND, COMMAND or STATE_COMMAND
+        :param since: time (metrics.now()) of the event causing the command,
+                      for the alarm latency (default: now)
+        '''
+        now = metrics.now() if since is None else since
+        with self.condition:
+            if kind == ALARM_COMMAND:
+                if self.state is not None:
+                    merged = dict(self.state[0])
+                    merged.update(command)
+                    command = merged
+                    self.state = None
+                self.alarms.append((command, now))
+            elif kind == COMMAND:
+                self.commands.append((command, now))
+            else:
+                self.state = (command, now)
+            self.condition.notify()
+
+    def next(self):
+        '''
+        :return: (command, time queued, kind) of the next command to
+                 write, or None if there are none
+        '''
+        if self.alarms:
+            return self.alarms.popleft() + (ALARM_COMMAND,)
+        if self.commands:
+            return self.commands.popleft() + (COMMAND,)
+        if self.state is not None:
+            state, self.state = self.state, None
+            return state + (STATE_COMMAND,)
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.alarms or self.commands or self.state is not None):
+                    self.condition.wait()
+            # the command to write is chosen after the pause, so that
+            # an alarm queued in the meantime still goes first
+            pause = self.lastWrite + self.write_interval - time.time()
+            if pause > 0:
+                time.sleep(pause)
+            with self.condition:
+                command, queued, kind = self.next()
+            data = self.encode(command)
+            self.port.write(data)
+            self.lastWrite = time.time()
+            if kind == ALARM_COMMAND:
+                latency = metrics.now() - queued
+                metrics.ALARM_SECONDS.observe('alarm', latency)
+                if self.debug_queue:
+                    self.debug_queue.put("DEVICE: alarm command sent in %.1f ms" % (latency * 1000))
+            if self.debug_queue:
+                self.debug_queue.put("DEVICE: Sent to Serial Port: %s" % data)
@@ -6,10 +6,22 @@ import tornado.web
 import tornado.websocket
 import tornado.gen
 from tornado.options import define, options
+import ConfigParser
 import multiprocessing
 import node
 import processor
+import device
+import framering
+import pipeline
+import recorder
+import render
+import metrics
+import sensors
+import streams
+import json
 import sys
+import time
+from collections import deque
 
 CONFIG_FILE_DEFAULT = './config/grideye.cfg'
 NODE_SECTION = 'Node'
@@ -19,19 +31,33 @@ RELAY = 'Relay'
 SEP_TAG = '_'
 STATUS_ON = 'ON'
 STATUS_OFF = 'OFF'
+FRAME_TRANSPORT_OPT = 'frame_transport'
+FRAME_RING_SLOTS_OPT = 'frame_ring_slots'
+FRAME_TRANSPORT_QUEUE = 'queue'
+FRAME_TRANSPORT_SHARED = 'shared_memory'
+
+# a client with more control messages than this waiting to be sent, or
+# whose last message has not been sent after this many seconds, is
+# considered stuck and disconnected
+CLIENT_MAX_BACKLOG = 100
+CLIENT_STALL_TIMEOUT = 10
 
 define("port", default=8080, help="run on the given port", type=int)
 
 clients = []
-# Communication direction
-web_to_node_queue = multiprocessing.Queue()  # UI -> Node
-processor_to_web_queue = multiprocessing.Queue()  # Processor -> UI
-processor_to_node_queue = multiprocessing.Queue()  # Processor -> Node
-node_to_processor_queue = multiprocessing.Queue()  # Node -> Processor
+sensor_ids = []  # the sensors, in the order of their [Device:<name>] sections
+# Communication direction (pipeline.StageQueue instances, created from the config)
+web_to_node_queues = {}  # UI -> Node, by sensor
+processor_to_web_queue = None  # Processors -> UI
+processor_to_node_queues = {}  # Processor -> Node, by sensor
+node_to_processor_queues = []  # Nodes -> Processors, by processor shard
+node_to_recorder_queues = {}  # Node -> Recorder (if recording), by sensor
+render_queues = []  # Processor <-> render workers (if any)
 
 debug_queue = None  # multiprocessing.Queue()
+default_format = streams.webframe.FORMAT_JSON  # frame format for the clients not subscribing
+stream_demand = pipeline.StreamDemand()  # what the clients consume, read by the processor
 alarms = []
-device = {}
 
 
 class IndexHandler(tornado.web.RequestHandler):
@@ -39,16 +65,137 @@ class IndexHandler(tornado.web.RequestHandler):
         self.render('./web/index.html')
 
 
+def get_queues():
+    '''
+    :return: all the pipeline queues
+    '''
+    queues = web_to_node_queues.values() + node_to_processor_queues + processor_to_node_queues.values()
+    queues.append(processor_to_web_queue)
+    queues.extend(node_to_recorder_queues.values())
+    queues.extend(render_queues)
+    return sorted(queues, key=lambda queue: queue.name)
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        # per-stage counters of the pipeline queues
+        stats = {}
+        for queue in get_queues():
+            stats[queue.name] = queue.getStats()
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(stats))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        # stage latencies and queue counters, in the Prometheus text format
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.format(get_queues()))
+
+
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
     def open(self):
         print 'new connection'
+        # outgoing messages: control messages are all sent, in order,
+        # while frames are coalesced to the newest one
+        self.pendingControl = deque()
+        self.pendingFrame = None
+        self.pendingWrite = None  # future of the message being sent
+        self.pendingTimestamps = None  # timestamps of the frame being sent
+        self.writeStart = 0
+        self.subscription = streams.Subscription(default_format)
+        self.lastFrameTimes = {}  # by sensor
         clients.append(self)
+        update_demand()
         self.write_message("connected")
+        self.queueMessage(json.dumps({sensors.SENSORS_TAG: sensor_ids}))
+
+    def queueMessage(self, message, droppable=False, binary=False, timestamps=None):
+        '''
+        Queue a message for the client, without waiting for the
+        previous ones to be sent.
+        :param message: the message
+        :param droppable: True if the message is a frame, that can be replaced
+                          by a newer one while waiting
+        :param binary: True to send the message as a binary WebSocket message
+        :param timestamps: the frame timestamps (metrics), if the message is a frame
+        '''
+        if droppable:
+            if self.pendingFrame is not None:
+                metrics.CLIENT_FRAMES_DROPPED.increment()
+            self.pendingFrame = (message, binary, timestamps)
+        else:
+            self.pendingControl.append((message, binary, None))
+        if len(self.pendingControl) > CLIENT_MAX_BACKLOG or \
+                (self.pendingWrite is not None and time.time() - self.writeStart > CLIENT_STALL_TIMEOUT):
+            print 'client too slow, closing connection'
+            self.close()
+            return
+        self.sendNext()
+
+    def sendNext(self):
+        if self.pendingWrite is not None:
+            return
+        if self.pendingControl:
+            message, binary, timestamps = self.pendingControl.popleft()
+        elif self.pendingFrame is not None:
+            message, binary, timestamps = self.pendingFrame
+            self.pendingFrame = None
+        else:
+            return
+        try:
+            self.pendingWrite = self.write_message(message, binary=binary)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.writeStart = time.time()
+        self.pendingTimestamps = timestamps
+        tornado.ioloop.IOLoop.current().add_future(self.pendingWrite, self.onWritten)
+
+    def wantsFrame(self, now, sensor):
+        '''
+        :return: True if a frame of the sensor received now has to be sent
+                 to the client, according to the sensors and rate it subscribed to
+        '''
+        if not self.subscription.wantsSensor(sensor):
+            return False
+        if self.subscription.rate > 0:
+            if now - self.lastFrameTimes.get(sensor, 0) < 1.0 / self.subscription.rate:
+                return False
+            self.lastFrameTimes[sensor] = now
+        return True
+
+    def onWritten(self, future):
+        if self.pendingTimestamps is not None:
+            metrics.observeSend(self.pendingTimestamps)
+        self.pendingWrite = None
+        self.sendNext()
 
     def on_message(self, message):
         # print 'tornado received from client: %s' % json.dumps(message)
         # self.write_message('ack')
-        web_to_node_queue.put(message)
+        try:
+            data = json.loads(message)
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and streams.SUBSCRIBE in data:
+            # stream settings are handled here, not by the node
+            try:
+                self.subscription.update(data[streams.SUBSCRIBE])
+            except (TypeError, ValueError, AttributeError):
+                print "WEB: invalid subscription - %s" % message
+            update_demand()
+            return
+        # messages for a sensor go to its node, the others to all the nodes
+        sensor = data.get(sensors.SENSOR_TAG) if isinstance(data, dict) else None
+        if sensor is None:
+            queues = [web_to_node_queues[name] for name in sensor_ids]
+        elif sensor in web_to_node_queues:
+            queues = [web_to_node_queues[sensor]]
+        else:
+            print "WEB: unknown sensor - %s" % message
+            return
+        for queue in queues:
+            queue.put(message)
         if debug_queue:
             debug_queue.put("WEB: send msg to node - %s" % message)
         else:
@@ -57,16 +204,41 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
     def on_close(self):
         print 'connection closed'
         clients.remove(self)
+        update_demand()
 
 
-# check the queue for pending messages, and rely that to all connected clients
-def check_queue():
-    while not processor_to_web_queue.empty():
-        message = processor_to_web_queue.get()
-        if debug_queue:
-            debug_queue.put("WEB: recv msg from processor - %s" % message)
-        for c in clients:
-            c.write_message(message)
+# let the processor know what the connected clients consume,
+# so that it does not build the parts of the frames nobody wants
+def update_demand():
+    stream_demand.set(streams.getDemand(c.subscription for c in clients))
+
+
+# invoked by the IOLoop when the processor queue has pending messages:
+# relay them to all the connected clients (the frames, to the clients
+# subscribed to their sensor). Each variant of a frame is encoded once,
+# and shared by all the clients subscribed to it
+def on_processor_message(fd, events):
+    now = time.time()
+    for droppable, message in processor_to_web_queue.drainItems(block=False):
+        if not streams.isFrame(message):
+            if debug_queue:
+                debug_queue.put("WEB: recv msg from processor - %s" % message)
+            for c in list(clients):
+                c.queueMessage(message, droppable)
+            continue
+        timestamps = message.setdefault(metrics.TIMESTAMPS_TAG, {})
+        metrics.stamp(message, metrics.STAGE_RECEIVE)
+        variants = streams.FrameVariants(message)
+        sensor = message.get(sensors.SENSOR_TAG, sensors.DEFAULT_SENSOR)
+        sending = []
+        for c in list(clients):
+            if c.wantsFrame(now, sensor):
+                payload, binary = variants.get(c.subscription)
+                sending.append((c, payload, binary))
+        metrics.stamp(message, metrics.STAGE_SERIALIZATION)
+        metrics.observeFrame(timestamps)
+        for c, payload, binary in sending:
+            c.queueMessage(payload, droppable, binary, timestamps)
 
 
 def print_debug():
@@ -77,14 +249,71 @@ def print_debug():
 if __name__ == '__main__':
     # read config
     cfgFile = sys.argv[1] if len(sys.argv) > 1 else CONFIG_FILE_DEFAULT
-    # start the serial worker in background (as a deamon)
-    node = node.Node(web_to_node_queue, processor_to_node_queue, node_to_processor_queue, cfgFile, debug_queue)
-    # start the monitoring process worker in background (as a deamon)
-    proc = processor.Processor(node_to_processor_queue, processor_to_node_queue, processor_to_web_queue,
-                               config_file=cfgFile)
-
-    node.daemon = True
-    proc.daemon = True
+    config = ConfigParser.ConfigParser()
+    config.optionxform = str
+    config.read(cfgFile)
+    sensor_ids = sensors.getSensors(config)
+    # the queues of a single sensor keep their stage name
+    multiSensor = len(sensor_ids) > 1
+    processor_to_web_queue = pipeline.createStageQueue(config, 'processor_to_web', streams=sensor_ids)
+    if config.has_option(streams.WEB_SECTION, streams.FRAME_FORMAT_OPT):
+        default_format = config.get(streams.WEB_SECTION, streams.FRAME_FORMAT_OPT)
+    # the sensors are shared among the processor processes, up to one per core
+    shards = min(len(sensor_ids), multiprocessing.cpu_count())
+    if config.has_option(processor.PROCESSOR_SECTION, sensors.PROCESSES_OPT):
+        shards = max(1, min(len(sensor_ids), config.getint(processor.PROCESSOR_SECTION, sensors.PROCESSES_OPT)))
+    nodes = []
+    shardProcessors = []
+    frameRecorders = []
+    renderWorkers = []
+    for shard, shardSensors in enumerate(sensors.assignShards(sensor_ids, shards)):
+        node_to_processor_queue = pipeline.createStageQueue(config, 'node_to_processor',
+                                                            instance=str(shard) if shards > 1 else None,
+                                                            streams=shardSensors)
+        node_to_processor_queues.append(node_to_processor_queue)
+        # the thermal images of the shard are rendered by these workers (if any)
+        renderPool, workers = render.createRenderPool(config, processor_to_web_queue,
+                                                      str(shard) if shards > 1 else None)
+        if renderPool is not None:
+            render_queues.extend((renderPool.render_queue, renderPool.rendered_queue))
+            renderWorkers.extend(workers)
+        processors = []
+        for sensor in shardSensors:
+            instance = sensor if multiSensor else None
+            sensorConfig = sensors.sensorConfig(config, sensor)
+            web_to_node_queues[sensor] = pipeline.createStageQueue(config, 'web_to_node', pipeline.DROP_NONE,
+                                                                   instance)
+            processor_to_node_queues[sensor] = pipeline.createStageQueue(config, 'processor_to_node',
+                                                                         pipeline.DROP_NONE, instance)
+            frameRing = None
+            if sensorConfig.has_option(NODE_SECTION, FRAME_TRANSPORT_OPT) and \
+                    sensorConfig.get(NODE_SECTION, FRAME_TRANSPORT_OPT) == FRAME_TRANSPORT_SHARED:
+                # sensor frames go through shared memory, only their reference through the queue
+                slots = framering.DEFAULT_RING_SLOTS
+                if sensorConfig.has_option(NODE_SECTION, FRAME_RING_SLOTS_OPT):
+                    slots = sensorConfig.getint(NODE_SECTION, FRAME_RING_SLOTS_OPT)
+                pixelFormat = device.getPixelFormat(sensorConfig)
+                frameRing = framering.FrameRing(device.GRID_SIZE_X, device.GRID_SIZE_Y, slots,
+                                                device.PIXEL_DTYPES[pixelFormat])
+            # raw frames recorder (optional), fed by the node
+            frameRecorder = recorder.createRecorder(sensorConfig, pipeline.createStageQueue(
+                config, 'node_to_recorder', pipeline.DROP_NEWEST, instance), debug_queue, instance)
+            recorder_queue = None
+            if frameRecorder is not None:
+                recorder_queue = node_to_recorder_queues[sensor] = frameRecorder.recorder_queue
+                frameRecorders.append(frameRecorder)
+            # the serial worker of the sensor
+            nodes.append(node.Node(web_to_node_queues[sensor], processor_to_node_queues[sensor],
+                                   node_to_processor_queue, cfgFile, debug_queue, frame_ring=frameRing,
+                                   recorder_queue=recorder_queue, sensor=sensor))
+            processors.append(processor.Processor(node_to_processor_queue, processor_to_node_queues[sensor],
+                                                  processor_to_web_queue, config_file=cfgFile,
+                                                  frame_ring=frameRing, stream_demand=stream_demand,
+                                                  sensor=sensor, render_pool=renderPool))
+        # the monitoring process of the shard
+        shardProcessors.append(processor.ProcessorShard(node_to_processor_queue, processors, renderPool,
+                                                        debug_queue))
+
     tornado.options.parse_command_line()
     app = tornado.web.Application(
         handlers=[
@@ -94,6 +323,8 @@ if __name__ == '__main__':
             (r'/(grideye.js)', tornado.web.StaticFileHandler, {'path': './web/'}),
             (r'/(jquery.onoff.css)', tornado.web.StaticFileHandler, {'path': './web/'}),
             (r'/(grideye.css)', tornado.web.StaticFileHandler, {'path': './web/'}),
+            (r"/stats", StatsHandler),
+            (r"/metrics", MetricsHandler),
             (r"/ws", WebSocketHandler)
         ]
     )
@@ -102,13 +333,14 @@ if __name__ == '__main__':
     print "Listening on port:", options.port
 
     mainLoop = tornado.ioloop.IOLoop.instance()
-    # adjust the scheduler_interval according to the frames sent by the serial port
+    # wake up as soon as the processor sends something
+    mainLoop.add_handler(processor_to_web_queue._reader.fileno(), on_processor_message, tornado.ioloop.IOLoop.READ)
     scheduler_interval = 50
-    scheduler = tornado.ioloop.PeriodicCallback(check_queue, scheduler_interval, io_loop=mainLoop)
     # uncomment if debugging 
     scheduler2 = tornado.ioloop.PeriodicCallback(print_debug, scheduler_interval, io_loop=mainLoop)
     scheduler2.start()
-    scheduler.start()
-    node.start()
-    proc.start()
+    # start the workers in background (as deamons)
+    for worker in nodes + shardProcessors + renderWorkers + frameRecorders:
+        worker.daemon = True
+        worker.start()
     mainLoop.start()
@@ -0,0 +1,268 @@
+__author__ = 'fabio'
+import binascii
+import fcntl
+import json
+import os
+import struct
+import termios
+import threading
+import time
+import numpy as np
+from device import GE, NON_LATCHING_RELAY, LATCHING_RELAY, BINARY, DEVICE_ID_TAG, DEVICE_TYPE_TAG, \
+    DEVICE_ID, DEVICE_TYPE, GRID_SIZE_X, GRID_SIZE_Y, BINARY_MAGIC, BINARY_HEADER, \
+    START_MARKER, END_MARKER
+
+SIMULATOR_SECTION = 'Simulator'
+RATE_OPT = 'rate'
+SOURCE_OPT = 'source'
+BLOBS_OPT = 'blobs'
+BACKGROUND_OPT = 'background'
+NOISE_OPT = 'noise'
+BLOB_TEMPERATURE_OPT = 'blob_temperature'
+SEED_OPT = 'seed'
+
+SOURCE_SYNTHETIC = 'synthetic'  # otherwise, the directory of a recording (see recorder.py)
+
+DEFAULT_RATE = 10.0  # frames per second, 0 for as fast as the reader takes them
+DEFAULT_BLOBS = 1
+DEFAULT_BACKGROUND = 22.0
+DEFAULT_NOISE = 0.2
+DEFAULT_BLOB_TEMPERATURE = 8.0  # above the background
+BLOB_SIGMA = 0.8                # blob radius (pixels)
+BLOB_SPEED = 0.3                # max blob speed (pixels per frame)
+TEMPERATURE_SCALE = 256         # the sensor values are in 1/256 C
+
+
+class SyntheticScene(object):
+    '''
+    Warm blobs moving over a noisy background, bouncing on the edges.
+    '''
+
+    def __init__(self, blobs=DEFAULT_BLOBS, background=DEFAULT_BACKGROUND, noise=DEFAULT_NOISE,
+                 blob_temperature=DEFAULT_BLOB_TEMPERATURE, seed=None, sizeX=GRID_SIZE_X, sizeY=GRID_SIZE_Y):
+        self.random = np.random.RandomState(seed)
+        self.background = background
+        self.noise = noise
+        self.blob_temperature = blob_temperature
+        self.size = np.array([sizeX - 1, sizeY - 1], dtype=float)
+        self.positions = self.random.uniform(0, 1, (blobs, 2)) * self.size
+        self.speeds = self.random.uniform(-BLOB_SPEED, BLOB_SPEED, (blobs, 2))
+        self.grid = np.mgrid[0:sizeX, 0:sizeY].astype(float)
+
+    def next(self):
+        '''
+        :return: the next frame, (sizeX,sizeY) array of temperatures
+        '''
+        self.positions += self.speeds
+        # bounce on the edges
+        out = (self.positions < 0) | (self.positions > self.size)
+        self.speeds[out] = -self.speeds[out]
+        self.positions = np.clip(self.positions, 0, self.size)
+        frame = self.background + self.random.normal(0, self.noise, self.grid.shape[1:])
+        for x, y in self.positions:
+            distance = (self.grid[0] - x) ** 2 + (self.grid[1] - y) ** 2
+            frame += self.blob_temperature * np.exp(-distance / (2 * BLOB_SIGMA ** 2))
+        return frame
+
+
+class RecordedScene(object):
+    '''
+    The frames of a recording, played in a loop.
+    '''
+
+    def __init__(self, directory):
+        import recorder
+        self.segments = [recorder.readSegment(path)[0] for path in recorder.listSegments(directory)]
+        self.segments = [records for records in self.segments if len(records)]
+        if not self.segments:
+            raise ValueError("no frames recorded in %s" % directory)
+        self.int16 = self.segments[0].dtype['pixels'].base == np.dtype('<i2')
+        self.segment = 0
+        self.record = 0
+
+    def next(self):
+        records = self.segments[self.segment]
+        pixels = records[self.record]['pixels']
+        self.record += 1
+        if self.record == len(records):
+            self.record = 0
+            self.segment = (self.segment + 1) % len(self.segments)
+        return pixels / float(TEMPERATURE_SCALE) if self.int16 else np.array(pixels)
+
+
+class SimulatedSerial(object):
+    '''
+    Stand-in for the serial port of the device, emulating the firmware:
+    it sends the scene frames in the firmware wire format (JSON, or
+    binary once enabled with the BIN command) at the given rate, and
+    applies the relay commands it receives, as reported in the binary
+    frames. Only the methods used by Device are implemented.
+    The frames are written by a thread to a pipe, so the port can be
+    waited on with select. The thread is started on first use, in the
+    process using the port (after the fork of the Node).
+    '''
+
+    def __init__(self, scene, rate=DEFAULT_RATE, debug_queue=None):
+        '''
+        :param scene: source of the frames (SyntheticScene or RecordedScene)
+        :param rate: frames per second, 0 for as fast as the reader takes them
+        :param debug_queue: output queue for debugging messages
+        '''
+        self.scene = scene
+        self.rate = rate
+        self.debug_queue = debug_queue
+        self.pid = None
+        self.reader = None
+        self.writer = None
+        self.commandBuffer = ''
+        self.nlr = 0
+        self.lr = 0
+        self.sensor = True
+        self.binary = False
+        self.sequence = 0
+        self.commands = 0  # commands received
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.reader, self.writer = os.pipe()
+        thread = threading.Thread(target=self.run, name='SimulatedDevice')
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        interval = 1.0 / self.rate if self.rate > 0 else 0
+        nextFrame = time.time()
+        while True:
+            if interval:
+                pause = nextFrame - time.time()
+                if pause > 0:
+                    time.sleep(pause)
+                nextFrame = max(nextFrame + interval, time.time() - interval)
+            # blocks while the pipe is full: the reader sets the pace
+            os.write(self.writer, self.encodeFrame(self.scene.next()))
+
+    def encodeFrame(self, temperatures):
+        '''
+        :param temperatures: (GRID_SIZE_X,GRID_SIZE_Y) array
+        :return: the frame as sent by the firmware
+        '''
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        pixels = np.rint(np.ravel(temperatures) * TEMPERATURE_SCALE).astype('<i2')
+        if self.binary and self.sensor:
+            body = BINARY_HEADER.pack(DEVICE_ID, DEVICE_TYPE, self.sequence) + pixels.tostring() + \
+                struct.pack('<BB', self.nlr, self.lr)
+            return BINARY_MAGIC + body + struct.pack('<H', binascii.crc_hqx(body, 0xFFFF))
+        return json.dumps({DEVICE_ID_TAG: DEVICE_ID, DEVICE_TYPE_TAG: DEVICE_TYPE,
+                           GE: pixels.tolist() if self.sensor else []}) + '\r\n'
+
+    def fileno(self):
+        self.start()
+        return self.reader
+
+    def inWaiting(self):
+        self.start()
+        return struct.unpack('i', fcntl.ioctl(self.reader, termios.FIONREAD, struct.pack('i', 0)))[0]
+
+    def read(self, size=1):
+        self.start()
+        return os.read(self.reader, size)
+
+    def flushInput(self):
+        pass
+
+    def write(self, data):
+        '''
+        Receive the commands, as the firmware does ({...}, one or more)
+        '''
+        self.commandBuffer += data
+        while END_MARKER in self.commandBuffer:
+            command, self.commandBuffer = self.commandBuffer.split(END_MARKER, 1)
+            start = command.rfind(START_MARKER)
+            if start >= 0:
+                self.apply(command[start:] + END_MARKER)
+        return len(data)
+
+    def apply(self, command):
+        try:
+            data = json.loads(command.replace("'", '"'))
+        except ValueError:
+            return
+        self.commands += 1
+        if NON_LATCHING_RELAY in data:
+            self.nlr = int(data[NON_LATCHING_RELAY]) & 0xFF
+        if LATCHING_RELAY in data:
+            self.lr = int(data[LATCHING_RELAY]) & 0x07
+        if BINARY in data:
+            self.binary = data[BINARY] != 0
+        if GE in data:
+            self.sensor = data[GE] != 0
+        if self.debug_queue:
+            self.debug_queue.put("SIMULATOR: applied %s (NLR %d, LR %d)" % (command, self.nlr, self.lr))
+
+
+def createSimulator(config, debug_queue=None):
+    '''
+    Create the simulated device, from the [Simulator] section of the configuration.
+    :param config: a ConfigParser instance
+    :return: a SimulatedSerial
+    '''
+    def option(name, default, get=config.get):
+        return get(SIMULATOR_SECTION, name) if config.has_option(SIMULATOR_SECTION, name) else default
+    source = option(SOURCE_OPT, SOURCE_SYNTHETIC)
+    if source == SOURCE_SYNTHETIC:
+        seed = option(SEED_OPT, None, config.getint)
+        scene = SyntheticScene(blobs=option(BLOBS_OPT, DEFAULT_BLOBS, config.getint),
+                               background=option(BACKGROUND_OPT, DEFAULT_BACKGROUND, config.getfloat),
+                               noise=option(NOISE_OPT, DEFAULT_NOISE, config.getfloat),
+                               blob_temperature=option(BLOB_TEMPERATURE_OPT, DEFAULT_BLOB_TEMPERATURE,
+                                                       config.getfloat),
+                               seed=seed)
+    else:
+        scene = RecordedScene(source)
+    return SimulatedSerial(scene, option(RATE_OPT, DEFAULT_RATE, config.getfloat), debug_queue)
+
+
+def loadTest(config_file, duration=30.0):
+    '''
+    Drive the Node and the Processor with the simulated device set in
+    the configuration (e.g. rate = 0, as fast as possible), and report
+    the frame rates of each stage.
+    :param config_file: configuration file, with port = sim://
+    :param duration: test duration (s)
+    '''
+    import ConfigParser
+    import node
+    import pipeline
+    import processor
+    config = ConfigParser.ConfigParser()
+    config.optionxform = str
+    config.read(config_file)
+    web_to_node = pipeline.createStageQueue(config, 'web_to_node', pipeline.DROP_NONE)
+    processor_to_node = pipeline.createStageQueue(config, 'processor_to_node', pipeline.DROP_NONE)
+    node_to_processor = pipeline.createStageQueue(config, 'node_to_processor')
+    processor_to_web = pipeline.createStageQueue(config, 'processor_to_web')
+    deviceNode = node.Node(web_to_node, processor_to_node, node_to_processor, config_file)
+    proc = processor.Processor(node_to_processor, processor_to_node, processor_to_web, config_file=config_file)
+    deviceNode.daemon = proc.daemon = True
+    deviceNode.start()
+    proc.start()
+    processed = 0
+    start = time.time()
+    while time.time() - start < duration:
+        for message in processor_to_web.drain(timeout=0.5):
+            if isinstance(message, dict) and message.get(GE) is not None:
+                processed += 1
+    elapsed = time.time() - start
+    stats = node_to_processor.getStats()
+    print "node -> processor: %8.1f frames/s (%d dropped)" % (stats['sent'] / elapsed, stats['dropped'])
+    print "processed:         %8.1f frames/s" % (processed / elapsed)
+    deviceNode.terminate()
+    proc.terminate()
+
+
+if __name__ == '__main__':
+    import sys
+    loadTest(sys.argv[1] if len(sys.argv) > 1 else './config/grideye.cfg',
+             float(sys.argv[2]) if len(sys.argv) > 2 else 30.0)
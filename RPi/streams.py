@@ -0,0 +1,178 @@
+__author__ = 'fabio'
+import json
+import numpy as np
+import webframe
+from processor import GE_MIN, GE_MAX, GE_AVG, GE_MDN, GE_STD, GE_BINARY, GE_TEMP, GE_RAW, GE_SEQ, GE_IMAGES
+from device import GE, NON_LATCHING_RELAY, LATCHING_RELAY, GRID_SIZE_X
+from metrics import TIMESTAMPS_TAG
+from pipeline import DEMAND_CLIENTS, DEMAND_IMAGE, DEMAND_BINARY, DEMAND_TEMP, DEMANDS, IMAGE_DEMANDS
+from sensors import SENSOR_TAG, SENSORS_TAG, DEFAULT_SENSOR
+
+# subscription message sent by a web client:
+# {"SUBSCRIBE": {"FORMAT": "uint8", "RES": 32, "RATE": 5, "CHANNELS": ["STATS", "IMAGE"],
+#                "SENSORS": ["hall", "door"]}}
+SUBSCRIBE = "SUBSCRIBE"
+FORMAT_TAG = "FORMAT"
+RESOLUTION_TAG = "RES"
+RATE_TAG = "RATE"
+CHANNELS_TAG = "CHANNELS"
+GE_ROWS = "GE_ROWS"
+GE_COLS = "GE_COLS"
+
+CHANNEL_STATS = "STATS"    # frame min, max, mean, median and std. dev.
+CHANNEL_IMAGE = "IMAGE"    # thermal image, at the subscribed resolution
+CHANNEL_BINARY = "BINARY"  # binary grid of the detected objects
+CHANNEL_TEMP = "TEMP"      # temperature grid
+ALL_CHANNELS = frozenset((CHANNEL_STATS, CHANNEL_IMAGE, CHANNEL_BINARY, CHANNEL_TEMP))
+
+FORMATS = (webframe.FORMAT_JSON, webframe.FORMAT_UINT8, webframe.FORMAT_UINT16)
+# thermal image resolutions a client can subscribe to: the raw grid,
+# 32x32 and 64x64 (0 for the processor image size)
+RESOLUTIONS = frozenset((GRID_SIZE_X,) + tuple(IMAGE_DEMANDS))
+
+# fields of a processed frame, that are not sent as they are
+FRAME_FIELDS = (GE, GE_RAW, GE_TEMP, GE_BINARY, GE_MIN, GE_MAX, GE_AVG, GE_MDN, GE_STD, GE_IMAGES,
+                TIMESTAMPS_TAG)
+
+WEB_SECTION = 'Web'
+FRAME_FORMAT_OPT = 'frame_format'
+
+
+class Subscription(object):
+    '''
+    What a web client receives of the frame stream.
+    resolution is the size of the (square) thermal image, one of
+    RESOLUTIONS, or None for the processor image size. rate is the max number of frames
+    per second of each sensor (0 for no limit). sensors are the ids
+    of the sensors whose frames are sent, or None for all of them.
+    '''
+
+    def __init__(self, format=webframe.FORMAT_JSON, resolution=None, rate=0, channels=ALL_CHANNELS,
+                 sensors=None):
+        self.format = format
+        self.resolution = resolution
+        self.rate = rate
+        self.channels = frozenset(channels)
+        self.sensors = sensors
+
+    def getKey(self):
+        '''
+        :return: the key of the variant of the frames sent to the subscriber
+        '''
+        return (self.format, self.resolution if CHANNEL_IMAGE in self.channels else None, self.channels)
+
+    def update(self, data):
+        '''
+        Update the subscription from the content of a SUBSCRIBE message.
+        Invalid values are ignored.
+        '''
+        if data.get(FORMAT_TAG) in FORMATS:
+            self.format = str(data[FORMAT_TAG])
+        if data.get(RESOLUTION_TAG) in RESOLUTIONS:
+            self.resolution = int(data[RESOLUTION_TAG])
+        elif data.get(RESOLUTION_TAG) == 0:
+            self.resolution = None
+        if RATE_TAG in data:
+            self.rate = max(0.0, float(data[RATE_TAG]))
+        if CHANNELS_TAG in data:
+            self.channels = frozenset(str(channel) for channel in data[CHANNELS_TAG]) & ALL_CHANNELS
+        if SENSORS_TAG in data:
+            sensors = data[SENSORS_TAG]
+            self.sensors = None if sensors is None else frozenset(str(sensor) for sensor in sensors)
+
+    def wantsSensor(self, sensor):
+        return self.sensors is None or sensor in self.sensors
+
+
+class FrameVariants(object):
+    '''
+    The encoded variants of one processed frame, each built once on the
+    first request and then shared by all the subscribers asking for it.
+    '''
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.variants = {}
+
+    def getImage(self, resolution):
+        '''
+        :return: the thermal image at the given resolution (2-D array), or
+                 None if the processor did not build it (no subscriber for
+                 it when the frame was processed). The images are built
+                 by the processor, never here: the web server only
+                 encodes and sends them
+        '''
+        image = self.frame.get(GE)
+        if image is not None and (resolution is None or resolution == image.shape[0]):
+            return image
+        if resolution is None:
+            return None
+        raw = self.frame[GE_RAW]
+        if resolution == raw.shape[0]:
+            return raw
+        return self.frame.get(GE_IMAGES, {}).get(resolution)
+
+    def get(self, subscription):
+        '''
+        :return: (message, binary) the frame encoded for the subscription
+        '''
+        key = subscription.getKey()
+        if key not in self.variants:
+            self.variants[key] = self.encode(subscription)
+        return self.variants[key]
+
+    def encode(self, subscription):
+        frame = self.frame
+        channels = subscription.channels
+        image = self.getImage(subscription.resolution) if CHANNEL_IMAGE in channels else None
+        binary = frame.get(GE_BINARY) if CHANNEL_BINARY in channels else None
+        temperatures = frame.get(GE_TEMP) if CHANNEL_TEMP in channels else None
+        if subscription.format != webframe.FORMAT_JSON:
+            stats = (frame[GE_MIN], frame[GE_MAX], frame[GE_AVG], frame[GE_MDN], frame[GE_STD])
+            return webframe.encode(frame[GE_SEQ], stats, image=image, binary=binary,
+                                   temperatures=temperatures,
+                                   nlr=frame.get(NON_LATCHING_RELAY, 0),
+                                   lr=frame.get(LATCHING_RELAY, 0),
+                                   depth=subscription.format,
+                                   sensor=frame.get(SENSOR_TAG, DEFAULT_SENSOR)), True
+        message = dict((key, value) for key, value in frame.iteritems() if key not in FRAME_FIELDS)
+        if CHANNEL_STATS in channels:
+            for key in (GE_MIN, GE_MAX, GE_AVG, GE_MDN, GE_STD):
+                message[key] = frame[key]
+        if image is not None:
+            message[GE] = image.ravel().tolist()
+            message[GE_ROWS], message[GE_COLS] = image.shape
+        if binary is not None:
+            message[GE_BINARY] = binary.ravel().tolist()
+        if temperatures is not None:
+            message[GE_TEMP] = temperatures.ravel().tolist()
+        return json.dumps(message), False
+
+
+def getDemand(subscriptions):
+    '''
+    :param subscriptions: the subscriptions of the connected clients
+    :return: the StreamDemand counters for them: the processor builds
+             the thermal images only at the resolutions the clients take
+             (the raw one is served from GE_RAW)
+    '''
+    demand = [0] * DEMANDS
+    for subscription in subscriptions:
+        demand[DEMAND_CLIENTS] += 1
+        if CHANNEL_IMAGE in subscription.channels:
+            if subscription.resolution is None:
+                demand[DEMAND_IMAGE] += 1
+            elif subscription.resolution in IMAGE_DEMANDS:
+                demand[IMAGE_DEMANDS[subscription.resolution]] += 1
+        if CHANNEL_BINARY in subscription.channels:
+            demand[DEMAND_BINARY] += 1
+        if CHANNEL_TEMP in subscription.channels:
+            demand[DEMAND_TEMP] += 1
+    return demand
+
+
+def isFrame(message):
+    '''
+    :return: True if the message from the processor is a processed frame
+    '''
+    return isinstance(message, dict) and GE_MIN in message
@@ -22,25 +22,155 @@ $(document).ready(function () {
             var pixel_bw = $('<div id="col-bw-' + i + '" class="col-bw"></div>').data('row-bw', r).data('col-bw', i);
             row_bw.append(pixel_bw);
             pixel_bw.on('click', null, {x: r, y: i}, function (ev) {
-                sendMessage({'data': JSON.stringify({'X': ev.data.x, 'Y': ev.data.y})});
+                sendCommand({'X': ev.data.x, 'Y': ev.data.y, 'ZONE': zone});
             });
         }
     }
 
     var host = window.location.host;
     var ws = new WebSocket('ws://' + host + '/ws');
+    ws.binaryType = 'arraybuffer';
     var $message = $('#received');
+    var $sensor = $('#sensor');
+    var sensor = null;  // the sensor shown, once the server sent the sensors list
+    var $zone = $('#zone');
+    var zone = 'alarm';  // the alarm zone shown and edited on the grid
+    var zones = {};      // the zones snapshot of the sensor shown (see zones.py)
+
+    // binary frame message flags (see webframe.py for the layout)
+    var FLAG_UINT16 = 1;
+    var FLAG_IMAGE = 2;
+    var FLAG_BINARY = 4;
+    var FLAG_TEMP = 8;
+    var FRAME_HEADER_SIZE = 45;
+    var FRAME_STATS = ['GE_MIN', 'GE_MAX', 'GE_AVG', 'GE_MDN', 'GE_STD'];
+
+    // decode a binary frame message into the same fields of a JSON one
+    var decodeFrame = function (buffer) {
+        var view = new DataView(buffer);
+        var flags = view.getUint8(3);
+        var msg = {'SEQ': view.getUint32(4, true), 'NLR': view.getUint8(8), 'LR': view.getUint8(9)};
+        var imgRows = view.getUint16(10, true);
+        var imgCols = view.getUint16(12, true);
+        var gridCells = view.getUint8(14) * view.getUint8(15);
+        for (var i = 0; i < FRAME_STATS.length; i++) {
+            msg[FRAME_STATS[i]] = view.getFloat32(16 + i * 4, true);
+        }
+        var low = view.getFloat32(36, true);
+        var high = view.getFloat32(40, true);
+        var sensorLength = view.getUint8(44);
+        msg.SENSOR = String.fromCharCode.apply(null, new Uint8Array(buffer, FRAME_HEADER_SIZE, sensorLength));
+        var offset = FRAME_HEADER_SIZE + sensorLength;
+        if (flags & FLAG_IMAGE) {
+            var imgCells = imgRows * imgCols;
+            var wide = (flags & FLAG_UINT16) != 0;
+            var step = (high - low) / (wide ? 65535 : 255);
+            var image = new Array(imgCells);
+            for (var i = 0; i < imgCells; i++) {
+                image[i] = low + step * (wide ? view.getUint16(offset + 2 * i, true) : view.getUint8(offset + i));
+            }
+            msg.GE = image;
+            msg.GE_ROWS = imgRows;
+            msg.GE_COLS = imgCols;
+            offset += imgCells * (wide ? 2 : 1);
+        }
+        if (flags & FLAG_BINARY) {
+            var bw = new Array(gridCells);
+            for (var i = 0; i < gridCells; i++) {
+                bw[i] = (view.getUint8(offset + (i >> 3)) >> (7 - (i & 7))) & 1;
+            }
+            msg.GE_BINARY = bw;
+            offset += (gridCells + 7) >> 3;
+        }
+        if (flags & FLAG_TEMP) {
+            var temps = new Array(gridCells);
+            for (var i = 0; i < gridCells; i++) {
+                temps[i] = view.getInt16(offset + 2 * i, true) / 256;
+            }
+            msg.GE_TEMP = temps;
+        }
+        return msg;
+    };
+
+    // stream subscription, from the page URL parameters, for example:
+    // /?format=uint8&res=32&rate=2&channels=stats,image
+    var subscriptionParams = {'format': 'FORMAT', 'res': 'RES', 'rate': 'RATE', 'channels': 'CHANNELS'};
+    var getSubscription = function () {
+        var subscription = {};
+        var params = window.location.search.substring(1).split('&');
+        for (var i = 0; i < params.length; i++) {
+            var param = params[i].split('=');
+            var key = subscriptionParams[param[0]];
+            if (key == 'CHANNELS') {
+                subscription[key] = decodeURIComponent(param[1]).toUpperCase().split(',');
+            } else if (key) {
+                subscription[key] = (key == 'FORMAT') ? param[1] : parseFloat(param[1]);
+            }
+        }
+        return subscription;
+    };
 
     ws.onopen = function () {
         $message.attr("class", 'label label-success');
         $message.text('Starting Up...');
+        var subscription = getSubscription();
+        if (!$.isEmptyObject(subscription)) {
+            sendMessage({'data': JSON.stringify({'SUBSCRIBE': subscription})});
+        }
         sendMessage({'data':JSON.stringify({'SRC': 'WEB','CMD':'UPDATE_UI'})});
     };
 
+    // show the sensor selected: only its frames are sent by the server
+    var selectSensor = function (id) {
+        sensor = id;
+        $('.col-bw').removeClass('active');
+        $(".alarm-box").removeClass("blink");
+        sendMessage({'data': JSON.stringify({'SUBSCRIBE': {'SENSORS': [sensor]}})});
+        sendCommand({'SRC': 'WEB', 'CMD': 'UPDATE_UI'});
+    };
+
+    $sensor.change(function () {
+        selectSensor($sensor.val());
+    });
+
+    // show the cells of the zone selected on the grid
+    var showZone = function () {
+        if (!(zone in zones)) {
+            return;
+        }
+        var mask = zones[zone].MASK;
+        var rows = $('.row-bw');
+        for (var i = 0; i < rows.length; i++) {
+            var cols = $('.col-bw', rows[i]);
+            for (var j = 0; j < cols.length; j++) {
+                var cell = i * cols.length + j;
+                var cellSet = (parseInt(mask.substr((cell >> 3) * 2, 2), 16) >> (7 - (cell & 7))) & 1;
+                $(cols[j]).toggleClass('active', cellSet == 1);
+            }
+        }
+    };
+
+    $zone.change(function () {
+        zone = $zone.val();
+        showZone();
+    });
+
     ws.onmessage = function (ev) {
         $message.attr("class", 'label label-info');
         try {
-            var json = JSON.parse(ev.data);
+            var json = (ev.data instanceof ArrayBuffer) ? decodeFrame(ev.data) : JSON.parse(ev.data);
+            if ("SENSORS" in json) {
+                $sensor.empty();
+                for (var i = 0; i < json.SENSORS.length; i++) {
+                    $sensor.append($('<option></option>').val(json.SENSORS[i]).text(json.SENSORS[i]));
+                }
+                $sensor.toggle(json.SENSORS.length > 1);
+                selectSensor(json.SENSORS[0]);
+                return;
+            }
+            if (sensor != null && "SENSOR" in json && json.SENSOR != sensor) {
+                return;
+            }
             if ("ALARM" in json) {
                 var alarmBox = $(".alarm-box");
                 if (json.ALARM == "SET") {
@@ -49,20 +179,18 @@ $(document).ready(function () {
                     alarmBox.removeClass("blink")
                 }
             }
-            if ("CELL" in json) {
-                var x = json.X;
-                var y = json.Y;
-                var cellSet = (json.CELL == "SET");
-                var cell = $('#row-bw-' + x + ' #col-bw-' + y);
-                if (cellSet) {
-                    if (!cell.hasClass('active')) {
-                        cell.addClass('active');
-                    }
-                } else {
-                    if (cell.hasClass('active')) {
-                        cell.removeClass('active');
-                    }
+            if ("ZONES" in json) {
+                zones = json.ZONES;
+                var names = Object.keys(zones);
+                $zone.empty();
+                for (var i = 0; i < names.length; i++) {
+                    $zone.append($('<option></option>').val(names[i]).text(names[i]));
                 }
+                if (!(zone in zones)) {
+                    zone = names[0];
+                }
+                $zone.val(zone).toggle(names.length > 1);
+                showZone();
             }
             if ("MODE" in json){
                 switch (json.MODE){
@@ -92,23 +220,32 @@ $(document).ready(function () {
                     checkBox.prop('checked', value);
                 }
             }
-            if ("GE" in json) {
+            if ("GE" in json || "GE_MIN" in json) {
                 var tMax = "GE_MAX" in json ? json.GE_MAX.toFixed(2) : "N/A";
                 var tMin = "GE_MIN" in json ? json.GE_MIN.toFixed(2) : "N/A";
                 var tMean = "GE_AVG" in json ? json.GE_AVG.toFixed(2) : "N/A";
                 var tMdn = "GE_MDN" in json ? json.GE_MDN.toFixed(2) : "N/A";
                 var tStd = "GE_STD" in json ? json.GE_STD.toFixed(2) : "N/A";
                 $message.text("Max: " + tMax + "℃ - Min: " + tMin + "℃ - Mean: " + tMean + "℃ - Med: " + tMdn + "℃ - Std Dev: " + tStd + "℃");
+            }
+            if ("GE" in json && json.GE.length > 0) {
+                var rows = $('.row');
+                // the image resolution may be lower than the grid one
+                var imgRows = "GE_ROWS" in json ? json.GE_ROWS : rows.length;
+                var imgCols = "GE_COLS" in json ? json.GE_COLS : json.GE.length / imgRows;
+                var rangeMin = "GE_MIN" in json ? json.GE_MIN : Math.min.apply(null, json.GE);
+                var rangeMax = "GE_MAX" in json ? json.GE_MAX : Math.max.apply(null, json.GE);
                 var myRainbow = new Rainbow();
                 //myRainbow.setNumberRange(tMin*100,tMax*100);
-                myRainbow.setNumberRange(tMin * 100, tMax * 100);
+                myRainbow.setNumberRange(rangeMin * 100, rangeMax * 100);
                 myRainbow.setSpectrum("#5e4fa2", "#3288bd", "#66c2a5", "#abdda4", "#e6f598", "#ffffbf", "#fee08b", "#fdae61", "#f46d43", "#d53e4f", "#9e0142");
-                var rows = $('.row');
                 for (var i = 0; i < rows.length; i++) {
                     var row = rows[i];
                     var cols = $('.col', row);
+                    var imgRow = Math.floor(i * imgRows / rows.length) * imgCols;
                     for (var j = 0; j < cols.length; j++) {
-                        $(cols[j]).css('background-color', myRainbow.colourAt(json.GE[i * cols.length + j] * 100));
+                        var value = json.GE[imgRow + Math.floor(j * imgCols / cols.length)];
+                        $(cols[j]).css('background-color', myRainbow.colourAt(value * 100));
                         //$(cols[j]).text(json.GE[i*cols.length+j].toFixed(2)).css("fontSize",12).css("font-family","Verdana, Geneva, sans-serif");
                     }
                 }
@@ -143,31 +280,38 @@ $(document).ready(function () {
 //console.log("sending:" + message.data);
         ws.send(message.data);
     };
+    // send a command to the device of the sensor shown
+    var sendCommand = function (command) {
+        if (sensor != null) {
+            command.SENSOR = sensor;
+        }
+        sendMessage({'data': JSON.stringify(command)});
+    };
 
     $('input[name=detection-mode]').attr("disabled",true);
 
     $('.reset-button').click(function (ev) {
         ev.preventDefault();
-        sendMessage({'data': JSON.stringify({'ALARM': 'RESET'})});
+        sendCommand({'ALARM': 'RESET'});
     });
 
     $('.reload-button').click(function (ev) {
         ev.preventDefault();
-        sendMessage({'data': JSON.stringify({'BACKGROUND': 'RESET'})});
+        sendCommand({'BACKGROUND': 'RESET'});
     });
 
     for (var i = 1; i <= 8; i++) {
         $('input[id=nlr' + i + ']').click({value: i}, function (ev) {
             ev.preventDefault();
             var statusStr = $(this).is(':checked') ? 'ON' : 'OFF';
-            sendMessage({'data': JSON.stringify({'NLR': ev.data.value, 'STATUS': statusStr})});
+            sendCommand({'NLR': ev.data.value, 'STATUS': statusStr});
         });
     }
     for (var i = 1; i <= 3; i++) {
         $("input[id=lr" + i + "]").click({value: i}, function (ev) {
             ev.preventDefault();
             var statusStr = $(this).is(':checked') ? 'ON' : 'OFF';
-            sendMessage({'data': JSON.stringify({'LR': ev.data.value, 'STATUS': statusStr})});
+            sendCommand({'LR': ev.data.value, 'STATUS': statusStr});
         });
     }
 });
\ No newline at end of file
@@ -0,0 +1,89 @@
+__author__ = 'fabio'
+import struct
+import numpy as np
+
+# Binary frame message sent to the web clients (decoded by grideye.js).
+# All the fields are little-endian:
+#   header (HEADER struct):
+#     magic 'GF', version, flags, sequence number (uint32), NLR, LR,
+#     image rows and columns (uint16), grid rows and columns (uint8),
+#     frame min, max, mean, median, std. dev., image min and max (float32),
+#     sensor id length (uint8)
+#   sensor id (ASCII)
+#   image (if FLAG_IMAGE): rows*columns values quantized over
+#     [image min, image max], uint8 or uint16 (FLAG_UINT16)
+#   binary grid (if FLAG_BINARY): grid rows*columns bits, packed in bytes
+#   temperature grid (if FLAG_TEMP): grid rows*columns int16, in 1/256 C
+MAGIC = 'GF'
+VERSION = 2
+HEADER = struct.Struct('<2sBBIBBHHBB7fB')
+
+FLAG_UINT16 = 1
+FLAG_IMAGE = 2
+FLAG_BINARY = 4
+FLAG_TEMP = 8
+
+FORMAT_JSON = 'json'
+FORMAT_UINT8 = 'uint8'
+FORMAT_UINT16 = 'uint16'
+
+TEMPERATURE_SCALE = 256
+
+
+def quantize(image, levels):
+    '''
+    :param image: 2-D array of temperatures
+    :param levels: max quantized value
+    :return: (quantized values, min, max)
+    '''
+    low = float(image.min())
+    high = float(image.max())
+    if high > low:
+        quantized = np.rint((image - low) * (levels / (high - low)))
+    else:
+        quantized = np.zeros(image.shape)
+    return quantized, low, high
+
+
+def encode(sequence, stats, image=None, binary=None, temperatures=None,
+           nlr=0, lr=0, depth=FORMAT_UINT8, sensor=''):
+    '''
+    Encode a frame message.
+    :param sequence: frame sequence number
+    :param stats: (min, max, mean, median, std. dev.) of the frame
+    :param image: 2-D array, the thermal image
+    :param binary: 2-D array, the binary (detected objects) grid
+    :param temperatures: 2-D array, the temperature grid
+    :param nlr: non-latching relays status
+    :param lr: latching relays status
+    :param depth: FORMAT_UINT8 or FORMAT_UINT16, the image values size
+    :param sensor: the sensor id (up to 255 characters)
+    :return: the encoded message (string)
+    '''
+    flags = 0
+    parts = []
+    imgRows = imgCols = gridRows = gridCols = 0
+    low = high = 0.0
+    if image is not None:
+        flags |= FLAG_IMAGE
+        imgRows, imgCols = image.shape
+        if depth == FORMAT_UINT16:
+            flags |= FLAG_UINT16
+            quantized, low, high = quantize(image, 0xFFFF)
+            parts.append(quantized.astype('<u2').tostring())
+        else:
+            quantized, low, high = quantize(image, 0xFF)
+            parts.append(quantized.astype(np.uint8).tostring())
+    if binary is not None:
+        flags |= FLAG_BINARY
+        gridRows, gridCols = binary.shape
+        parts.append(np.packbits(np.ravel(binary) != 0).tostring())
+    if temperatures is not None:
+        flags |= FLAG_TEMP
+        gridRows, gridCols = temperatures.shape
+        parts.append(np.rint(np.asarray(temperatures) * TEMPERATURE_SCALE).astype('<i2').tostring())
+    sensor = str(sensor)[:0xFF]
+    header = HEADER.pack(MAGIC, VERSION, flags, sequence & 0xFFFFFFFF, nlr, lr,
+                         imgRows, imgCols, gridRows, gridCols,
+                         stats[0], stats[1], stats[2], stats[3], stats[4], low, high, len(sensor))
+    return header + sensor + ''.join(parts)
@@ -0,0 +1,137 @@
+__author__ = 'fabio'
+from ast import literal_eval
+from collections import OrderedDict
+import numpy as np
+from analyser import PROCESSOR_SECTION
+from sensors import SECTION_SEP
+
+# The alarm zones of a sensor: the [Processor] alarm_mask, alarm_command
+# and alarm_trigger_threshold options make the DEFAULT_ZONE, and each
+# [Zone_<name>] section adds a zone with its own mask, command and
+# trigger threshold (the ones of [Processor] by default). As the other
+# sections, [Zone_<name>:<sensor>] overrides it for one sensor.
+ALARM_MASK_OPT = 'alarm_mask'  # [Processor] option: the cells of the DEFAULT_ZONE
+ZONE_SECTION_PREFIX = 'Zone_'
+ZONE_MASK_OPT = 'mask'
+ZONE_COMMAND_OPT = 'command'
+ZONE_TRIGGER_THRESHOLD_OPT = 'trigger_threshold'
+DEFAULT_ZONE = 'alarm'
+
+ZONE_TAG = "ZONE"    # zone name, in the mask edits and alarm messages
+ZONES_TAG = "ZONES"  # zones snapshot, sent to the web clients
+MASK_TAG = "MASK"    # zone cells, packed bits (row by row) in hex
+ROWS_TAG = "ROWS"
+COLS_TAG = "COLS"
+TRIGGERED_TAG = "TRIGGERED"
+
+
+def parseCells(text):
+    '''
+    :param text: the cells of a mask, as "(x,y) (x,y) ..."
+    :return: list of (x, y) tuples
+    '''
+    return [literal_eval(cell) for cell in text.split()]
+
+
+class AlarmZone(object):
+    '''
+    Set of cells of the grid raising an alarm once objects are detected
+    in it for trigger_threshold frames. The cells are kept both as a
+    boolean grid and as an integer bitmask, with the bit layout of
+    DetectedObject.getBitmask, so that testing an object is a single AND.
+    '''
+    __slots__ = ('name', 'mask', 'bits', 'command', 'trigger_threshold', 'counter', 'triggered')
+
+    def __init__(self, name, shape, cells=(), command=None, trigger_threshold=1):
+        '''
+        :param name: the zone name
+        :param shape: (rows, columns) of the grid
+        :param cells: the (x, y) cells of the zone
+        :param command: the JSON command to trigger the alarm on the device
+        :param trigger_threshold: number of frames with objects in the
+                                  zone before the alarm is triggered
+        '''
+        self.name = name
+        self.mask = np.zeros(shape, dtype=bool)
+        self.bits = 0
+        self.command = command
+        self.trigger_threshold = trigger_threshold
+        self.counter = 0
+        self.triggered = False
+        for x, y in cells:
+            if not self.mask[x, y]:
+                self.toggle(x, y)
+
+    def toggle(self, x, y):
+        '''
+        Add the cell (x, y) to the zone, or remove it.
+        :return: True if the cell is now in the zone
+        '''
+        self.mask[x, y] = not self.mask[x, y]
+        self.bits ^= 1 << (x * self.mask.shape[1] + y)
+        return bool(self.mask[x, y])
+
+    def intersects(self, detected_object):
+        return (self.bits & detected_object.getBitmask()) != 0
+
+    def hit(self):
+        '''
+        Count a frame with an object in the zone.
+        :return: True if the alarm has to be triggered
+        '''
+        if self.triggered:
+            return False
+        if self.counter == self.trigger_threshold:
+            self.counter = 0
+            self.triggered = True
+            return True
+        self.counter += 1
+        return False
+
+    def reset(self):
+        self.counter = 0
+        self.triggered = False
+
+    def snapshot(self):
+        '''
+        :return: the zone state, for the web clients
+        '''
+        return {MASK_TAG: np.packbits(self.mask.ravel()).tostring().encode('hex'),
+                TRIGGERED_TAG: self.triggered}
+
+
+def readZones(config, shape, command, trigger_threshold):
+    '''
+    Create the alarm zones of the configuration.
+    :param config: a ConfigParser instance, as seen by the sensor (see sensors.sensorConfig)
+    :param shape: (rows, columns) of the grid
+    :param command: the default alarm command
+    :param trigger_threshold: the default trigger threshold
+    :return: OrderedDict of the AlarmZone instances by name, DEFAULT_ZONE first
+    '''
+    zones = OrderedDict()
+    cells = []
+    if config is not None and config.has_option(PROCESSOR_SECTION, ALARM_MASK_OPT):
+        cells = parseCells(config.get(PROCESSOR_SECTION, ALARM_MASK_OPT))
+    zones[DEFAULT_ZONE] = AlarmZone(DEFAULT_ZONE, shape, cells, command, trigger_threshold)
+    if config is None:
+        return zones
+    for section in config.sections():
+        if not section.startswith(ZONE_SECTION_PREFIX) or SECTION_SEP in section:
+            continue
+        name = section[len(ZONE_SECTION_PREFIX):]
+        cells = parseCells(config.get(section, ZONE_MASK_OPT)) if config.has_option(section, ZONE_MASK_OPT) else []
+        zoneCommand = config.get(section, ZONE_COMMAND_OPT) \
+            if config.has_option(section, ZONE_COMMAND_OPT) else command
+        zoneThreshold = config.getint(section, ZONE_TRIGGER_THRESHOLD_OPT) \
+            if config.has_option(section, ZONE_TRIGGER_THRESHOLD_OPT) else trigger_threshold
+        zones[name] = AlarmZone(name, shape, cells, zoneCommand, zoneThreshold)
+    return zones
+
+
+def zonesMessage(zones, shape):
+    '''
+    :return: the snapshot of all the zones, as one message for the web clients
+    '''
+    return {ZONES_TAG: OrderedDict((name, zone.snapshot()) for name, zone in zones.iteritems()),
+            ROWS_TAG: shape[0], COLS_TAG: shape[1]}